@@ -0,0 +1,80 @@
+import sys
+import json
+import logging
+import random
+import argparse
+import timeit
+from dotenv import load_dotenv
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', dest='config')
+parser.add_argument('--turns', dest='turns', type=int, nargs='+', default=[1, 3, 10, 25, 50])
+parser.add_argument('--repeat', dest='repeat', type=int, default=200)
+parser.add_argument('--chats', dest='chats', help='JSON file with a list of recorded chats, each a list of {role, content} messages')
+args = parser.parse_args()
+
+load_dotenv(dotenv_path='.env')
+load_dotenv(dotenv_path=args.config)
+
+sys.path.insert(0, 'lambda_common')
+from lambda_slack import lambda_handler
+
+logging.disable(logging.INFO)
+
+
+WORDS = (
+    "the a to of and in is for that you it with on this be are as can your or an "
+    "slack channel thread message team project deploy release customer meeting "
+    "summary python lambda function error timeout please thanks could would should "
+    "here there what when where how why which because example following steps"
+).split()
+
+
+def random_text(rng, min_words, max_words):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def add_token_counts(chat):
+    for message in chat:
+        lambda_handler.set_token_count(message)
+    return chat
+
+
+def build_chat(rng, turns):
+    chat = lambda_handler.start_chat()
+    for _ in range(turns):
+        chat.append({"role": "user", "content": "<@U04KU9EAYNQ> " + random_text(rng, 8, 40) + "?"})
+        chat.append({"role": "assistant", "content": random_text(rng, 60, 300) + "."})
+    return add_token_counts(chat)
+
+
+def load_chats(path):
+    with open(path) as f:
+        chats = json.load(f)
+    return [add_token_counts(lambda_handler.start_chat() + [message for message in chat if message.get("role") != "system"]) for chat in chats]
+
+
+def main():
+    if args.chats:
+        chats = load_chats(args.chats)
+    else:
+        # A small repeated vocabulary compresses far better than real
+        # conversations, so these ratios are an upper bound
+        print("Synthetic chats: pass --chats with recorded chats for representative ratios")
+        rng = random.Random(42)
+        chats = [build_chat(rng, turns) for turns in args.turns]
+    print(f"{'turns':>6} {'plain B':>9} {'zlib B':>8} {'ratio':>6} {'encode us':>10} {'decode us':>10}")
+    for chat in chats:
+        turns = (len(chat) - 1) // 2
+        plain_size = len(json.dumps(chat))
+        encoded = lambda_handler.encode_chat(chat)
+        assert lambda_handler.decode_chat(encoded) == chat
+
+        encode_us = timeit.timeit(lambda: lambda_handler.encode_chat(chat), number=args.repeat) / args.repeat * 1e6
+        decode_us = timeit.timeit(lambda: lambda_handler.decode_chat(encoded), number=args.repeat) / args.repeat * 1e6
+        print(f"{turns:>6} {plain_size:>9} {len(encoded):>8} {plain_size / len(encoded):>6.2f} {encode_us:>10.1f} {decode_us:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,11 @@ from aws_cdk import (
     aws_iam as iam,
     aws_s3 as s3,
     aws_lambda,
+    aws_lambda_event_sources as lambda_event_sources,
     aws_lambda_python_alpha as lambda_python,
     aws_dynamodb as dynamodb,
     aws_logs as logs,
+    aws_sqs as sqs,
     aws_events as events,
     aws_events_targets as targets,
     Stack,
@@ -55,6 +57,96 @@ class SlackAppStack(Stack):
             )
         )
 
+        # Creating Lambda layer with the modules shared by all Lambda functions
+        lambda_common_layer = lambda_python.PythonLayerVersion(
+            self,
+            f'{env}-{name}-lambda-common-layer',
+            layer_version_name=f'{env}-{name}-lambda-common-layer',
+            entry='lambda_common',
+            compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_9],
+        )
+
+        lambda_logging_environment = {
+            'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'INFO'),
+            'LOG_MAX_FIELD_CHARS': os.environ.get('LOG_MAX_FIELD_CHARS', '512'),
+            'LOG_SAMPLE_RATES': os.environ.get('LOG_SAMPLE_RATES', ''),
+        }
+
+        # Creating SQS queue that decouples Slack event ingress from OpenAI generation
+        slack_events_dlq = sqs.Queue(
+            self,
+            f'{env}-{name}-slack-events-dlq',
+            queue_name=f'{env}-{name}-slack-events-dlq',
+            retention_period=Duration.days(14),
+        )
+
+        slack_events_queue = sqs.Queue(
+            self,
+            f'{env}-{name}-slack-events-queue',
+            queue_name=f'{env}-{name}-slack-events-queue',
+            visibility_timeout=Duration.seconds(1800),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3,
+                queue=slack_events_dlq
+            ),
+        )
+
+        lambda_slack_environment = {
+            **lambda_logging_environment,
+            'OPENAI_API_KEY': os.environ['OPENAI_API_KEY'],
+            'OPENAI_MODEL': os.environ['OPENAI_MODEL'],
+            'SLACK_SIGNING_SECRET': os.environ['SLACK_SIGNING_SECRET'],
+            'SLACK_CLIENT_ID': os.environ['SLACK_CLIENT_ID'],
+            'SLACK_CLIENT_SECRET': os.environ['SLACK_CLIENT_SECRET'],
+            'SLACK_BOT_TOKEN': os.environ['SLACK_BOT_TOKEN'],
+            'SLACK_SCOPES': os.environ['SLACK_SCOPES'],
+            'SLACK_INSTALLATION_S3_BUCKET_NAME': os.environ['SLACK_INSTALLATION_S3_BUCKET_NAME'],
+            'SLACK_STATE_S3_BUCKET_NAME': os.environ['SLACK_STATE_S3_BUCKET_NAME'],
+            'SLACK_APP_URL': os.environ['SLACK_APP_URL'],
+            'DDB_USERS_ID': os.environ['DDB_USERS_ID'],
+            'DDB_USERS_EMAIL': os.environ['DDB_USERS_EMAIL'],
+            'FREE_TRIAL_DAYS': os.environ['FREE_TRIAL_DAYS'],
+            'DDB_TRIAL_TIMERS': f'{env}_{name.replace("-","_")}_trial_timers',
+            'DDB_PUBLIC_CHATS': os.environ['DDB_PUBLIC_CHATS'],
+            'DDB_PUBLIC_CHATS': os.environ['DDB_PUBLIC_CHATS'],
+            'DDB_PRIVATE_CHATS': os.environ['DDB_PRIVATE_CHATS'],
+            'SLACK_EVENTS': os.environ['SLACK_EVENTS'],
+            'MAX_CHAT_LENGTH': os.environ['MAX_CHAT_LENGTH'],
+            'OPENAI_FALLBACK_MODEL': os.environ.get('OPENAI_FALLBACK_MODEL', ''),
+            'OPENAI_BASE_URL': os.environ.get('OPENAI_BASE_URL', ''),
+            'OPENAI_MAX_ATTEMPTS': os.environ.get('OPENAI_MAX_ATTEMPTS', '3'),
+            'OPENAI_REQUEST_TIMEOUT': os.environ.get('OPENAI_REQUEST_TIMEOUT', '60'),
+            'OPENAI_HEDGE': os.environ.get('OPENAI_HEDGE', 'false'),
+            'MODEL_ROUTES': os.environ.get('MODEL_ROUTES', ''),
+            'CHAT_STORAGE': os.environ.get('CHAT_STORAGE', 'item'),
+            'CHAT_CODEC': os.environ.get('CHAT_CODEC', ''),
+            'CHAT_SAVE_ATTEMPTS': os.environ.get('CHAT_SAVE_ATTEMPTS', '3'),
+            'DDB_CHAT_TURNS': f'{env}_{name.replace("-","_")}_chat_turns',
+            'PROMPT_TOKEN_BUDGET': os.environ.get('PROMPT_TOKEN_BUDGET', '3000'),
+            'LATEST_TURN_MIN_TOKENS': os.environ.get('LATEST_TURN_MIN_TOKENS', '256'),
+            'SUMMARY_TOKEN_THRESHOLD': os.environ.get('SUMMARY_TOKEN_THRESHOLD', '0'),
+            'SUMMARY_KEEP_TURNS': os.environ.get('SUMMARY_KEEP_TURNS', '4'),
+            'RESPONSE_CACHE_TTL': os.environ.get('RESPONSE_CACHE_TTL', '0'),
+            'RESPONSE_CACHE_MAX_MESSAGES': os.environ.get('RESPONSE_CACHE_MAX_MESSAGES', '2'),
+            'USER_CACHE_TTL': os.environ.get('USER_CACHE_TTL', '60'),
+            'HOME_VIEW_MAX_AGE': os.environ.get('HOME_VIEW_MAX_AGE', '86400'),
+            'USER_CACHE_NEGATIVE_TTL': os.environ.get('USER_CACHE_NEGATIVE_TTL', '30'),
+            'DDB_RESPONSE_CACHE': f'{env}_{name.replace("-","_")}_response_cache',
+            'DDB_EVENTS': f'{env}_{name.replace("-","_")}_events',
+            'TEAM_REQUESTS_PER_MINUTE': os.environ.get('TEAM_REQUESTS_PER_MINUTE', '0'),
+            'TEAM_TOKENS_PER_MINUTE': os.environ.get('TEAM_TOKENS_PER_MINUTE', '0'),
+            'RATE_LIMIT_MAX_WAIT': os.environ.get('RATE_LIMIT_MAX_WAIT', '2.0'),
+            'DDB_RATE_LIMITS': f'{env}_{name.replace("-","_")}_rate_limits',
+            'STRIPE_MONTHLY_LINK': os.environ['STRIPE_MONTHLY_LINK'],
+            'STRIPE_ANNUAL_LINK': os.environ['STRIPE_ANNUAL_LINK'],
+            'STRIPE_LIFETIME_LINK': os.environ['STRIPE_LIFETIME_LINK'],
+            'STREAM_RESPONSES': os.environ.get('STREAM_RESPONSES', 'false'),
+            'SLACK_ASYNC': os.environ.get('SLACK_ASYNC', 'false'),
+            'STREAM_UPDATE_INTERVAL': os.environ.get('STREAM_UPDATE_INTERVAL', '1.0'),
+            'WORKER_BATCH_SIZE': os.environ.get('WORKER_BATCH_SIZE', '10'),
+            'WORKER_CONCURRENCY': os.environ.get('WORKER_CONCURRENCY', '10'),
+        }
+
         # Creating Lambda function that will be triggered by Lambda function URL
         lambda_slack_function_name=f'{env}-{name}-lambda-slack-function'
         lambda_slack_function = lambda_python.PythonFunction(
@@ -66,29 +158,12 @@ class SlackAppStack(Stack):
             index='lambda_handler.py',
             handler='handler',
             environment={
-                'OPENAI_API_KEY': os.environ['OPENAI_API_KEY'],
-                'OPENAI_MODEL': os.environ['OPENAI_MODEL'],
-                'SLACK_SIGNING_SECRET': os.environ['SLACK_SIGNING_SECRET'],
-                'SLACK_CLIENT_ID': os.environ['SLACK_CLIENT_ID'],
-                'SLACK_CLIENT_SECRET': os.environ['SLACK_CLIENT_SECRET'],
-                'SLACK_BOT_TOKEN': os.environ['SLACK_BOT_TOKEN'],
-                'SLACK_SCOPES': os.environ['SLACK_SCOPES'],
-                'SLACK_INSTALLATION_S3_BUCKET_NAME': os.environ['SLACK_INSTALLATION_S3_BUCKET_NAME'],
-                'SLACK_STATE_S3_BUCKET_NAME': os.environ['SLACK_STATE_S3_BUCKET_NAME'],
-                'SLACK_APP_URL': os.environ['SLACK_APP_URL'],
-                'DDB_USERS_ID': os.environ['DDB_USERS_ID'],
-                'DDB_USERS_EMAIL': os.environ['DDB_USERS_EMAIL'],
-                'DDB_PUBLIC_CHATS': os.environ['DDB_PUBLIC_CHATS'],
-                'DDB_PUBLIC_CHATS': os.environ['DDB_PUBLIC_CHATS'],
-                'DDB_PRIVATE_CHATS': os.environ['DDB_PRIVATE_CHATS'],
-                'SLACK_EVENTS': os.environ['SLACK_EVENTS'],
-                'MAX_CHAT_LENGTH': os.environ['MAX_CHAT_LENGTH'],
-                'STRIPE_MONTHLY_LINK': os.environ['STRIPE_MONTHLY_LINK'],
-                'STRIPE_ANNUAL_LINK': os.environ['STRIPE_ANNUAL_LINK'],
-                'STRIPE_LIFETIME_LINK': os.environ['STRIPE_LIFETIME_LINK'],
+                **lambda_slack_environment,
+                'EVENT_QUEUE_URL': slack_events_queue.queue_url,
             },
             timeout=Duration.seconds(300),
             role=lambda_role,
+            layers=[lambda_common_layer],
         )
 
         lambda_slack_function_log_group = logs.LogGroup(
@@ -103,6 +178,56 @@ class SlackAppStack(Stack):
             auth_type=aws_lambda.FunctionUrlAuthType.NONE,
         )
 
+        # Creating Lambda function that drains the Slack events queue and runs the OpenAI work
+        lambda_slack_worker_function_name=f'{env}-{name}-lambda-slack-worker-function'
+        lambda_slack_worker_function = lambda_python.PythonFunction(
+            self,
+            lambda_slack_worker_function_name,
+            function_name=lambda_slack_worker_function_name,
+            runtime=aws_lambda.Runtime.PYTHON_3_9,
+            entry='lambda_slack',
+            index='lambda_handler.py',
+            handler='worker_handler',
+            environment={
+                **lambda_slack_environment,
+                # Failed records are made visible again through this queue
+                'EVENT_QUEUE_URL': slack_events_queue.queue_url,
+                'EVENT_RETRY_DELAY': os.environ.get('EVENT_RETRY_DELAY', '10'),
+            },
+            timeout=Duration.seconds(300),
+            role=lambda_role,
+            layers=[lambda_common_layer],
+        )
+
+        lambda_slack_worker_function_log_group = logs.LogGroup(
+            self,
+            f'{lambda_slack_worker_function_name}-logs',
+            log_group_name=f"/aws/lambda/{lambda_slack_worker_function_name}",
+            retention=logs.RetentionDays.ONE_MONTH
+        )
+
+        lambda_slack_worker_function.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                slack_events_queue,
+                batch_size=int(os.environ.get('WORKER_BATCH_SIZE', '10')),
+                report_batch_item_failures=True,
+            )
+        )
+        slack_events_queue.grant_send_messages(lambda_slack_function)
+
+        # Trial-ending DMs and home tab refreshes sent by the cron functions
+        lambda_notify_environment = {
+            'NOTIFY_TRIALS': os.environ.get('NOTIFY_TRIALS', 'false'),
+            'NOTIFY_DAYS_BEFORE': os.environ.get('NOTIFY_DAYS_BEFORE', '1'),
+            'SLACK_CLIENT_ID': os.environ['SLACK_CLIENT_ID'],
+            'SLACK_BOT_TOKEN': os.environ['SLACK_BOT_TOKEN'],
+            'SLACK_INSTALLATION_S3_BUCKET_NAME': os.environ['SLACK_INSTALLATION_S3_BUCKET_NAME'],
+            'SLACK_APP_URL': os.environ['SLACK_APP_URL'],
+            'STRIPE_MONTHLY_LINK': os.environ['STRIPE_MONTHLY_LINK'],
+            'STRIPE_ANNUAL_LINK': os.environ['STRIPE_ANNUAL_LINK'],
+            'STRIPE_LIFETIME_LINK': os.environ['STRIPE_LIFETIME_LINK'],
+        }
+
         # Creating Lambda function that runs on a daily schedule to disable free trials when completed
         lambda_cron_function_name=f'{env}-{name}-lambda-cron-function'
         lambda_cron_function = lambda_python.PythonFunction(
@@ -114,11 +239,18 @@ class SlackAppStack(Stack):
             index='lambda_handler.py',
             handler='handler',
             environment={
+                **lambda_logging_environment,
                 'DDB_USERS_ID': os.environ['DDB_USERS_ID'],
                 'FREE_TRIAL_DAYS': os.environ['FREE_TRIAL_DAYS'],
+                'DDB_CRON_CHECKPOINTS': f'{env}_{name.replace("-","_")}_cron_checkpoints',
+                'SWEEP_SEGMENTS': os.environ.get('SWEEP_SEGMENTS', '1'),
+                'SWEEP_CONCURRENCY': os.environ.get('SWEEP_CONCURRENCY', '8'),
+                'SWEEP_LOOKBACK_DAYS': os.environ.get('SWEEP_LOOKBACK_DAYS', '30'),
+                **lambda_notify_environment,
             },
             timeout=Duration.seconds(300),
             role=lambda_role,
+            layers=[lambda_common_layer],
         )
 
         lambda_cron_function_log_group = logs.LogGroup(
@@ -128,7 +260,36 @@ class SlackAppStack(Stack):
             retention=logs.RetentionDays.ONE_MONTH
         )
 
-        # Create the CloudWatch Events rule with a cron schedule
+        # Creating Lambda function that deactivates each trial as its timer expires
+        lambda_trial_expiry_function_name=f'{env}-{name}-lambda-trial-expiry-function'
+        lambda_trial_expiry_function = lambda_python.PythonFunction(
+            self,
+            lambda_trial_expiry_function_name,
+            function_name=lambda_trial_expiry_function_name,
+            runtime=aws_lambda.Runtime.PYTHON_3_9,
+            entry='lambda_cron',
+            index='lambda_handler.py',
+            handler='expiry_stream_handler',
+            environment={
+                **lambda_logging_environment,
+                'DDB_USERS_ID': os.environ['DDB_USERS_ID'],
+                'FREE_TRIAL_DAYS': os.environ['FREE_TRIAL_DAYS'],
+                'DDB_TRIAL_TIMERS': f'{env}_{name.replace("-","_")}_trial_timers',
+                **lambda_notify_environment,
+            },
+            timeout=Duration.seconds(60),
+            role=lambda_role,
+            layers=[lambda_common_layer],
+        )
+
+        lambda_trial_expiry_function_log_group = logs.LogGroup(
+            self,
+            f'{lambda_trial_expiry_function_name}-logs',
+            log_group_name=f"/aws/lambda/{lambda_trial_expiry_function_name}",
+            retention=logs.RetentionDays.ONE_MONTH
+        )
+
+        # Create the CloudWatch Events rule with a cron schedule - the nightly sweep expires trials on time, TTL deletes can arrive days late
         rule = events.Rule(
             self,
             'DailyLambdaSchedule',
@@ -149,12 +310,17 @@ class SlackAppStack(Stack):
             index='lambda_handler.py',
             handler='handler',
             environment={
+                **lambda_logging_environment,
                 'STRIPE_SECRET': os.environ['STRIPE_SECRET'],
                 'DDB_USERS_ID': os.environ['DDB_USERS_ID'],
                 'DDB_USERS_EMAIL': os.environ['DDB_USERS_EMAIL'],
+                'DDB_TRIAL_TIMERS': f'{env}_{name.replace("-","_")}_trial_timers',
+                'ACTIVATION_TRANSACTION_SIZE': os.environ.get('ACTIVATION_TRANSACTION_SIZE', '100'),
+                'ACTIVATION_CONCURRENCY': os.environ.get('ACTIVATION_CONCURRENCY', '4'),
             },
             timeout=Duration.seconds(300),
             role=lambda_role,
+            layers=[lambda_common_layer],
         )
 
         lambda_stripe_function_log_group = logs.LogGroup(
@@ -253,6 +419,21 @@ class SlackAppStack(Stack):
             projection_type=dynamodb.ProjectionType.ALL,
         )
 
+        # Create sparse DynamoDB secondary index holding only live trials by expiry day - the cron lambda reads only the days that are due
+        users_id_table.add_global_secondary_index(
+            index_name='trial_expiry_index',
+            partition_key=dynamodb.Attribute(
+                name='trial_expires_at',
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name='slack_id',
+                type=dynamodb.AttributeType.STRING
+            ),
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=['slack_install_timestamp'],
+        )
+
         # Create DynamoDB table for storing public chats 
         public_chats_table = dynamodb.Table(
             self,
@@ -277,12 +458,122 @@ class SlackAppStack(Stack):
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
         )
 
+        # Create DynamoDB table for storing public and private chats as one item per turn
+        chat_turns_table = dynamodb.Table(
+            self,
+            f'{env}-{name}-chat-turns-table',
+            table_name=f'{env}_{name.replace("-","_")}_chat_turns',
+            partition_key=dynamodb.Attribute(
+                name='chat_id',
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name='seq',
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        # Create DynamoDB table shared by warm containers for caching one-shot OpenAI responses
+        response_cache_table = dynamodb.Table(
+            self,
+            f'{env}-{name}-response-cache-table',
+            table_name=f'{env}_{name.replace("-","_")}_response_cache',
+            partition_key=dynamodb.Attribute(
+                name='cache_key',
+                type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute='expires_at',
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        # Create DynamoDB table recording in-flight and completed Slack events by event_id
+        events_table = dynamodb.Table(
+            self,
+            f'{env}-{name}-events-table',
+            table_name=f'{env}_{name.replace("-","_")}_events',
+            partition_key=dynamodb.Attribute(
+                name='event_id',
+                type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute='expires_at',
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        # Create DynamoDB table holding per-workspace OpenAI request and token counters
+        rate_limits_table = dynamodb.Table(
+            self,
+            f'{env}-{name}-rate-limits-table',
+            table_name=f'{env}_{name.replace("-","_")}_rate_limits',
+            partition_key=dynamodb.Attribute(
+                name='limit_key',
+                type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute='expires_at',
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        # Create DynamoDB table holding where an unfinished trial expiry sweep stopped
+        cron_checkpoints_table = dynamodb.Table(
+            self,
+            f'{env}-{name}-cron-checkpoints-table',
+            table_name=f'{env}_{name.replace("-","_")}_cron_checkpoints',
+            partition_key=dynamodb.Attribute(
+                name='checkpoint_id',
+                type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute='expires_at',
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        # Create DynamoDB table holding one timer per trial - TTL deletes it when the trial ends and its stream triggers the trial expiry lambda
+        trial_timers_table = dynamodb.Table(
+            self,
+            f'{env}-{name}-trial-timers-table',
+            table_name=f'{env}_{name.replace("-","_")}_trial_timers',
+            partition_key=dynamodb.Attribute(
+                name='timer_id',
+                type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute='expires_at',
+            stream=dynamodb.StreamViewType.KEYS_ONLY,
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+        lambda_trial_expiry_function.add_event_source(
+            lambda_event_sources.DynamoEventSource(
+                trial_timers_table,
+                starting_position=aws_lambda.StartingPosition.TRIM_HORIZON,
+                batch_size=100,
+                retry_attempts=10,
+                filters=[aws_lambda.FilterCriteria.filter({
+                    'eventName': aws_lambda.FilterRule.is_equal('REMOVE'),
+                    'userIdentity': {'principalId': aws_lambda.FilterRule.is_equal('dynamodb.amazonaws.com')},
+                })],
+            )
+        )
+
         # Update lambda function to read and write to dynamodb tables
         users_email_table.grant_read_write_data(lambda_slack_function)
         users_id_table.grant_read_write_data(lambda_slack_function)
         users_id_table.grant_read_write_data(lambda_cron_function)
+        cron_checkpoints_table.grant_read_write_data(lambda_cron_function)
+        users_id_table.grant_read_write_data(lambda_trial_expiry_function)
+        trial_timers_table.grant_read_write_data(lambda_slack_function)
+        trial_timers_table.grant_read_write_data(lambda_slack_worker_function)
+        trial_timers_table.grant_read_write_data(lambda_stripe_function)
         public_chats_table.grant_read_write_data(lambda_slack_function)
         private_chats_table.grant_read_write_data(lambda_slack_function)
+        users_id_table.grant_read_write_data(lambda_slack_worker_function)
+        public_chats_table.grant_read_write_data(lambda_slack_worker_function)
+        private_chats_table.grant_read_write_data(lambda_slack_worker_function)
+        chat_turns_table.grant_read_write_data(lambda_slack_function)
+        chat_turns_table.grant_read_write_data(lambda_slack_worker_function)
+        response_cache_table.grant_read_write_data(lambda_slack_function)
+        response_cache_table.grant_read_write_data(lambda_slack_worker_function)
+        events_table.grant_read_write_data(lambda_slack_function)
+        events_table.grant_read_write_data(lambda_slack_worker_function)
+        rate_limits_table.grant_read_write_data(lambda_slack_function)
+        rate_limits_table.grant_read_write_data(lambda_slack_worker_function)
 
 
 app = App()
@@ -0,0 +1,177 @@
+import os
+import hashlib
+import threading
+from collections import Counter
+from structured_log import log_event
+
+
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "25"))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "120"))
+
+clients = {}
+# Reentrant, since a factory may build the clients it wraps, e.g. the OpenAI
+# client and its httpx pool
+clients_lock = threading.RLock()
+# Counts registry lookups per client: instances created and lookups served an
+# existing instance. Connection reuse happens inside each client's own pool.
+registry_stats = Counter()
+# Connections opened and requests sent through the httpx pools, which keep no
+# counts of their own; the botocore pools are read in get_pool_stats
+http_pool_stats = Counter()
+http_pool_stats_lock = threading.Lock()
+
+
+def get_client(name, factory):
+    """
+    Get a client from the process-wide registry, building it on first use so
+    that warm invocations keep its connection pool
+
+    Args:
+        name (str): Registry key, e.g. "boto3.resource.dynamodb"
+        factory (callable): Builds the client
+    Returns:
+        Client built by factory
+    """
+    with clients_lock:
+        client = clients.get(name)
+        if client is None:
+            client = clients[name] = factory()
+            registry_stats[f"{name}.created"] += 1
+            log_event("clients", "get_client built", name=name)
+        else:
+            registry_stats[f"{name}.registry_hits"] += 1
+        return client
+
+
+def get_boto3_config():
+    """
+    Returns:
+        botocore.config.Config: Pool size and TCP keep-alive shared by all AWS clients
+    """
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        retries={"mode": "standard"},
+    )
+
+
+def get_boto3_resource(service_name):
+    """
+    Args:
+        service_name (str): AWS service, e.g. "dynamodb"
+    Returns:
+        boto3 resource shared by the process
+    """
+    def factory():
+        import boto3
+        return boto3.resource(service_name, config=get_boto3_config())
+    return get_client(f"boto3.resource.{service_name}", factory)
+
+
+def get_boto3_client(service_name):
+    """
+    Args:
+        service_name (str): AWS service, e.g. "sqs"
+    Returns:
+        boto3 client shared by the process
+    """
+    def factory():
+        import boto3
+        return boto3.client(service_name, config=get_boto3_config())
+    return get_client(f"boto3.client.{service_name}", factory)
+
+
+def count_http_pool_use(name):
+    """
+    Args:
+        name (str): Registry key of the httpx client
+    Returns:
+        callable: httpx request hook counting requests, and through the
+            httpcore trace extension, the connections the pool opens for them
+    """
+    def count(key):
+        with http_pool_stats_lock:
+            http_pool_stats[f"{name}.{key}"] += 1
+
+    def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            count("connections")
+
+    def on_request(request):
+        count("requests")
+        request.extensions["trace"] = trace
+    return on_request
+
+
+def get_http_client():
+    """
+    Returns:
+        httpx.Client: Keep-alive HTTP client for the OpenAI SDK
+    """
+    def factory():
+        import httpx
+        from openai import DefaultHttpxClient
+        return DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={"request": [count_http_pool_use("httpx.openai")]},
+        )
+    return get_client("httpx.openai", factory)
+
+
+def get_botocore_pools(client):
+    """
+    Args:
+        client: boto3 client or resource
+    Returns:
+        list: urllib3 connection pools of its botocore HTTP session
+    """
+    client = getattr(client.meta, "client", client)
+    # botocore has no public accessor for its urllib3 pool managers
+    http_session = client._endpoint.http_session
+    managers = [http_session._manager, *http_session._proxy_managers.values()]
+    return [manager.pools[key] for manager in managers for key in manager.pools.keys()]
+
+
+def get_pool_stats():
+    """
+    Count connection reuse in the pools of the registered AWS and OpenAI
+    clients. Slack's WebClient is built on urllib and has no pool.
+
+    Returns:
+        Counter: <name>.connections opened, <name>.requests sent and
+            <name>.reused, the requests that went over an open connection
+    """
+    with http_pool_stats_lock:
+        stats = Counter(http_pool_stats)
+    with clients_lock:
+        registered = list(clients.items())
+    for name, client in registered:
+        if name.startswith("boto3."):
+            for pool in get_botocore_pools(client):
+                stats[f"{name}.connections"] += pool.num_connections
+                stats[f"{name}.requests"] += pool.num_requests
+    for name in {key.rsplit(".", 1)[0] for key in stats}:
+        stats[f"{name}.reused"] = max(stats[f"{name}.requests"] - stats[f"{name}.connections"], 0)
+    return stats
+
+
+def get_slack_client(token):
+    """
+    Args:
+        token (str): Slack bot token
+    Returns:
+        slack_sdk.WebClient: Client shared by every event for this token
+    """
+    def factory():
+        from slack_sdk import WebClient
+        return WebClient(token=token)
+    # Tokens are kept out of registry keys, which show up in registry_stats
+    token_hash = hashlib.sha256((token or "").encode()).hexdigest()[:16]
+    return get_client(f"slack.{token_hash}", factory)
@@ -0,0 +1,105 @@
+import abc
+import time
+import heapq
+import threading
+from structured_log import log_event
+
+
+class ExpiryScheduler(abc.ABC):
+    """
+    Registers a deadline per key, e.g. the end of a user's free trial, so
+    that each key can be handled when its own deadline passes
+    """
+
+    @abc.abstractmethod
+    def schedule(self, key, expires_at):
+        """
+        Args:
+            key (str): Key to expire, replacing any deadline it already has
+            expires_at (int): Epoch time of the deadline
+        """
+
+    @abc.abstractmethod
+    def cancel(self, key):
+        """
+        Args:
+            key (str): Key whose deadline no longer applies
+        """
+
+
+class DynamoExpiryScheduler(ExpiryScheduler):
+    """
+    One item per key in a table with TTL on expires_at. DynamoDB deletes the
+    item after the deadline and the table's stream hands the deletion to
+    get_expired_keys. AWS only documents TTL deletes as happening within a
+    few days of the deadline, so this spreads expiry work out but does not
+    make it near-exact; the nightly sweep stays the expiry that can be relied
+    on, and exact deadlines need a one-time scheduler such as EventBridge
+    Scheduler instead.
+    """
+
+    def __init__(self, table, key_name="timer_id"):
+        self.table = table
+        self.key_name = key_name
+
+    def schedule(self, key, expires_at):
+        self.table.put_item(Item={self.key_name: key, "expires_at": int(expires_at)})
+        log_event("expiry", "schedule", key=key, expires_at=expires_at)
+
+    def cancel(self, key):
+        self.table.delete_item(Key={self.key_name: key})
+
+    def get_expired_keys(self, stream_event):
+        """
+        Args:
+            stream_event (dict): DynamoDB stream event delivered to Lambda
+        Returns:
+            list: Keys whose items were deleted by TTL, not by cancel
+        """
+        keys = []
+        for record in stream_event.get("Records", []):
+            user_identity = record.get("userIdentity") or {}
+            if record.get("eventName") != "REMOVE" or user_identity.get("principalId") != "dynamodb.amazonaws.com":
+                continue
+            keys.append(record["dynamodb"]["Keys"][self.key_name]["S"])
+        return keys
+
+
+class LocalExpiryScheduler(ExpiryScheduler):
+    """
+    In-process priority queue standing in for the DynamoDB backend in tests
+    and local runs
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        self.deadlines = {}
+        self.lock = threading.Lock()
+
+    def schedule(self, key, expires_at):
+        with self.lock:
+            self.deadlines[key] = expires_at
+            heapq.heappush(self.heap, (expires_at, key))
+
+    def cancel(self, key):
+        with self.lock:
+            self.deadlines.pop(key, None)
+
+    def pop_expired_keys(self, now=None):
+        """
+        Args:
+            now (float): Epoch time, defaults to the clock
+        Returns:
+            list: Keys whose deadline has passed, in deadline order
+        """
+        now = self.clock() if now is None else now
+        keys = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                expires_at, key = heapq.heappop(self.heap)
+                # Entries left behind by cancel or a later schedule are skipped
+                if self.deadlines.get(key) == expires_at:
+                    del self.deadlines[key]
+                    keys.append(key)
+        return keys
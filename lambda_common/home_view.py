@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+from functools import lru_cache
+
+
+SLACK_APP_URL = os.environ.get("SLACK_APP_URL")
+STRIPE_MONTHLY_LINK = os.environ['STRIPE_MONTHLY_LINK']
+STRIPE_ANNUAL_LINK = os.environ['STRIPE_ANNUAL_LINK']
+STRIPE_LIFETIME_LINK = os.environ['STRIPE_LIFETIME_LINK']
+
+
+def get_inactive_message():
+    return "We're thrilled you've been enjoying Bounce! Your free trial has wrapped up, but there's more value in store. Swing by the Home tab to continue taking advantage of enhanced productivity – subscribe now to keep bouncing with us! :rocket:"
+
+
+def get_trial_ending_message():
+    return "Thanks for trying Bounce! Your free trial is ending soon. Swing by the Home tab to subscribe and keep bouncing with us without a break! :rocket:"
+
+
+@lru_cache(maxsize=None)
+def get_home_view(plan_type, active):
+    blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": ":wave: Hi! I'm Bounce, your ChatGPT for Slack app!",
+            },
+        },
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "We are always improving! Click the button below to get the latest features.",
+            },
+        },
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Update now",
+                    },
+                    "url": SLACK_APP_URL,
+                },
+            ],
+        },
+    ]
+    if plan_type == "paid":
+        blocks.append(
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "Thanks for subscribing! Please share with your friends and colleagues!",
+                },
+            }
+        )
+        return {
+            "type": "home",
+            "callback_id": "home_view",
+            "blocks": blocks
+        }
+
+    if plan_type == "trial":
+        if active:
+            blocks.append(
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": "We hope you are enjoying your free trial!",
+                    },
+                }
+            )
+        else:
+            blocks.append(
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": "Your free trial has expired. Subscribe now to continue using Bounce.",
+                    },
+                }
+            )
+
+
+    blocks.extend([
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": "Click one of the buttons below to start your subscription!",
+            },
+        },
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Lifetime access for only $100",
+                    },
+                    "url": STRIPE_LIFETIME_LINK,
+                },
+            ],
+        },
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Annual access for $50/year",
+                    },
+                    "url": STRIPE_ANNUAL_LINK,
+                },
+            ],
+        },
+        {
+            "type": "actions",
+            "elements": [
+                {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Monthly access for $5/month",
+                    },
+                    "url": STRIPE_MONTHLY_LINK,
+                },
+            ],
+        },
+    ])
+    return {
+        "type": "home",
+        "callback_id": "home_view",
+        "blocks": blocks
+    }
+
+
+@lru_cache(maxsize=None)
+def get_home_view_hash(plan_type, active):
+    return hashlib.sha256(json.dumps(get_home_view(plan_type, active), sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,227 @@
+import time
+import random
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from structured_log import log_event
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when there is no time left before the deadline for another attempt
+    """
+
+
+class LatencyTracker:
+    """
+    Rolling window of recent call latencies
+    """
+
+    def __init__(self, window=100):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percentile):
+        """
+        Args:
+            percentile (float): Percentile between 0 and 100
+        Returns:
+            float: Latency in seconds, or None without samples
+        """
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+
+class ResilientOpenAI:
+    """
+    Chat completions with an overall deadline, jittered exponential backoff on
+    429 and 5xx responses, an optional hedged request once a call runs past
+    the observed p95 latency, and a fallback model once the primary model has
+    used up its attempts
+    """
+
+    def __init__(self, api_key, model, fallback_model=None, base_url=None, max_attempts=3,
+                 request_timeout=60.0, backoff_base=0.5, backoff_max=8.0, hedge=False,
+                 hedge_min_samples=20, http_client=None, clock=time.monotonic, sleep=time.sleep, jitter=random.random):
+        self.api_key = api_key
+        self.model = model
+        self.fallback_model = fallback_model if fallback_model != model else None
+        self.base_url = base_url
+        self.max_attempts = max_attempts
+        self.request_timeout = request_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.http_client = http_client
+        self.clock = clock
+        self.sleep = sleep
+        self.jitter = jitter
+        # Keyed by model, since routed models differ in latency
+        self.latency = {}
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.openai = None
+
+    @property
+    def client(self):
+        if self.openai is None:
+            from openai import OpenAI
+            self.openai = OpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0, http_client=self.http_client)
+        return self.openai
+
+    def count(self, name):
+        # Hedged calls run in worker threads
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        """
+        Returns:
+            dict: Copy of the call counters
+        """
+        with self.lock:
+            return dict(self.stats)
+
+    def get_latency(self, model):
+        """
+        Args:
+            model (str): Model name
+        Returns:
+            LatencyTracker: Recent latencies of calls to the model
+        """
+        with self.lock:
+            latency = self.latency.get(model)
+            if latency is None:
+                latency = self.latency[model] = LatencyTracker()
+            return latency
+
+    def is_retryable(self, error):
+        """
+        Args:
+            error (Exception): Error raised by the OpenAI client
+        Returns:
+            bool: Whether the call can be retried
+        """
+        import openai
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+    def get_backoff(self, attempt, error):
+        """
+        Full jitter exponential backoff that honors a Retry-After header
+
+        Args:
+            attempt (int): Zero based attempt number that failed
+            error (Exception): Error raised by the failed attempt
+        Returns:
+            float: Seconds to wait before the next attempt
+        """
+        backoff = self.jitter() * min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return max(backoff, float(retry_after)) if retry_after else backoff
+        except ValueError:
+            return backoff
+
+    def get_timeout(self, deadline):
+        remaining = deadline - self.clock() if deadline is not None else self.request_timeout
+        if remaining <= 0:
+            raise DeadlineExceeded("OpenAI deadline exceeded")
+        return min(self.request_timeout, remaining)
+
+    def call(self, model, messages, deadline, **kwargs):
+        start = self.clock()
+        response = self.client.with_options(timeout=self.get_timeout(deadline)).chat.completions.create(
+            model=model,
+            messages=messages,
+            **kwargs
+        )
+        if not kwargs.get("stream"):
+            self.get_latency(model).record(self.clock() - start)
+        return response
+
+    def call_hedged(self, model, messages, deadline, **kwargs):
+        # The hedge goes to the fallback model when there is one, since a slow
+        # model is usually slow for everyone. The losing call is abandoned.
+        latency = self.get_latency(model)
+        p95 = latency.percentile(95) if len(latency) >= self.hedge_min_samples else None
+        if not self.hedge or kwargs.get("stream") or p95 is None:
+            return self.call(model, messages, deadline, **kwargs)
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            pending = {executor.submit(self.call, model, messages, deadline, **kwargs)}
+            hedge = None
+            done, _ = wait(pending, timeout=p95)
+            if not done:
+                hedge_model = self.fallback_model or model
+                self.count("hedged")
+                log_event("openai", "hedging request", model=model, hedge_model=hedge_model, p95=p95)
+                hedge = executor.submit(self.call, hedge_model, messages, deadline, **kwargs)
+                pending.add(hedge)
+
+            error = None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedge:
+                            self.count("hedge_wins")
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            executor.shutdown(wait=False)
+
+    def create(self, messages, model=None, deadline=None, **kwargs):
+        """
+        Create a chat completion, retrying and falling back until the deadline
+
+        Args:
+            messages (list): Chat messages
+            model (str): Primary model, defaults to the configured model
+            deadline (float): Clock time by which the call must finish, or None
+            **kwargs: Extra chat.completions.create arguments, e.g. stream=True
+        Returns:
+            ChatCompletion or Stream: OpenAI response
+        """
+        model = model or self.model
+        models = [model] + ([self.fallback_model] if self.fallback_model and self.fallback_model != model else [])
+        error = None
+        for model_index, current_model in enumerate(models):
+            if model_index:
+                self.count("fallbacks")
+                log_event("openai", "falling back", level=logging.WARNING, model=model, fallback_model=current_model, error=error)
+            for attempt in range(self.max_attempts):
+                try:
+                    self.count("calls")
+                    return self.call_hedged(current_model, messages, deadline, **kwargs)
+                except DeadlineExceeded:
+                    self.count("deadlines")
+                    raise error or DeadlineExceeded("OpenAI deadline exceeded")
+                except Exception as e:
+                    if not self.is_retryable(e):
+                        raise
+                    error = e
+                backoff = self.get_backoff(attempt, error)
+                if attempt + 1 == self.max_attempts or (deadline is not None and self.clock() + backoff >= deadline):
+                    break
+                self.count("retries")
+                log_event("openai", "retrying", level=logging.WARNING, model=current_model, attempt=attempt + 1, backoff=backoff, error=error)
+                self.sleep(backoff)
+        self.count("failures")
+        raise error
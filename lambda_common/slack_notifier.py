@@ -0,0 +1,117 @@
+import time
+import threading
+from collections import Counter
+from token_bucket import TokenBucket
+from structured_log import log_event
+
+
+# Per workspace limits in calls per minute, chat.postMessage is about one per
+# second per channel and views.publish is Tier 4
+SLACK_METHOD_RATES = {
+    "chat.postMessage": 60,
+    "views.publish": 100,
+}
+
+
+class SlackNotifier:
+    """
+    Calls Slack Web API methods for many workspaces from many threads, keeping
+    each workspace under the method's rate limit and waiting out 429s
+    """
+
+    def __init__(self, get_client, rates=SLACK_METHOD_RATES, max_attempts=3, deadline=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            get_client (callable): Returns the slack_sdk.WebClient for a team id, or None
+            rates (dict): Calls per minute by method name
+            max_attempts (int): Calls made per notification before giving up on 429s
+            deadline (float): Clock time after which no call waits, None to always wait
+            clock (callable): Monotonic time in seconds
+            sleep (callable): Blocks for a number of seconds
+        """
+        self.get_client = get_client
+        self.rates = rates
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.clock = clock
+        self.sleep = sleep
+        self.clients = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def get_bucket(self, team_id, method):
+        key = (team_id, method)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rates[method], self.clock)
+        return bucket
+
+    def acquire(self, team_id, method):
+        """
+        Take one call from the workspace's bucket for the method, waiting for it
+        to refill
+
+        Args:
+            team_id (str): Workspace whose rate limit the call counts against
+            method (str): Web API method, e.g. "chat.postMessage"
+        Returns:
+            bool: False if the wait would run past the deadline
+        """
+        while True:
+            with self.lock:
+                bucket = self.get_bucket(team_id, method)
+                wait = bucket.wait_time(1)
+                if not wait:
+                    bucket.take(1)
+                    return True
+            if self.deadline is not None and self.clock() + wait > self.deadline:
+                return False
+            with self.lock:
+                self.stats["waited"] += 1
+            self.sleep(wait)
+
+    def call(self, team_id, method, acquired=False, **kwargs):
+        """
+        Args:
+            team_id (str): Workspace whose rate limit the call counts against
+            method (str): Web API method, e.g. "chat.postMessage"
+            acquired (bool): The first call was already taken with acquire
+            **kwargs: Arguments of the method
+        Returns:
+            str: "sent", "deferred" when out of time before trying, "rate_limited",
+                "failed" or "no_client"
+        """
+        from slack_sdk.errors import SlackApiError
+        if team_id not in self.clients:
+            # Clients are looked up once per workspace, races only look up twice
+            self.clients[team_id] = self.get_client(team_id)
+        client = self.clients[team_id]
+        if client is None:
+            outcome = "no_client"
+        elif not acquired and not self.acquire(team_id, method):
+            outcome = "deferred"
+        else:
+            outcome = "rate_limited"
+            for attempt in range(1, self.max_attempts + 1):
+                if attempt > 1 and not self.acquire(team_id, method):
+                    break
+                try:
+                    client.api_call(method, json=kwargs)
+                    outcome = "sent"
+                    break
+                except SlackApiError as e:
+                    if e.response.status_code != 429:
+                        log_event("notify", "call failed", team_id=team_id, method=method, error=e.response.get("error"))
+                        outcome = "failed"
+                        break
+                    # Every later call for this workspace and method waits out Retry-After
+                    retry_after = float((e.response.headers or {}).get("Retry-After") or 1)
+                    with self.lock:
+                        self.get_bucket(team_id, method).pause(retry_after)
+                        self.stats["retried"] += 1
+                    log_event("notify", "call rate limited", team_id=team_id, method=method, attempt=attempt, retry_after=retry_after)
+        # Sweep segments share the notifier across threads
+        with self.lock:
+            self.stats[outcome] += 1
+        return outcome
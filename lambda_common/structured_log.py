@@ -0,0 +1,120 @@
+import os
+import json
+import random
+import reprlib
+import logging
+
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "512"))
+LOG_SAMPLE_RATES = os.environ.get("LOG_SAMPLE_RATES", "")
+
+logger = logging.getLogger("bounce")
+
+
+def parse_sample_rates(sample_rates):
+    """
+    Parse per-category sample rates
+
+    Args:
+        sample_rates (str): Comma separated category=rate pairs, e.g. "ddb=0.1,openai=1"
+    Returns:
+        dict: Sample rate per category
+    """
+    rates = {}
+    for pair in sample_rates.split(","):
+        if "=" in pair:
+            category, rate = pair.split("=", 1)
+            rates[category.strip()] = float(rate)
+    return rates
+
+
+sample_rates = parse_sample_rates(LOG_SAMPLE_RATES)
+
+
+def configure_logging(level=LOG_LEVEL):
+    """
+    Configure the root logger for a Lambda handler, replacing the handler
+    the Lambda runtime installs
+
+    Args:
+        level (str): Log level name
+    """
+    logging.basicConfig(format="%(asctime)s %(message)s", level=level, force=True)
+
+
+def truncate(value, max_chars=LOG_MAX_FIELD_CHARS):
+    """
+    Render a field value and cap its size
+
+    Args:
+        value: Field value
+        max_chars (int): Maximum number of characters to keep
+    Returns:
+        JSON serializable field value
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        text = value
+    else:
+        # Containers go through a size-limited repr, so a large event or
+        # chat is cut down while it is formatted instead of afterwards
+        limited_repr = reprlib.Repr()
+        limited_repr.maxstring = limited_repr.maxother = max_chars
+        text = limited_repr.repr(value)
+    if len(text) > max_chars:
+        return f"{text[:max_chars]}...[{len(text) - max_chars} more chars]"
+    return text
+
+
+class LazyRecord:
+    """
+    Log record body that is only serialized if a handler emits it
+    """
+
+    def __init__(self, category, message, fields):
+        self.category = category
+        self.message = message
+        self.fields = fields
+        self.rendered = None
+
+    def __str__(self):
+        if self.rendered is None:
+            record = {"category": self.category, "message": self.message}
+            for key, value in self.fields.items():
+                record[key] = truncate(value() if callable(value) else value)
+            self.rendered = json.dumps(record, default=str)
+        return self.rendered
+
+
+def is_sampled(category, level):
+    """
+    Check whether a record in this category should be emitted; warnings and
+    errors are never sampled out
+
+    Args:
+        category (str): Log category
+        level (int): Log level
+    Returns:
+        bool: Whether to emit the record
+    """
+    if level >= logging.WARNING:
+        return True
+    rate = sample_rates.get(category, 1.0)
+    return rate >= 1.0 or random.random() < rate
+
+
+def log_event(category, message, level=logging.INFO, **fields):
+    """
+    Log a structured record with lazily formatted, size-capped fields
+
+    Args:
+        category (str): Log category used for sampling, e.g. "ddb" or "openai"
+        message (str): Short description of the event
+        level (int): Log level
+        **fields: Record fields; callables are only evaluated if the record is emitted
+    """
+    if not logger.isEnabledFor(level) or not is_sampled(category, level):
+        return
+    logger.log(level, "%s", LazyRecord(category, message, fields))
@@ -0,0 +1,37 @@
+import time
+import threading
+
+
+class TokenBucket:
+    # Each call is atomic; callers that check wait_time and then take hold
+    # their own lock around both so that two threads cannot over-admit.
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.clock = clock
+        self.level = per_minute
+        self.updated = clock()
+        self.lock = threading.RLock()
+
+    def refill(self):
+        with self.lock:
+            now = self.clock()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, amount):
+        # Anything larger than a full bucket waits for a full bucket
+        with self.lock:
+            self.refill()
+            amount = min(amount, self.capacity)
+            return 0 if amount <= self.level else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        with self.lock:
+            self.level -= min(amount, self.capacity)
+
+    def pause(self, seconds):
+        # Empties the bucket so that the next single take waits about seconds
+        with self.lock:
+            self.refill()
+            self.level = min(self.level, 1 - seconds * self.rate)
@@ -0,0 +1,55 @@
+import os
+from datetime import datetime, timedelta
+
+
+FREE_TRIAL_DAYS = int(os.environ.get("FREE_TRIAL_DAYS", "7"))
+TRIAL_EXPIRY_INDEX = "trial_expiry_index"
+TRIAL_EXPIRY_BUCKET_FORMAT = "%Y-%m-%d"
+
+
+def get_trial_expires_at(install_timestamp, trial_days=FREE_TRIAL_DAYS):
+    """
+    Args:
+        install_timestamp (int): Epoch time the app was installed
+        trial_days (int): Length of the free trial
+    Returns:
+        int: Epoch time the trial expires
+    """
+    return int(install_timestamp) + trial_days * 86400
+
+
+def get_trial_expiry_bucket(install_timestamp, trial_days=FREE_TRIAL_DAYS):
+    """
+    Day on which a trial expires, the partition key of the sparse trial expiry
+    index that holds only live trials
+
+    Args:
+        install_timestamp (int): Epoch time the app was installed
+        trial_days (int): Length of the free trial
+    Returns:
+        str: UTC day, e.g. "2024-03-01"
+    """
+    expires_at = datetime.utcfromtimestamp(get_trial_expires_at(install_timestamp, trial_days))
+    return expires_at.strftime(TRIAL_EXPIRY_BUCKET_FORMAT)
+
+
+def get_due_trial_expiry_buckets(now, lookback_days):
+    """
+    Args:
+        now (datetime): Current UTC time
+        lookback_days (int): Earlier days to include, catching up on missed sweeps
+    Returns:
+        list: Buckets from the oldest up to and including today
+    """
+    return [(now - timedelta(days=days)).strftime(TRIAL_EXPIRY_BUCKET_FORMAT) for days in range(lookback_days, -1, -1)]
+
+
+def get_upcoming_trial_expiry_buckets(now, days_ahead):
+    """
+    Args:
+        now (datetime): Current UTC time
+        days_ahead (int): Later days to include
+    Returns:
+        list: Buckets from tomorrow up to and including days_ahead from today
+    """
+    return [(now + timedelta(days=days)).strftime(TRIAL_EXPIRY_BUCKET_FORMAT) for days in range(1, days_ahead + 1)]
@@ -1,17 +1,41 @@
 import os
-import boto3
+import json
+import time
 import logging
+from collections import Counter
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Attr, Key
 from datetime import datetime, timedelta
+from structured_log import configure_logging, log_event
+from clients import get_boto3_client, get_boto3_resource, get_client, get_slack_client
+from expiry_scheduler import DynamoExpiryScheduler
+from home_view import get_home_view, get_home_view_hash, get_inactive_message, get_trial_ending_message
+from slack_notifier import SlackNotifier
+from trials import TRIAL_EXPIRY_INDEX, get_due_trial_expiry_buckets, get_trial_expiry_bucket, get_upcoming_trial_expiry_buckets
 
 
-logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+configure_logging()
 
 
 FREE_TRIAL_DAYS = int(os.environ['FREE_TRIAL_DAYS'])
-ddb = boto3.resource('dynamodb')
+SWEEP_SEGMENTS = int(os.environ.get('SWEEP_SEGMENTS', '1'))
+SWEEP_CONCURRENCY = int(os.environ.get('SWEEP_CONCURRENCY', '8'))
+SWEEP_LOOKBACK_DAYS = int(os.environ.get('SWEEP_LOOKBACK_DAYS', '30'))
+SWEEP_PAGE_SIZE = int(os.environ.get('SWEEP_PAGE_SIZE', '0'))
+SWEEP_TIME_MARGIN = float(os.environ.get('SWEEP_TIME_MARGIN', '30'))
+SWEEP_CHECKPOINT_TTL = int(os.environ.get('SWEEP_CHECKPOINT_TTL', '604800'))
+TRIAL_BACKFILL_RUN_ID = 'backfill#trial_expires_at'
+TRIAL_BACKFILL_MARKER_ID = 'trial_backfill#finished'
+NOTIFY_TRIALS = os.environ.get('NOTIFY_TRIALS', 'false').lower() == 'true'
+NOTIFY_DAYS_BEFORE = int(os.environ.get('NOTIFY_DAYS_BEFORE', '1'))
+SLACK_BOT_TOKEN = os.environ.get('SLACK_BOT_TOKEN')
+SLACK_CLIENT_ID = os.environ.get('SLACK_CLIENT_ID')
+SLACK_INSTALLATION_S3_BUCKET_NAME = os.environ.get('SLACK_INSTALLATION_S3_BUCKET_NAME')
+ddb = get_boto3_resource('dynamodb')
 users_id_table = ddb.Table(os.environ['DDB_USERS_ID'])
-current_datetime = datetime.utcnow()
+checkpoints_table = ddb.Table(os.environ['DDB_CRON_CHECKPOINTS']) if os.environ.get('DDB_CRON_CHECKPOINTS') else None
+trial_expiry_scheduler = DynamoExpiryScheduler(ddb.Table(os.environ['DDB_TRIAL_TIMERS'])) if os.environ.get('DDB_TRIAL_TIMERS') else None
 
 
 def free_trial_completed(item, current_datetime):
@@ -19,7 +43,7 @@ def free_trial_completed(item, current_datetime):
     if not slack_install_timestamp:
         logging.warning("Item missing slack_install_timestamp")
         return False
-    
+
     slack_install_datetime = datetime.fromtimestamp(int(slack_install_timestamp))
     trial_period = current_datetime - timedelta(days=FREE_TRIAL_DAYS)
     if slack_install_datetime < trial_period:
@@ -29,17 +53,325 @@ def free_trial_completed(item, current_datetime):
     return False
 
 
-def handler(event, context):
-    response = users_id_table.query(
+def get_page_kwargs(start_key):
+    kwargs = {'ProjectionExpression': 'slack_id, slack_install_timestamp, trial_expires_at'}
+    if SWEEP_PAGE_SIZE:
+        kwargs['Limit'] = SWEEP_PAGE_SIZE
+    if start_key:
+        kwargs['ExclusiveStartKey'] = start_key
+    return kwargs
+
+
+def query_expiry_bucket(bucket, start_key=None):
+    # The index is sparse: deactivation and payment remove trial_expires_at,
+    # so a bucket only holds trials that are still live
+    return users_id_table.query(
+        IndexName=TRIAL_EXPIRY_INDEX,
+        KeyConditionExpression=Key('trial_expires_at').eq(bucket),
+        **get_page_kwargs(start_key)
+    )
+
+
+def scan_trials(segment, total_segments, start_key=None):
+    return users_id_table.scan(
         IndexName='plan_type_index',
-        KeyConditionExpression=Key('plan_type').eq('trial'),
-        FilterExpression=Attr('active').eq(True),
-        ProjectionExpression='slack_id, active, email, plan_type, slack_install_timestamp'
+        Segment=segment,
+        TotalSegments=total_segments,
+        FilterExpression=Attr('plan_type').eq('trial') & Attr('active').eq(True),
+        **get_page_kwargs(start_key)
     )
-    
-    items = response['Items']
-    for item in items:
-        logging.info(f"Processing item: {item}")
-        if free_trial_completed(item, current_datetime):
-            item['active'] = False
-            users_id_table.put_item(Item=item)
+
+
+def deactivate_user(item):
+    # Only active is flipped, and only while the user is still an active
+    # trial, so a payment that lands during the sweep is never overwritten.
+    try:
+        users_id_table.update_item(
+            Key={'slack_id': item['slack_id']},
+            UpdateExpression='SET active = :inactive REMOVE trial_expires_at',
+            ConditionExpression='active = :active AND plan_type = :trial',
+            ExpressionAttributeValues={':inactive': False, ':active': True, ':trial': 'trial'},
+        )
+    except users_id_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return 'skipped'
+    return 'deactivated'
+
+
+def get_installation_store():
+    def factory():
+        from slack_sdk.oauth.installation_store.amazon_s3 import AmazonS3InstallationStore
+        return AmazonS3InstallationStore(
+            s3_client=get_boto3_client('s3'),
+            bucket_name=SLACK_INSTALLATION_S3_BUCKET_NAME,
+            client_id=SLACK_CLIENT_ID,
+        )
+    return get_client('slack.installation_store', factory)
+
+
+def get_team_client(team_id):
+    token = SLACK_BOT_TOKEN
+    if SLACK_INSTALLATION_S3_BUCKET_NAME:
+        bot = get_installation_store().find_bot(enterprise_id=None, team_id=team_id)
+        if bot:
+            token = bot.bot_token
+    return get_slack_client(token) if token else None
+
+
+def get_notifier(deadline=None):
+    return SlackNotifier(get_team_client, deadline=deadline) if NOTIFY_TRIALS else None
+
+
+def split_slack_id(slack_id):
+    parts = slack_id.split('-')
+    return parts[0], parts[-1]
+
+
+def publish_home_view(team_id, user_id, notifier):
+    # Stores the hash the slack lambda compares against on app_home_opened
+    view = get_home_view('trial', False)
+    if notifier.call(team_id, 'views.publish', user_id=user_id, view=view) == 'sent':
+        users_id_table.update_item(
+            Key={'slack_id': f'{team_id}-{user_id}'},
+            UpdateExpression='SET home_view_hash = :home_view_hash, home_view_published_at = :now',
+            ExpressionAttributeValues={':home_view_hash': get_home_view_hash('trial', False), ':now': round(time.time())},
+        )
+
+
+def deactivate_and_notify(item, notifier=None):
+    if not notifier:
+        return deactivate_user(item)
+    team_id, user_id = split_slack_id(item['slack_id'])
+    # The first attempt at the message is paid for before deactivating, so
+    # running out of time defers the user instead of deactivating them. A 429
+    # on that attempt, or a failed call, can still leave the user deactivated
+    # without the message; they get it on their next message to the app.
+    if not notifier.acquire(team_id, 'chat.postMessage'):
+        return 'deferred'
+    outcome = deactivate_user(item)
+    if outcome == 'deactivated':
+        notice = notifier.call(team_id, 'chat.postMessage', acquired=True, channel=user_id, text=get_inactive_message())
+        if notice != 'sent':
+            log_event("cron", "deactivated without notice", level=logging.WARNING, slack_id=item['slack_id'], outcome=notice)
+        publish_home_view(team_id, user_id, notifier)
+    return outcome
+
+
+def expire_user(item, now, notifier=None):
+    if not free_trial_completed(item, now):
+        return 'ongoing'
+    return deactivate_and_notify(item, notifier)
+
+
+def remind_user(item, notifier):
+    # The trial_notice marker is claimed before sending, so each user is
+    # reminded once however often their bucket is read
+    key = {'slack_id': item['slack_id']}
+    try:
+        users_id_table.update_item(
+            Key=key,
+            UpdateExpression='SET trial_notice = :notice',
+            ConditionExpression='attribute_not_exists(trial_notice) AND active = :active AND plan_type = :trial',
+            ExpressionAttributeValues={':notice': item.get('trial_expires_at') or 'sent', ':active': True, ':trial': 'trial'},
+        )
+    except users_id_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return 'skipped'
+    team_id, user_id = split_slack_id(item['slack_id'])
+    outcome = notifier.call(team_id, 'chat.postMessage', channel=user_id, text=get_trial_ending_message())
+    if outcome != 'sent':
+        # Released so a later read of the bucket tries the reminder again
+        users_id_table.update_item(Key=key, UpdateExpression='REMOVE trial_notice')
+        return outcome
+    return 'reminded'
+
+
+def backfill_user(item, now):
+    # Trials created before the expiry index existed are added to it, or
+    # deactivated if they have already expired
+    if item.get('trial_expires_at'):
+        return 'indexed'
+    if free_trial_completed(item, now):
+        return deactivate_user(item)
+    if not item.get('slack_install_timestamp'):
+        return 'skipped'
+    try:
+        users_id_table.update_item(
+            Key={'slack_id': item['slack_id']},
+            UpdateExpression='SET trial_expires_at = :bucket',
+            ConditionExpression='active = :active AND plan_type = :trial',
+            ExpressionAttributeValues={
+                ':bucket': get_trial_expiry_bucket(item['slack_install_timestamp'], FREE_TRIAL_DAYS),
+                ':active': True,
+                ':trial': 'trial',
+            },
+        )
+    except users_id_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return 'skipped'
+    return 'backfilled'
+
+
+def get_checkpoint_id(run_id, segment_id):
+    return f'trial_expiry#{run_id}#{segment_id}'
+
+
+def get_checkpoint(run_id, segment_id):
+    if not checkpoints_table:
+        return None
+    return checkpoints_table.get_item(Key={'checkpoint_id': get_checkpoint_id(run_id, segment_id)}).get('Item')
+
+
+def save_checkpoint(run_id, segment_id, start_key):
+    if not checkpoints_table:
+        return
+    item = {
+        'checkpoint_id': get_checkpoint_id(run_id, segment_id),
+        'done': not start_key,
+        'expires_at': round(time.time()) + SWEEP_CHECKPOINT_TTL,
+    }
+    if start_key:
+        item['start_key'] = start_key
+    checkpoints_table.put_item(Item=item)
+
+
+def trials_backfilled():
+    return bool(checkpoints_table.get_item(Key={'checkpoint_id': TRIAL_BACKFILL_MARKER_ID}).get('Item'))
+
+
+def mark_trials_backfilled():
+    # No expires_at, unlike the sweep checkpoints, so the backfill is never
+    # repeated once it has covered every trial
+    if checkpoints_table:
+        checkpoints_table.put_item(Item={'checkpoint_id': TRIAL_BACKFILL_MARKER_ID, 'done': True})
+
+
+def sweep_segment(run_id, segment_id, get_page, process_item, executor, out_of_time):
+    stats = Counter()
+    checkpoint = get_checkpoint(run_id, segment_id)
+    if checkpoint and checkpoint.get('done'):
+        return stats, True
+    start_key = checkpoint.get('start_key') if checkpoint else None
+    if start_key:
+        stats['resumed'] += 1
+
+    while not out_of_time():
+        page = get_page(start_key=start_key)
+        items = page['Items']
+        stats['pages'] += 1
+        stats['read'] += len(items)
+        page_stats = Counter(executor.map(process_item, items))
+        stats.update(page_stats)
+        if page_stats['deferred']:
+            # Without moving the checkpoint, so the resumed run reads the page
+            # again; the items already handled have left the index or are skipped
+            return stats, False
+
+        # The checkpoint only moves past a page once all of its updates are done
+        start_key = page.get('LastEvaluatedKey')
+        save_checkpoint(run_id, segment_id, start_key)
+        if not start_key:
+            return stats, True
+    return stats, False
+
+
+def sweep(run_id, segments, process_item, parallelism=SWEEP_SEGMENTS, concurrency=SWEEP_CONCURRENCY, out_of_time=lambda: False):
+    """
+    Read every page of every segment and process its items
+
+    Args:
+        run_id (str): Identifies the sweep so that a resumed run skips finished pages
+        segments (dict): Page reader taking start_key, by segment id
+        process_item (callable): Handles one item and returns its outcome
+        parallelism (int): Segments read in parallel
+        concurrency (int): Maximum process_item calls in flight across all segments
+        out_of_time (callable): Returns True once the sweep should stop and checkpoint
+    Returns:
+        tuple: Counter of pages, items read and outcomes, and whether every segment finished
+    """
+    stats = Counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, ThreadPoolExecutor(max_workers=parallelism) as readers:
+        futures = [
+            readers.submit(sweep_segment, run_id, segment_id, get_page, process_item, executor, out_of_time)
+            for segment_id, get_page in segments.items()
+        ]
+        finished = True
+        for future in futures:
+            segment_stats, segment_finished = future.result()
+            stats.update(segment_stats)
+            finished = finished and segment_finished
+    return stats, finished
+
+
+def sweep_trials(run_id, now, lookback_days=SWEEP_LOOKBACK_DAYS, notifier=None, **kwargs):
+    # Reads only the buckets that are due, so the cost follows the number of
+    # expiring trials rather than all trials
+    segments = {
+        bucket: partial(query_expiry_bucket, bucket)
+        for bucket in get_due_trial_expiry_buckets(now, lookback_days)
+    }
+    return sweep(run_id, segments, partial(expire_user, now=now, notifier=notifier), **kwargs)
+
+
+def remind_trials(run_id, now, notifier, days_before=NOTIFY_DAYS_BEFORE, **kwargs):
+    segments = {
+        f'notice-{bucket}': partial(query_expiry_bucket, bucket)
+        for bucket in get_upcoming_trial_expiry_buckets(now, days_before)
+    }
+    return sweep(run_id, segments, partial(remind_user, notifier=notifier), **kwargs)
+
+
+def backfill_trials(run_id, now, total_segments=SWEEP_SEGMENTS, **kwargs):
+    segments = {
+        f'backfill-{segment}/{total_segments}': partial(scan_trials, segment, total_segments)
+        for segment in range(total_segments)
+    }
+    return sweep(run_id, segments, partial(backfill_user, now=now), **kwargs)
+
+
+def resume_sweep(run_id, backfill, context):
+    # Checkpoints let the next invocation pick up where this one stopped
+    get_boto3_client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'run_id': run_id, 'backfill': backfill}),
+    )
+
+
+def handler(event, context):
+    event = event or {}
+    now = datetime.utcnow()
+    run_id = event.get('run_id') or now.strftime('%Y-%m-%d')
+    backfill = bool(event.get('backfill'))
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - SWEEP_TIME_MARGIN if context else None
+    out_of_time = lambda: deadline is not None and time.monotonic() >= deadline
+
+    stats, finished = Counter(), True
+    if backfill or (checkpoints_table and not trials_backfilled()):
+        # Trials created before trial_expires_at existed are not in the expiry
+        # index, so the nightly run backfills them first until one backfill
+        # has finished, resuming across nights if need be
+        stats, finished = backfill_trials(f'backfill#{run_id}' if backfill else TRIAL_BACKFILL_RUN_ID, now, out_of_time=out_of_time)
+        if finished:
+            mark_trials_backfilled()
+    if not backfill and finished:
+        notifier = get_notifier(deadline)
+        sweep_stats, finished = sweep_trials(run_id, now, notifier=notifier, out_of_time=out_of_time)
+        stats.update(sweep_stats)
+        if notifier:
+            remind_stats, reminders_finished = remind_trials(run_id, now, notifier, out_of_time=out_of_time)
+            stats.update(remind_stats)
+            stats.update({f'notify_{outcome}': count for outcome, count in notifier.stats.items()})
+            finished = finished and reminders_finished
+    log_event("cron", "sweep", run_id=run_id, backfill=backfill, finished=finished, **stats)
+    if not finished and checkpoints_table and context:
+        resume_sweep(run_id, backfill, context)
+    return {'run_id': run_id, 'finished': finished, **stats}
+
+
+def expiry_stream_handler(event, context):
+    # Deactivates each trial as DynamoDB expires its timer, which can be
+    # days after the deadline; the nightly sweep catches trials before that
+    slack_ids = trial_expiry_scheduler.get_expired_keys(event)
+    notifier = get_notifier()
+    stats = Counter(deactivate_and_notify({'slack_id': slack_id}, notifier) for slack_id in slack_ids)
+    notify_stats = {f'notify_{outcome}': count for outcome, count in notifier.stats.items()} if notifier else {}
+    log_event("cron", "expiry_stream_handler", records=len(event.get('Records', [])), **stats, **notify_stats)
+    return dict(stats)
@@ -1,41 +1,380 @@
 import os
+import re
 import json
+import hmac
+import base64
+import hashlib
 import logging
+import time
+import zlib
+import asyncio
 import datetime
-import boto3
-from openai import OpenAI
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
-from slack_bolt import App
-from slack_bolt.adapter.aws_lambda import SlackRequestHandler
-from slack_bolt.adapter.aws_lambda.lambda_s3_oauth_flow import LambdaS3OAuthFlow
+import contextvars
+import threading
+import itertools
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from structured_log import configure_logging, log_event
+from openai_client import ResilientOpenAI
+from clients import get_boto3_client, get_boto3_resource, get_client, get_http_client, get_pool_stats, get_slack_client
+from trials import get_trial_expires_at, get_trial_expiry_bucket
+from token_bucket import TokenBucket
+from home_view import get_home_view, get_home_view_hash, get_inactive_message
+from expiry_scheduler import DynamoExpiryScheduler
 
 
-SlackRequestHandler.clear_all_log_handlers()
-logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+# boto3, openai, slack_sdk and slack_bolt are imported on first use so that URL
+# verification challenges and ignored events never pay for loading them.
+configure_logging()
 
 
-app = App(
-    process_before_response=True,
-    oauth_flow=LambdaS3OAuthFlow()
-)
+app = None
+async_app = None
 
-ddb = boto3.resource('dynamodb')
-users_id_table = ddb.Table(os.environ['DDB_USERS_ID'])
-users_email_table = ddb.Table(os.environ['DDB_USERS_EMAIL'])
-public_chats_table = ddb.Table(os.environ['DDB_PUBLIC_CHATS'])
-private_chats_table = ddb.Table(os.environ['DDB_PRIVATE_CHATS'])
+
+def get_dynamodb():
+    return get_boto3_resource('dynamodb')
+
+
+class LazyTable:
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.table = None
+
+    def __getattr__(self, name):
+        if self.table is None:
+            self.table = get_dynamodb().Table(self.table_name)
+        return getattr(self.table, name)
+
+
+users_id_table = LazyTable(os.environ['DDB_USERS_ID'])
+users_email_table = LazyTable(os.environ['DDB_USERS_EMAIL'])
+public_chats_table = LazyTable(os.environ['DDB_PUBLIC_CHATS'])
+private_chats_table = LazyTable(os.environ['DDB_PRIVATE_CHATS'])
+chat_turns_table = LazyTable(os.environ['DDB_CHAT_TURNS']) if os.environ.get('DDB_CHAT_TURNS') else None
+response_cache_table = LazyTable(os.environ['DDB_RESPONSE_CACHE']) if os.environ.get('DDB_RESPONSE_CACHE') else None
+events_table = LazyTable(os.environ['DDB_EVENTS']) if os.environ.get('DDB_EVENTS') else None
+rate_limits_table = LazyTable(os.environ['DDB_RATE_LIMITS']) if os.environ.get('DDB_RATE_LIMITS') else None
+trial_expiry_scheduler = DynamoExpiryScheduler(LazyTable(os.environ['DDB_TRIAL_TIMERS'])) if os.environ.get('DDB_TRIAL_TIMERS') else None
 
 OPENAI_MODEL = os.environ['OPENAI_MODEL']
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
+OPENAI_FALLBACK_MODEL = os.environ.get("OPENAI_FALLBACK_MODEL") or None
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL") or None
+OPENAI_MAX_ATTEMPTS = int(os.environ.get("OPENAI_MAX_ATTEMPTS", "3"))
+OPENAI_REQUEST_TIMEOUT = float(os.environ.get("OPENAI_REQUEST_TIMEOUT", "60"))
+OPENAI_HEDGE = os.environ.get("OPENAI_HEDGE", "false").lower() == "true"
+# Time kept back from the Lambda deadline to post the reply and save the chat
+OPENAI_DEADLINE_MARGIN = float(os.environ.get("OPENAI_DEADLINE_MARGIN", "10"))
 MAX_CHAT_LENGTH = int(os.environ['MAX_CHAT_LENGTH'])
-SLACK_EVENTS = os.environ['SLACK_EVENTS'].split(',')
+CHAT_STORAGE = os.environ.get("CHAT_STORAGE", "item")
+CHAT_CODEC = os.environ.get("CHAT_CODEC", "")
+CHAT_CODEC_VERSION = 1
+CHAT_CODEC_ROLES = ["system", "user", "assistant"]
+# Sort key of the row holding last_seq and the summary in turns storage; it
+# sorts after every turn, so the newest-first tail query returns it first
+CHAT_METADATA_SEQ = 10 ** 18
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "3000"))
+LATEST_TURN_MIN_TOKENS = int(os.environ.get("LATEST_TURN_MIN_TOKENS", "256"))
+MESSAGE_TOKEN_OVERHEAD = 4
+SUMMARY_TOKEN_THRESHOLD = int(os.environ.get("SUMMARY_TOKEN_THRESHOLD", "0"))
+SUMMARY_KEEP_TURNS = int(os.environ.get("SUMMARY_KEEP_TURNS", "4"))
+CHAT_SAVE_ATTEMPTS = int(os.environ.get("CHAT_SAVE_ATTEMPTS", "3"))
+CHAT_LOCKS_SIZE = int(os.environ.get("CHAT_LOCKS_SIZE", "256"))
+SLACK_MENTION_PATTERN = re.compile(r"<@[UW][A-Z0-9]+(?:\|[^>]*)?>")
+SLACK_EVENTS = frozenset(os.environ['SLACK_EVENTS'].split(','))
 SLACK_BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
-SLACK_APP_URL = os.environ.get("SLACK_APP_URL")
+SLACK_SIGNING_SECRET = os.environ.get("SLACK_SIGNING_SECRET")
+SLACK_ASYNC = os.environ.get("SLACK_ASYNC", "false").lower() == "true"
+
+EVENT_QUEUE_URL = os.environ.get("EVENT_QUEUE_URL")
+EVENT_QUEUE_PATH = os.environ.get("EVENT_QUEUE_PATH")
+WORKER_BATCH_SIZE = int(os.environ.get("WORKER_BATCH_SIZE", "10"))
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "10"))
+# A failed event is visible again after this many seconds instead of the
+# queue's visibility timeout, which has to outlast the worker's timeout
+EVENT_RETRY_DELAY = int(os.environ.get("EVENT_RETRY_DELAY", "10"))
+QUEUED_EVENTS = frozenset(["app_mention", "message"])
+
+# The lease outlives the 300 s function timeout, so it only runs out when the
+# attempt holding it died; Slack's last retry arrives about six minutes in.
+EVENT_LEASE_SECONDS = int(os.environ.get("EVENT_LEASE_SECONDS", "330"))
+EVENT_STATE_TTL = int(os.environ.get("EVENT_STATE_TTL", "86400"))
+EVENT_CACHE_SIZE = int(os.environ.get("EVENT_CACHE_SIZE", "1024"))
+EVENT_CLAIMED = "claimed"
+EVENT_IN_FLIGHT = "in_flight"
+EVENT_COMPLETED = "completed"
+
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "0"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_MAX_MESSAGES = int(os.environ.get("RESPONSE_CACHE_MAX_MESSAGES", "2"))
+
+# Nothing invalidates a cached record across containers, so a deactivation
+# or payment reaches a warm container up to USER_CACHE_MAX_TTL seconds late
+USER_CACHE_MAX_TTL = 60
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "60"))
+USER_CACHE_NEGATIVE_TTL = int(os.environ.get("USER_CACHE_NEGATIVE_TTL", "30"))
+if max(USER_CACHE_TTL, USER_CACHE_NEGATIVE_TTL) > USER_CACHE_MAX_TTL:
+    logging.warning(f"USER_CACHE_TTL {USER_CACHE_TTL}s and USER_CACHE_NEGATIVE_TTL {USER_CACHE_NEGATIVE_TTL}s are capped at {USER_CACHE_MAX_TTL}s")
+    USER_CACHE_TTL = min(USER_CACHE_TTL, USER_CACHE_MAX_TTL)
+    USER_CACHE_NEGATIVE_TTL = min(USER_CACHE_NEGATIVE_TTL, USER_CACHE_MAX_TTL)
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "1024"))
+
+# Nothing tells the app when Slack drops a published Home tab, e.g. after a
+# reinstall, so an unchanged view is still republished once it is this old
+HOME_VIEW_MAX_AGE = int(os.environ.get("HOME_VIEW_MAX_AGE", "86400"))
+
+TEAM_REQUESTS_PER_MINUTE = int(os.environ.get("TEAM_REQUESTS_PER_MINUTE", "0"))
+TEAM_TOKENS_PER_MINUTE = int(os.environ.get("TEAM_TOKENS_PER_MINUTE", "0"))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "2.0"))
+
+# JSON list of routing rules, e.g. [{"model": "gpt-4.1-nano", "max_prompt_tokens": 300,
+# "request_classes": ["im"], "plans": ["trial"]}]; the first matching rule wins
+# and requests matching no rule go to OPENAI_MODEL.
+MODEL_ROUTES = os.environ.get("MODEL_ROUTES", "")
+
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "false").lower() == "true"
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", "1.0"))
+STREAM_PLACEHOLDER = os.environ.get("STREAM_PLACEHOLDER", ":thinking_face:")
+
+
+class SqsEventQueue:
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.client = None
+
+    @property
+    def sqs(self):
+        if self.client is None:
+            self.client = get_boto3_client('sqs')
+        return self.client
+
+    def send(self, body):
+        response = self.sqs.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(body)
+        )
+        logging.info(f"SqsEventQueue send: {response.get('MessageId')}")
+        return response
+
+    # Queues hand out (handle, body) pairs; a message is deleted only once it
+    # has been processed, and a released one is delivered again later.
+    def receive(self, max_messages):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, 10)
+        )
+        return [(message["ReceiptHandle"], json.loads(message["Body"])) for message in response.get("Messages", [])]
+
+    def delete(self, handle):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=handle)
+
+    def release(self, handle):
+        # Still counts as a receive, so repeated failures end up in the DLQ
+        self.sqs.change_message_visibility(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=handle,
+            VisibilityTimeout=EVENT_RETRY_DELAY
+        )
+
+
+class FileEventQueue:
+    def __init__(self, path):
+        self.path = path
+        self.in_flight = Counter()
+        self.lock = threading.Lock()
+
+    def read_lines(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [line for line in f if line.strip()]
+
+    def send(self, body):
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(body) + "\n")
+
+    def receive(self, max_messages):
+        # Lines stay in the file until deleted, so a crash leaves them queued
+        with self.lock:
+            skipped = Counter(self.in_flight)
+            messages = []
+            for line in self.read_lines():
+                if skipped[line]:
+                    skipped[line] -= 1
+                elif len(messages) < max_messages:
+                    self.in_flight[line] += 1
+                    messages.append((line, json.loads(line)))
+            return messages
+
+    def delete(self, handle):
+        with self.lock:
+            lines = self.read_lines()
+            lines.remove(handle)
+            with open(self.path, "w") as f:
+                f.writelines(lines)
+            self.in_flight[handle] -= 1
+
+    def release(self, handle):
+        with self.lock:
+            self.in_flight[handle] -= 1
+
+
+class MemoryEventQueue:
+    def __init__(self):
+        self.messages = []
+        self.in_flight = {}
+        self.handles = itertools.count()
+        self.lock = threading.Lock()
+
+    def send(self, body):
+        with self.lock:
+            self.messages.append(body)
+
+    def receive(self, max_messages):
+        with self.lock:
+            messages = [(next(self.handles), body) for body in self.messages[:max_messages]]
+            del self.messages[:max_messages]
+            self.in_flight.update(messages)
+            return messages
+
+    def delete(self, handle):
+        with self.lock:
+            del self.in_flight[handle]
+
+    def release(self, handle):
+        with self.lock:
+            self.messages.append(self.in_flight.pop(handle))
+
+
+def get_event_queue():
+    if EVENT_QUEUE_URL:
+        return SqsEventQueue(EVENT_QUEUE_URL)
+    if EVENT_QUEUE_PATH:
+        return FileEventQueue(EVENT_QUEUE_PATH)
+    return None
+
+
+event_queue = get_event_queue()
+rejection_counters = Counter()
+
+
+class LocalRateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute, clock=time.monotonic):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.clock = clock
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, team_id, tokens):
+        # Checked and charged under one lock, since worker batches run on threads
+        with self.lock:
+            buckets = self.buckets.get(team_id)
+            if buckets is None:
+                buckets = self.buckets[team_id] = (TokenBucket(self.requests_per_minute, self.clock), TokenBucket(self.tokens_per_minute, self.clock))
+            charges = [(bucket, amount) for bucket, amount in zip(buckets, (1, tokens)) if bucket.capacity]
+            wait = max([bucket.wait_time(amount) for bucket, amount in charges] + [0])
+            if wait:
+                return wait
+            for bucket, amount in charges:
+                bucket.take(amount)
+            return 0
+
+
+class DynamoRateLimiter:
+    # Fixed one-minute windows shared by every container, counted with atomic
+    # conditional ADDs; a refused request waits for the next window.
+    def __init__(self, table, requests_per_minute, tokens_per_minute, clock=time.time):
+        self.table = table
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.clock = clock
+
+    def acquire(self, team_id, tokens):
+        now = self.clock()
+        window = int(now // 60)
+        conditions = []
+        expression_values = {":one": 1, ":tokens": tokens, ":expires_at": (window + 2) * 60}
+        if self.requests_per_minute:
+            conditions.append("(attribute_not_exists(#requests) OR #requests < :max_requests)")
+            expression_values[":max_requests"] = self.requests_per_minute
+        if self.tokens_per_minute:
+            conditions.append("(attribute_not_exists(#tokens) OR #tokens <= :max_tokens)")
+            expression_values[":max_tokens"] = max(self.tokens_per_minute - tokens, 0)
+        try:
+            self.table.update_item(
+                Key={"limit_key": f"{team_id}#{window}"},
+                UpdateExpression="ADD #requests :one, #tokens :tokens SET expires_at = :expires_at",
+                ConditionExpression=" AND ".join(conditions),
+                ExpressionAttributeNames={"#requests": "requests", "#tokens": "tokens"},
+                ExpressionAttributeValues=expression_values,
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return (window + 1) * 60 - now
+        return 0
+
+
+def get_rate_limiter():
+    if not TEAM_REQUESTS_PER_MINUTE and not TEAM_TOKENS_PER_MINUTE:
+        return None
+    if rate_limits_table:
+        return DynamoRateLimiter(rate_limits_table, TEAM_REQUESTS_PER_MINUTE, TEAM_TOKENS_PER_MINUTE)
+    return LocalRateLimiter(TEAM_REQUESTS_PER_MINUTE, TEAM_TOKENS_PER_MINUTE)
+
 
-STRIPE_MONTHLY_LINK= os.environ['STRIPE_MONTHLY_LINK']
-STRIPE_ANNUAL_LINK= os.environ['STRIPE_ANNUAL_LINK']
-STRIPE_LIFETIME_LINK= os.environ['STRIPE_LIFETIME_LINK']
+rate_limiter = get_rate_limiter()
+rate_limit_stats = {"allowed": 0, "waited": 0, "rejected": 0}
+
+
+class TTLCache:
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Shared by the threads that process a worker batch
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None or entry[0] <= self.clock():
+                self.items.pop(key, None)
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.items[key] = (self.clock() + (ttl if ttl is not None else self.ttl), value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+response_cache_stats = {"hits": 0, "shared_hits": 0, "misses": 0, "bypassed": 0}
+
+CACHE_MISS = object()
+user_record_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+home_stats = Counter()
+
+event_state_cache = TTLCache(EVENT_CACHE_SIZE, EVENT_STATE_TTL)
+resumed_event_replies = TTLCache(EVENT_CACHE_SIZE, EVENT_LEASE_SECONDS)
+current_event_id = contextvars.ContextVar("current_event_id", default=None)
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+chat_locks = OrderedDict()
+chat_locks_lock = threading.Lock()
 
 
 def start_chat():
@@ -44,29 +383,280 @@ def start_chat():
     ]
 
 
-def get_openai_response(chat):
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    response = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=chat
-    )
-    logging.info(f"OpenAI response: {response}")
+def get_openai_client():
+    return get_client("openai", lambda: ResilientOpenAI(
+        OPENAI_API_KEY,
+        OPENAI_MODEL,
+        fallback_model=OPENAI_FALLBACK_MODEL,
+        base_url=OPENAI_BASE_URL,
+        max_attempts=OPENAI_MAX_ATTEMPTS,
+        request_timeout=OPENAI_REQUEST_TIMEOUT,
+        hedge=OPENAI_HEDGE,
+        http_client=get_http_client(),
+    ))
+
+
+def get_deadline(context):
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - OPENAI_DEADLINE_MARGIN
+
+
+def get_openai_response(chat, model=None):
+    openai_client = get_openai_client()
+    response = openai_client.create(chat, model=model, deadline=current_deadline.get())
+    log_event("openai", "get_openai_response", model=lambda: getattr(response, "model", None), id=lambda: getattr(response, "id", None), usage=lambda: getattr(response, "usage", None), stats=openai_client.get_stats)
     return response
 
 
+def get_openai_stream(chat, model=None):
+    return get_openai_client().create(chat, model=model, deadline=current_deadline.get(), stream=True)
+
+
+def parse_model_routes(model_routes):
+    try:
+        routes = json.loads(model_routes) if model_routes else []
+    except ValueError as e:
+        logging.error(f"parse_model_routes ignoring invalid MODEL_ROUTES: {e}")
+        return []
+    return [route for route in routes if route.get("model")]
+
+
+model_routes = parse_model_routes(MODEL_ROUTES)
+routing_stats = Counter()
+
+
+def route_matches(route, prompt_tokens, request_class, plan_type):
+    if prompt_tokens > route.get("max_prompt_tokens", prompt_tokens):
+        return False
+    if prompt_tokens < route.get("min_prompt_tokens", 0):
+        return False
+    if "request_classes" in route and request_class not in route["request_classes"]:
+        return False
+    if "plans" in route and plan_type not in route["plans"]:
+        return False
+    return True
+
+
+def route_model(context, request_class=None, plan_type=None, prompt_tokens=None):
+    if prompt_tokens is None and model_routes:
+        prompt_tokens = get_chat_token_count(context)
+    model, rule = OPENAI_MODEL, None
+    for index, route in enumerate(model_routes):
+        if route_matches(route, prompt_tokens, request_class, plan_type):
+            model, rule = route["model"], index
+            break
+    routing_stats[model] += 1
+    log_event("routing", "route_model", model=model, rule=rule, prompt_tokens=prompt_tokens, request_class=request_class, plan_type=plan_type, counts=lambda: dict(routing_stats))
+    return model
+
+
 def get_openai_message_content(response):
     try:
         return response.choices[0].message.content
     except Exception as e:
         logging.error(f"Error getting OpenAI message content: {e}")
-        return "Sorry, we are unable to process your request at this time. The OpenAI API is currently unavailable. Please try again later."
+        return get_openai_unavailable_message()
+
+
+def get_openai_unavailable_message():
+    return "Sorry, we are unable to process your request at this time. The OpenAI API is currently unavailable. Please try again later."
+
+
+def get_rate_limited_message():
+    return "Your workspace is sending a lot of requests right now. Please try again in a minute."
+
+
+def acquire_openai_budget(team_id, tokens, sleep=time.sleep):
+    # Waits briefly for the team's budget to refill, then gives up so that a
+    # busy workspace gets a fast reply instead of holding up everyone else.
+    if not rate_limiter or not team_id:
+        return True
+    waited = 0
+    while True:
+        wait = rate_limiter.acquire(team_id, tokens)
+        if not wait:
+            rate_limit_stats["waited" if waited else "allowed"] += 1
+            return True
+        if waited + wait > RATE_LIMIT_MAX_WAIT:
+            rate_limit_stats["rejected"] += 1
+            log_event("openai", "rate limited", level=logging.WARNING, team_id=team_id, tokens=tokens, wait=wait, **rate_limit_stats)
+            return False
+        sleep(wait)
+        waited += wait
+
+
+def get_openai_stream_delta(chunk):
+    try:
+        return chunk.choices[0].delta.content or ""
+    except (AttributeError, IndexError):
+        return ""
+
+
+def update_slack_message(client, channel, ts, text, retry=False):
+    from slack_sdk.errors import SlackApiError
+    try:
+        return client.chat_update(channel=channel, ts=ts, text=text)
+    except SlackApiError as e:
+        retry_after = e.response.headers.get("Retry-After") if e.response.headers else None
+        if retry and e.response.status_code == 429:
+            logging.warning(f"update_slack_message rate limited, retrying in {retry_after}s")
+            time.sleep(int(retry_after or 1))
+            return client.chat_update(channel=channel, ts=ts, text=text)
+        logging.warning(f"update_slack_message error: {e}")
+
+
+def stream_openai_response(client, say, chat, clock=time.monotonic, model=None, placeholder=None, **say_kwargs):
+    # Post a placeholder right away, then edit it in place as deltas arrive.
+    # Edits are coalesced to one per STREAM_UPDATE_INTERVAL to stay within the
+    # chat.update rate limit; the first delta is always pushed immediately.
+    # Returns the content, whether the generation completed, since a failure
+    # mid-stream leaves the partial text in place, and whether Slack shows all
+    # of it. A retry passes the placeholder checkpointed by the failed attempt.
+    if placeholder is None:
+        placeholder = say(STREAM_PLACEHOLDER, **say_kwargs)
+        checkpoint_event_placeholder(current_event_id.get(), placeholder.get("channel"), placeholder.get("ts"))
+    channel = placeholder.get("channel")
+    ts = placeholder.get("ts")
+
+    content = ""
+    sent_content = ""
+    last_update = clock() - STREAM_UPDATE_INTERVAL
+    completed = False
+    try:
+        for chunk in get_openai_stream(chat, model=model):
+            content += get_openai_stream_delta(chunk)
+            now = clock()
+            if content != sent_content and now - last_update >= STREAM_UPDATE_INTERVAL:
+                # A failed edit, e.g. rate limited, leaves sent_content behind
+                # so the closing edit below still goes out
+                if update_slack_message(client, channel, ts, content) is not None:
+                    sent_content = content
+                last_update = now
+        completed = bool(content)
+    except Exception as e:
+        logging.error(f"Error streaming OpenAI response: {e}")
+
+    if not content:
+        content = get_openai_unavailable_message()
+    # Slack still shows an earlier edit if the closing one fails
+    posted = content == sent_content or update_slack_message(client, channel, ts, content, retry=True) is not None
+    logging.info(f"stream_openai_response length: {len(content)} completed: {completed} posted: {posted}")
+    return content, completed, posted
+
+
+def response_is_cacheable(context):
+    return bool(RESPONSE_CACHE_TTL) and len(context) <= RESPONSE_CACHE_MAX_MESSAGES and context[-1].get("role") == "user"
+
+
+def normalize_cache_content(content):
+    return " ".join(strip_mentions(content).split()).casefold()
+
+
+def get_response_cache_key(model, context):
+    normalized = [[message.get("role"), normalize_cache_content(message.get("content"))] for message in context]
+    return hashlib.sha256(json.dumps([model, normalized]).encode()).hexdigest()
+
+
+def get_cached_response(cache_key):
+    content = response_cache.get(cache_key)
+    if content is not None:
+        response_cache_stats["hits"] += 1
+        return content
+
+    if response_cache_table:
+        item = get_ddb_item(response_cache_table, "cache_key", cache_key)
+        if item and int(item.get("expires_at", 0)) > get_timestamp():
+            response_cache_stats["shared_hits"] += 1
+            response_cache.set(cache_key, item.get("content"))
+            return item.get("content")
+
+    response_cache_stats["misses"] += 1
+    return None
+
+
+def set_cached_response(cache_key, content):
+    response_cache.set(cache_key, content)
+    if response_cache_table:
+        put_ddb_item(response_cache_table, {
+            "cache_key": cache_key,
+            "content": content,
+            "expires_at": get_timestamp() + RESPONSE_CACHE_TTL,
+        })
+
+
+class ReplyNotPosted(Exception):
+    # Raised by reply_to_chat when Slack does not show all of a checkpointed
+    # reply, so that the event is retried and edits the same message
+    pass
+
+
+def reply_to_chat(chat, say, client, summary=None, team_id=None, request_class=None, plan_type=None, **say_kwargs):
+    event_id = current_event_id.get()
+    resumed_reply = resumed_event_replies.get(event_id) or {}
+    placeholder = {"channel": resumed_reply.get("channel"), "ts": resumed_reply.get("ts")} if resumed_reply.get("ts") else None
+    if resumed_reply.get("reply"):
+        # A reply the failed attempt already posted is only saved this time
+        logging.info(f"reply_to_chat resuming reply for {event_id} posted: {resumed_reply.get('posted')}")
+        if not resumed_reply.get("posted"):
+            if placeholder:
+                if update_slack_message(client, placeholder["channel"], placeholder["ts"], resumed_reply.get("reply"), retry=True) is None:
+                    raise ReplyNotPosted(f"reply_to_chat could not edit the reply to {event_id}")
+            else:
+                say(resumed_reply.get("reply"), **say_kwargs)
+            mark_event_reply_posted(event_id)
+        return resumed_reply.get("reply")
+
+    context, prompt_tokens = build_counted_context(chat, summary=summary)
+    model = route_model(context, request_class=request_class, plan_type=plan_type, prompt_tokens=prompt_tokens)
+    cache_key = None
+    if response_is_cacheable(context):
+        cache_key = get_response_cache_key(model, context)
+        cached_message = get_cached_response(cache_key)
+        log_event("cache", "response_cache", **response_cache_stats)
+        if cached_message:
+            say(cached_message, **say_kwargs)
+            return cached_message
+    else:
+        response_cache_stats["bypassed"] += 1
+
+    if not acquire_openai_budget(team_id, prompt_tokens):
+        openai_message = get_rate_limited_message()
+        say(openai_message, **say_kwargs)
+        return openai_message
+
+    if STREAM_RESPONSES:
+        openai_message, completed, posted = stream_openai_response(client, say, context, model=model, placeholder=placeholder, **say_kwargs)
+        if completed:
+            checkpoint_event_reply(event_id, openai_message, posted=posted)
+            if not posted and events_table and event_id:
+                raise ReplyNotPosted(f"reply_to_chat could not edit the reply to {event_id}")
+        completed = completed and posted
+    else:
+        try:
+            response = get_openai_response(context, model=model)
+        except Exception as e:
+            logging.error(f"reply_to_chat OpenAI error: {e}")
+            response = None
+        openai_message = get_openai_message_content(response)
+        completed = openai_message != get_openai_unavailable_message()
+        if completed:
+            checkpoint_event_reply(event_id, openai_message)
+        say(openai_message, **say_kwargs)
+        if completed:
+            mark_event_reply_posted(event_id)
+
+    # A truncated or failed reply would otherwise be served to every repeat
+    if cache_key and completed:
+        set_cached_response(cache_key, openai_message)
+    return openai_message
 
 
 def add_to_chat(chat, role, content):
     chat.append(
-        {"role": role, "content": content}
+        set_token_count({"role": role, "content": content})
     )
-    logging.info(f'add_to_chat: {chat}')
+    log_event("chat", "add_to_chat", role=role, chat_length=len(chat))
     return chat
 
 
@@ -78,11 +668,123 @@ def trim_chat(chat, max_length=MAX_CHAT_LENGTH):
     return chat
     
 
+def strip_mentions(content):
+    return SLACK_MENTION_PATTERN.sub("", content or "").strip()
+
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token for English text with the GPT tokenizers
+    return (len(text) + 3) // 4
+
+
+def count_message_tokens(message):
+    # Stored turns carry their count; nothing is written back, so the messages
+    # sent to OpenAI keep exactly role and content
+    if "tokens" in message:
+        return int(message["tokens"])
+    return estimate_tokens(strip_mentions(message.get("content"))) + MESSAGE_TOKEN_OVERHEAD
+
+
+def set_token_count(message):
+    # Stored turns are counted once and keep the count; build_counted_context
+    # copies only role and content into what is sent to OpenAI
+    message["tokens"] = count_message_tokens(message)
+    return message
+
+
+def truncate_message(message, max_tokens):
+    max_chars = max(max_tokens - MESSAGE_TOKEN_OVERHEAD, 0) * 4
+    content = strip_mentions(message.get("content"))
+    if len(content) > max_chars:
+        content = content[:max_chars] + " [truncated]"
+    return {"role": message.get("role"), "content": content}
+
+
+def get_summary_message(summary):
+    return {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+
+
+def build_counted_context(chat, summary=None, budget=PROMPT_TOKEN_BUDGET, min_latest_tokens=LATEST_TURN_MIN_TOKENS):
+    system_message, turns = chat[0], chat[1:]
+    remaining = budget - count_message_tokens(system_message)
+    prefix = [{"role": system_message.get("role"), "content": system_message.get("content")}]
+    # The latest turn keeps at least min_latest_tokens of itself, taken out
+    # of the summary first and out of the budget only if nothing else is left
+    reserved = min(count_message_tokens(turns[-1]), min_latest_tokens) if turns else 0
+    if summary:
+        summary_message = get_summary_message(summary)
+        summary_budget = remaining - reserved
+        if count_message_tokens(summary_message) > summary_budget:
+            summary_message = truncate_message(summary_message, summary_budget) if summary_budget > MESSAGE_TOKEN_OVERHEAD else None
+        if summary_message:
+            remaining -= count_message_tokens(summary_message)
+            prefix.append(summary_message)
+
+    context = []
+    for message in reversed(turns):
+        tokens = count_message_tokens(message)
+        if tokens > remaining:
+            if not context:
+                truncated = truncate_message(message, max(remaining, reserved))
+                context.append(truncated)
+                remaining -= count_message_tokens(truncated)
+            break
+        context.append({"role": message.get("role"), "content": strip_mentions(message.get("content"))})
+        remaining -= tokens
+
+    logging.info(f"build_context kept {len(context)} of {len(turns)} turns, {budget - remaining} tokens")
+    return prefix + context[::-1], budget - remaining
+
+
+def build_context(chat, summary=None, budget=PROMPT_TOKEN_BUDGET, min_latest_tokens=LATEST_TURN_MIN_TOKENS):
+    return build_counted_context(chat, summary=summary, budget=budget, min_latest_tokens=min_latest_tokens)[0]
+
+
+def get_chat_token_count(chat):
+    return sum(count_message_tokens(message) for message in chat)
+
+
+def get_summary_prompt(summary, turns):
+    transcript = "\n".join(f'{message.get("role")}: {strip_mentions(message.get("content"))}' for message in turns)
+    return [
+        {"role": "system", "content": "You maintain a running summary of a conversation between a user and an assistant. Update the summary with the new messages, keeping names, facts, decisions and open questions. Reply with the updated summary only."},
+        {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"},
+    ]
+
+
+def needs_compaction(chat, threshold=SUMMARY_TOKEN_THRESHOLD, keep_turns=SUMMARY_KEEP_TURNS, max_length=MAX_CHAT_LENGTH):
+    # With summaries enabled, compaction replaces trim_chat, so a chat over the
+    # length cap is folded as well as one over the token threshold
+    if not threshold or len(chat) - 1 <= keep_turns:
+        return False
+    return len(chat) > max_length or get_chat_token_count(chat) > threshold
+
+
+def compact_chat(chat, summary, threshold=SUMMARY_TOKEN_THRESHOLD, keep_turns=SUMMARY_KEEP_TURNS, max_length=MAX_CHAT_LENGTH, earlier_turns=()):
+    # earlier_turns are unsummarized turns older than chat[1], which turns
+    # storage did not load; they are folded first so none are skipped
+    if not needs_compaction(chat, threshold, keep_turns, max_length):
+        return chat, summary
+
+    folded_turns = list(earlier_turns) + chat[1:len(chat) - keep_turns]
+    try:
+        response = get_openai_response(get_summary_prompt(summary, folded_turns))
+        new_summary = response.choices[0].message.content
+    except Exception as e:
+        logging.error(f"compact_chat error summarizing {len(folded_turns)} turns: {e}")
+        return chat, summary
+
+    if not new_summary:
+        return chat, summary
+    logging.info(f"compact_chat folded {len(folded_turns)} turns into summary")
+    return [chat[0]] + chat[len(chat) - keep_turns:], new_summary
+
+
 def get_ddb_item(table, key_name, key_value):
     response = table.get_item(
         Key={key_name: key_value}
     )
-    logging.info(f"get_ddb_item response: {response}")
+    log_event("ddb", "get_ddb_item", table=table.name, key=key_value, found="Item" in response)
     return response.get("Item")
 
 
@@ -90,60 +792,386 @@ def put_ddb_item(table, item):
     response = table.put_item(
         Item=item
     )
-    logging.info(f"put_ddb_item response: {response}")
+    log_event("ddb", "put_ddb_item", table=table.name, status=lambda: response.get("ResponseMetadata", {}).get("HTTPStatusCode"))
     return response
     
 
+def encode_chat(chat):
+    # Version byte followed by zlib over a compact JSON list of
+    # [role index, content, tokens]; the default system prompt is stored as null.
+    default_system_prompt = start_chat()[0].get("content")
+    compact_chat = []
+    for message in chat:
+        role = message.get("role")
+        content = message.get("content")
+        compact_chat.append([
+            CHAT_CODEC_ROLES.index(role) if role in CHAT_CODEC_ROLES else role,
+            None if role == "system" and content == default_system_prompt else content,
+            int(message["tokens"]) if "tokens" in message else None,
+        ])
+    payload = json.dumps(compact_chat, separators=(",", ":")).encode()
+    return bytes([CHAT_CODEC_VERSION]) + zlib.compress(payload)
+
+
+def decode_chat(data):
+    data = bytes(getattr(data, "value", data))
+    if data[0] != CHAT_CODEC_VERSION:
+        raise ValueError(f"Unsupported chat codec version: {data[0]}")
+
+    default_system_prompt = start_chat()[0].get("content")
+    chat = []
+    for role, content, tokens in json.loads(zlib.decompress(data[1:])):
+        role = CHAT_CODEC_ROLES[role] if isinstance(role, int) else role
+        message = {"role": role, "content": default_system_prompt if content is None and role == "system" else content}
+        if tokens is not None:
+            message["tokens"] = tokens
+        chat.append(message)
+    return chat
+
+
 def get_chat_from_ddb_item(item):
     if item:
-        logging.info(f"get_chat_from_ddb_item: {item}")
+        log_event("chat", "get_chat_from_ddb_item", attributes=lambda: sorted(item))
+        if "chat_z" in item:
+            return decode_chat(item.get("chat_z"))
         return item.get("chat")
     else:
         logging.info(f"get_chat_from_ddb_item: no item found")
         return []
 
 
-def save_chat_to_ddb(table, key_name, key_value, chat):
+def get_summary_from_ddb_item(item):
+    if item:
+        return item.get("summary")
+    return None
+
+
+def save_chat_to_ddb(table, key_name, key_value, chat, summary=None, version=None):
     ddb_item = {
         key_name: key_value,
-        'chat': chat,
     }
-    logging.info(f'save_chat_to_ddb: {table} {ddb_item}')
-    return put_ddb_item(table, ddb_item)
+    for message in chat:
+        set_token_count(message)
+    if CHAT_CODEC == "zlib":
+        ddb_item['chat_z'] = encode_chat(chat)
+    else:
+        ddb_item['chat'] = chat
+    if summary:
+        ddb_item['summary'] = summary
+    log_event("chat", "save_chat_to_ddb", table=table.name, key=key_value, chat_length=len(chat), summary=bool(summary), version=version)
+    if version is None:
+        return put_ddb_item(table, ddb_item)
+
+    # Items written before versioning have no version and count as version 0
+    ddb_item['version'] = version + 1
+    return table.put_item(
+        Item=ddb_item,
+        ConditionExpression="attribute_not_exists(#version) OR #version = :version",
+        ExpressionAttributeNames={"#version": "version"},
+        ExpressionAttributeValues={":version": version},
+    )
+
+
+def get_chat_turns_id(key_name, key_value):
+    return f"{key_name}#{key_value}"
+
+
+def get_message_from_chat_turn(turn):
+    message = {"role": turn.get("role"), "content": turn.get("content")}
+    if "tokens" in turn:
+        message["tokens"] = int(turn["tokens"])
+    return message
+
+
+def put_chat_turns(chat_turns_id, first_seq, messages):
+    with chat_turns_table.batch_writer() as batch:
+        for seq, message in enumerate(messages, start=first_seq):
+            batch.put_item(Item={
+                "chat_id": chat_turns_id,
+                "seq": seq,
+                "role": message.get("role"),
+                "content": message.get("content"),
+                "tokens": count_message_tokens(message),
+            })
+    logging.info(f"put_chat_turns: {chat_turns_id} {first_seq}-{first_seq + len(messages) - 1}")
+
+
+def query_chat_turns(chat_turns_id, limit=None):
+    from boto3.dynamodb.conditions import Key
+    response = chat_turns_table.query(
+        KeyConditionExpression=Key("chat_id").eq(chat_turns_id),
+        ScanIndexForward=False,
+        Limit=limit or MAX_CHAT_LENGTH,
+    )
+    logging.info(f"query_chat_turns: {chat_turns_id} {response.get('Count')} items")
+    return response.get("Items", [])[::-1]
+
+
+def query_unsummarized_turns(chat_turns_id, after_seq, before_seq):
+    # The turns between the summary and the loaded tail, oldest first
+    from boto3.dynamodb.conditions import Key
+    if before_seq - after_seq <= 1:
+        return []
+    query_kwargs = {"KeyConditionExpression": Key("chat_id").eq(chat_turns_id) & Key("seq").between(after_seq + 1, before_seq - 1)}
+    turns = []
+    while True:
+        response = chat_turns_table.query(**query_kwargs)
+        turns.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            break
+        query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    logging.info(f"query_unsummarized_turns: {chat_turns_id} {len(turns)} turns")
+    return [get_message_from_chat_turn(turn) for turn in turns]
+
+
+def migrate_chat_item_to_turns(table, key_name, key_value):
+    # Copies a legacy chat item into turns storage and claims its seqs on the
+    # metadata row, so later loads find the metadata row and skip the chat item
+    turns = [message for message in get_chat_from_ddb_item(get_ddb_item(table, key_name, key_value)) if message.get("role") != "system"]
+    if not turns:
+        return False
+    chat_turns_id = get_chat_turns_id(key_name, key_value)
+    put_chat_turns(chat_turns_id, 1, turns)
+    try:
+        chat_turns_table.update_item(
+            Key={"chat_id": chat_turns_id, "seq": CHAT_METADATA_SEQ},
+            UpdateExpression="SET last_seq = :last_seq",
+            ConditionExpression="attribute_not_exists(last_seq)",
+            ExpressionAttributeValues={":last_seq": len(turns)},
+        )
+    except chat_turns_table.meta.client.exceptions.ConditionalCheckFailedException:
+        # A concurrent migration or save has already claimed them
+        pass
+    logging.info(f"migrate_chat_item_to_turns: {chat_turns_id} {len(turns)} turns")
+    return True
+
+
+def load_chat_turns(table, key_name, key_value):
+    # One query returns the metadata row and the newest turns. The metadata
+    # row holds the summary and the last_seq claimed by save_chat, which is
+    # ahead of the stored turns if a writer died after claiming.
+    chat_turns_id = get_chat_turns_id(key_name, key_value)
+    items = query_chat_turns(chat_turns_id)
+    if not items and migrate_chat_item_to_turns(table, key_name, key_value):
+        items = query_chat_turns(chat_turns_id)
+    metadata = items.pop() if items and int(items[-1]["seq"]) == CHAT_METADATA_SEQ else None
+
+    summary = get_summary_from_ddb_item(metadata)
+    summary_seq = int(metadata.get("summary_seq", 0)) if metadata else 0
+    claimed_seq = int(metadata.get("last_seq", 0)) if metadata else 0
+    turns = [turn for turn in items if int(turn["seq"]) > summary_seq]
+    last_seq = max(int(turns[-1]["seq"]) if turns else summary_seq, claimed_seq)
+    return {
+        "chat": start_chat() + [get_message_from_chat_turn(turn) for turn in turns],
+        "summary": summary,
+        "summary_seq": summary_seq,
+        "seqs": [int(turn["seq"]) for turn in turns],
+        "last_seq": last_seq,
+    }
+
+
+def load_chat(table, key_name, key_value):
+    if CHAT_STORAGE == "turns":
+        return load_chat_turns(table, key_name, key_value)
+    item = get_ddb_item(table, key_name, key_value)
+    return {
+        "chat": get_chat_from_ddb_item(item),
+        "summary": get_summary_from_ddb_item(item),
+        "version": int(item.get("version", 0)) if item else 0,
+    }
+
+
+def try_save_chat(table, key_name, key_value, chat_record, chat, summary, new_turns):
+    if CHAT_STORAGE != "turns":
+        try:
+            save_chat_to_ddb(table, key_name, key_value, chat, summary, version=chat_record.get("version", 0))
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    # Claim the next seq slots on the metadata row first, so that a turn loaded
+    # from a stale last_seq cannot overwrite the turns saved since.
+    chat_turns_id = get_chat_turns_id(key_name, key_value)
+    last_seq = chat_record.get("last_seq", 0)
+    update_expression = "SET last_seq = :next_seq"
+    expression_values = {":last_seq": last_seq, ":next_seq": last_seq + len(new_turns)}
+    if summary and summary != chat_record.get("summary"):
+        # Everything before the first turn kept in the chat has been folded
+        seqs = chat_record.get("seqs", []) + list(range(last_seq + 1, last_seq + len(new_turns) + 1))
+        kept_turns = len(chat) - 1
+        update_expression += ", summary = :summary, summary_seq = :summary_seq"
+        expression_values[":summary"] = summary
+        expression_values[":summary_seq"] = seqs[-kept_turns] - 1 if kept_turns else seqs[-1]
+    try:
+        chat_turns_table.update_item(
+            Key={"chat_id": chat_turns_id, "seq": CHAT_METADATA_SEQ},
+            UpdateExpression=update_expression,
+            ConditionExpression="attribute_not_exists(last_seq) OR last_seq = :last_seq",
+            ExpressionAttributeValues=expression_values,
+        )
+    except chat_turns_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    put_chat_turns(chat_turns_id, last_seq + 1, new_turns)
+    return True
+
+
+class ChatSaveConflict(Exception):
+    # Raised by save_chat when every attempt lost to a concurrent write
+    pass
+
+
+def save_chat(table, key_name, key_value, chat_record, chat, summary, new_turns):
+    # Another turn in the same chat may have been saved since chat_record was
+    # loaded. On a conflict, reload and append this turn after the other one
+    # instead of overwriting it; the merged chat keeps the stored summary and
+    # is compacted on the next turn.
+    for attempt in range(1, CHAT_SAVE_ATTEMPTS + 1):
+        if try_save_chat(table, key_name, key_value, chat_record, chat, summary, new_turns):
+            return
+        log_event("chat", "save_chat conflict", level=logging.WARNING, key=key_value, attempt=attempt)
+        chat_record = load_chat(table, key_name, key_value)
+        chat = (chat_record.get("chat") or start_chat()) + new_turns
+        summary = chat_record.get("summary")
+        if CHAT_STORAGE != "turns" and not SUMMARY_TOKEN_THRESHOLD:
+            chat = trim_chat(chat)
+    raise ChatSaveConflict(f"save_chat gave up on {key_value} after {CHAT_SAVE_ATTEMPTS} conflicting writes")
+
+
+def get_chat_lock(chat_id):
+    # Serializes turns for the same chat within a warm container, so only
+    # turns from other containers can conflict in save_chat.
+    with chat_locks_lock:
+        lock = chat_locks.get(chat_id)
+        if lock is None:
+            lock = chat_locks[chat_id] = threading.Lock()
+        chat_locks.move_to_end(chat_id)
+        while len(chat_locks) > CHAT_LOCKS_SIZE:
+            oldest_id, oldest_lock = next(iter(chat_locks.items()))
+            if oldest_lock.locked():
+                break
+            del chat_locks[oldest_id]
+        return lock
+
+
+def run_chat_turn(table, key_name, key_value, chat_record, text, say, client, team_id=None, request_class=None, plan_type=None, **say_kwargs):
+    event_id = current_event_id.get()
+    resumed_reply = resumed_event_replies.get(event_id) or {}
+    if resumed_reply.get("saved"):
+        # The failed attempt posted the reply and saved the turn already
+        logging.info(f"run_chat_turn skipping turn saved for {event_id}")
+        return resumed_reply.get("reply")
+
+    chat = chat_record.get("chat") or start_chat()
+    summary = chat_record.get("summary")
+
+    chat = add_to_chat(chat, "user", text)
+    openai_message = reply_to_chat(chat, say, client, summary=summary, team_id=team_id, request_class=request_class, plan_type=plan_type, **say_kwargs)
+    if openai_message == get_rate_limited_message():
+        return openai_message
+    chat = add_to_chat(chat, "assistant", openai_message)
+    new_turns = chat[-2:]
+    earlier_turns = []
+    if CHAT_STORAGE == "turns" and needs_compaction(chat, SUMMARY_TOKEN_THRESHOLD, SUMMARY_KEEP_TURNS, MAX_CHAT_LENGTH):
+        first_seq = (chat_record.get("seqs") or [chat_record.get("last_seq", 0) + 1])[0]
+        earlier_turns = query_unsummarized_turns(get_chat_turns_id(key_name, key_value), chat_record.get("summary_seq", 0), first_seq)
+    chat, summary = compact_chat(chat, summary, SUMMARY_TOKEN_THRESHOLD, SUMMARY_KEEP_TURNS, MAX_CHAT_LENGTH, earlier_turns=earlier_turns)
+    # Once summaries are enabled, old turns are folded instead of dropped
+    if CHAT_STORAGE != "turns" and not SUMMARY_TOKEN_THRESHOLD:
+        chat = trim_chat(chat)
+    try:
+        save_chat(table, key_name, key_value, chat_record, chat, summary, new_turns)
+        mark_event_turn_saved(event_id)
+    except ChatSaveConflict as e:
+        # The reply has been sent, so failing the event would only have it
+        # retried and answered twice; the turn is left out of the history
+        log_event("chat", "turn lost", level=logging.ERROR, key=key_value, error=str(e), turn_lengths=[len(message.get("content") or "") for message in new_turns])
+    return openai_message
 
 
 def get_timestamp():
     return round(datetime.datetime.utcnow().timestamp())
 
 
-def add_new_user(slack_id, email):
-    slack_install_timestamp = get_timestamp()
+def get_onboarding_transaction(slack_id, email, users_id_ddb_item):
+    # The resource's meta.client serializes plain Python values like Table does
+    return [
+        {
+            "Update": {
+                "TableName": users_email_table.name,
+                "Key": {"email": email},
+                "UpdateExpression": "ADD workspaces :slack_ids",
+                "ExpressionAttributeValues": {":slack_ids": {slack_id}},
+            }
+        },
+        {
+            "Put": {
+                "TableName": users_id_table.name,
+                "Item": users_id_ddb_item,
+                "ConditionExpression": "attribute_not_exists(slack_id)",
+            }
+        },
+    ]
+
+
+def migrate_workspaces_to_set(email):
+    # Items written before onboarding was transactional hold workspaces as a
+    # list, which a set ADD cannot extend
     users_email_ddb_item = get_ddb_item(users_email_table, 'email', email)
-    logging.info(f"add_new_user users_email_ddb_item: {users_email_ddb_item}")
-    if not users_email_ddb_item:
-        users_email_ddb_item = {
-            'email': email,
-            'workspaces':[
-                slack_id
-            ] 
-        }
+    workspaces = users_email_ddb_item.get('workspaces') if users_email_ddb_item else None
+    if not isinstance(workspaces, list):
+        return
+    if workspaces:
+        update_expression = "SET workspaces = :workspaces"
+        expression_values = {":workspaces": set(workspaces), ":legacy_workspaces": workspaces}
     else:
-        if 'workspaces' not in users_email_ddb_item:
-            users_email_ddb_item['workspaces'] = []
-        users_email_ddb_item['workspaces'].append(slack_id)
+        update_expression = "REMOVE workspaces"
+        expression_values = {":legacy_workspaces": workspaces}
+    try:
+        users_email_table.update_item(
+            Key={'email': email},
+            UpdateExpression=update_expression,
+            ConditionExpression="workspaces = :legacy_workspaces",
+            ExpressionAttributeValues=expression_values,
+        )
+    except users_email_table.meta.client.exceptions.ConditionalCheckFailedException:
+        logging.info(f"migrate_workspaces_to_set: {email} already migrated")
 
-    response = put_ddb_item(users_email_table, users_email_ddb_item)
-    logging.info(f"add_new_user users_email_ddb_item: {users_email_ddb_item}")
 
+def add_new_user(slack_id, email):
+    # One transaction adds the workspace to the email's set and creates the
+    # user record only if it is absent, so concurrent installs and retries
+    # neither duplicate workspaces nor reset an existing record.
+    slack_install_timestamp = get_timestamp()
     users_id_ddb_item = {
         'slack_id': slack_id,
         'email': email,
         'active': True, 
         'plan_type': 'trial',  
         'slack_install_timestamp': slack_install_timestamp,
+        'trial_expires_at': get_trial_expiry_bucket(slack_install_timestamp),
     }
-    response = put_ddb_item(users_id_table, users_id_ddb_item)
-    logging.info(f"add_new_user users_id_ddb_item: {users_id_ddb_item}")
+    client = users_id_table.meta.client
+    for attempt in range(2):
+        try:
+            client.transact_write_items(TransactItems=get_onboarding_transaction(slack_id, email, users_id_ddb_item))
+            break
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = [reason.get("Code") for reason in e.response.get("CancellationReasons", [])]
+            logging.info(f"add_new_user {slack_id} transaction cancelled: {reasons}")
+            if len(reasons) > 1 and reasons[1] == "ConditionalCheckFailed":
+                users_id_ddb_item = get_ddb_item(users_id_table, "slack_id", slack_id)
+                return cache_user_record(slack_id, users_id_ddb_item)
+            # ADD on a legacy list workspaces attribute fails with a type error
+            if attempt or reasons[:1] not in (["ValidationError"], ["IncorrectDataType"]):
+                raise
+            migrate_workspaces_to_set(email)
+
+    # A trial that is never scheduled, e.g. after a crash here, is still
+    # caught by the nightly sweep
+    if trial_expiry_scheduler:
+        trial_expiry_scheduler.schedule(slack_id, get_trial_expires_at(slack_install_timestamp))
+    log_event("users", "add_new_user", users_id_ddb_item=users_id_ddb_item)
+    cache_user_record(slack_id, users_id_ddb_item)
     return users_id_ddb_item
 
 
@@ -171,7 +1199,7 @@ def get_slack_user_info(client, user_id):
     except Exception as e:
         logging.error(f'get_slack_users_info error {e}')
     else:
-        logging.info(f'get_slack_users_info info {result}')
+        log_event("slack", "get_slack_users_info", result=result)
         return result
 
 
@@ -192,12 +1220,28 @@ def get_slack_id(slack_user_info):
         return f"{slack_team_id}-{slack_user_id}"
 
 
+def cache_user_record(slack_id, user_record):
+    # Unknown and inactive users are cached briefly so that a Stripe payment
+    # unlocks the app quickly
+    ttl = USER_CACHE_TTL if user_record and user_record.get("active") else USER_CACHE_NEGATIVE_TTL
+    if ttl and user_record and user_record.get("active") and user_record.get("plan_type") == "trial" and user_record.get("slack_install_timestamp"):
+        # An active trial is not served from the cache past its expiry
+        ttl = max(min(ttl, get_trial_expires_at(user_record["slack_install_timestamp"]) - get_timestamp()), 0)
+    user_record_cache.set(slack_id, user_record, ttl=ttl)
+    return user_record
+
+
 def get_user_record(event):
     slack_id = f'{event.get("team")}-{event.get("user")}'
     logging.info(f'get_user_record slack_id: {slack_id}')
+    user_record = user_record_cache.get(slack_id, CACHE_MISS)
+    if user_record is not CACHE_MISS:
+        log_event("users", "get_user_record cache hit", user_record=user_record)
+        return user_record
+
     user_record = get_ddb_item(users_id_table, "slack_id", slack_id)
-    logging.info(f'get_user_record: {user_record}')
-    return user_record
+    log_event("users", "get_user_record", user_record=user_record)
+    return cache_user_record(slack_id, user_record)
 
 
 def slack_challenge_response(challenge):
@@ -221,156 +1265,45 @@ def default_response(message="Successs"):
     }
 
 
-def get_inactive_message():
-    return "We're thrilled you've been enjoying Bounce! Your free trial has wrapped up, but there's more value in store. Swing by the Home tab to continue taking advantage of enhanced productivity – subscribe now to keep bouncing with us! :rocket:"
-
+def slack_signature_is_valid(headers, raw_body, current_time=None):
+    timestamp = headers.get("x-slack-request-timestamp")
+    signature = headers.get("x-slack-signature")
+    if not timestamp or not signature or not SLACK_SIGNING_SECRET:
+        return False
 
-def get_home_view(plan_type, active):
-    blocks = [
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": ":wave: Hi! I'm Bounce, your ChatGPT for Slack app!",
-            },
-        },
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": "We are always improving! Click the button below to get the latest features.",
-            },
-        },
-        {
-            "type": "actions",
-            "elements": [
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Update now",
-                    },
-                    "url": SLACK_APP_URL,
-                },
-            ],
-        },
-    ]
-    if plan_type == "paid":
-        blocks.append(
-            {
-                "type": "section",
-                "text": {
-                    "type": "mrkdwn",
-                    "text": "Thanks for subscribing! Please share with your friends and colleagues!",
-                },
-            }
-        )
-        return {
-            "type": "home",
-            "callback_id": "home_view",
-            "blocks": blocks
-        }
-
-    if plan_type == "trial":
-        if active:
-            blocks.append(
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": "We hope you are enjoying your free trial!",
-                    },
-                }
-            )
-        else:
-            blocks.append(
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": "Your free trial has expired. Subscribe now to continue using Bounce.",
-                    },
-                }
-            )
+    try:
+        timestamp_seconds = int(timestamp)
+    except ValueError:
+        logging.warning(f"slack_signature_is_valid malformed timestamp: {timestamp}")
+        return False
 
+    current_time = current_time or time.time()
+    if abs(current_time - timestamp_seconds) > 60 * 5:
+        logging.warning(f"slack_signature_is_valid stale timestamp: {timestamp}")
+        return False
 
-    blocks.extend([
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": "Click one of the buttons below to start your subscription!",
-            },
-        },
-        {
-            "type": "actions",
-            "elements": [
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Lifetime access for only $100",
-                    },
-                    "url": STRIPE_LIFETIME_LINK,
-                },
-            ],
-        },
-        {
-            "type": "actions",
-            "elements": [
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Annual access for $50/year",
-                    },
-                    "url": STRIPE_ANNUAL_LINK,
-                },
-            ],
-        },
-        {
-            "type": "actions",
-            "elements": [
-                {
-                    "type": "button",
-                    "text": {
-                        "type": "plain_text",
-                        "text": "Monthly access for $5/month",
-                    },
-                    "url": STRIPE_MONTHLY_LINK,
-                },
-            ],
-        },
-    ])
-    return {
-        "type": "home",
-        "callback_id": "home_view",
-        "blocks": blocks
-    }
+    base_string = f"v0:{timestamp}:{raw_body}".encode()
+    computed_signature = "v0=" + hmac.new(SLACK_SIGNING_SECRET.encode(), base_string, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(computed_signature, signature)
 
 
-@app.event("app_mention")
-def app_mention_event(event, say):
+def app_mention_event(event, say, client):
     user_record = get_user_record(event)
     thread_ts = event.get("thread_ts")
 
     if user_record and user_record.get("active"):
-        if thread_ts:
-            public_chat_id = get_public_chat_id(event)
-            chat = get_chat_from_ddb_item(get_ddb_item(public_chats_table, "public_chat_id", public_chat_id))
-            logging.info(f"Retrieved existing public chat: {public_chat_id}")
-        else:
-            thread_ts = event.get("ts")
-            public_chat_id = get_public_chat_id(event)
-            logging.info(f"Starting new public chat: {public_chat_id}")
-            chat = start_chat()
-
-        chat = add_to_chat(chat, "user", event.get("text"))
-        openai_message = get_openai_message_content(get_openai_response(chat))
-        say(openai_message, thread_ts=thread_ts)
-        chat = add_to_chat(chat, "assistant", openai_message)
-        chat = trim_chat(chat)
-        save_chat_to_ddb(public_chats_table, "public_chat_id", public_chat_id, chat)
+        public_chat_id = get_public_chat_id(event)
+        request_class = "thread" if thread_ts else "mention"
+        with get_chat_lock(public_chat_id):
+            if thread_ts:
+                chat_record = load_chat(public_chats_table, "public_chat_id", public_chat_id)
+                logging.info(f"Retrieved existing public chat: {public_chat_id}")
+            else:
+                thread_ts = event.get("ts")
+                logging.info(f"Starting new public chat: {public_chat_id}")
+                chat_record = {"chat": start_chat()}
+
+            run_chat_turn(public_chats_table, "public_chat_id", public_chat_id, chat_record, event.get("text"), say, client, team_id=event.get("team"), request_class=request_class, plan_type=user_record.get("plan_type"), thread_ts=thread_ts)
     else:
         if thread_ts:
             say(get_inactive_message(), thread_ts=thread_ts)
@@ -378,9 +1311,8 @@ def app_mention_event(event, say):
             say(get_inactive_message(), thread_ts=event.get("ts"))
 
 
-@app.event("message")
-def message_event(event, say, logger):
-    logging.info(f"message_event event {event}")
+def message_event(event, say, client, logger):
+    log_event("ingress", "message_event", event=event)
     user_id = event.get("user")
     logging.info(f"message_event user_id {user_id}")
 
@@ -390,63 +1322,511 @@ def message_event(event, say, logger):
     if event.get("channel_type") == "im":
         if user_record and user_record.get("active"):
             private_chat_id = get_private_chat_id(event)
-            chat = get_chat_from_ddb_item(get_ddb_item(private_chats_table, "private_chat_id", private_chat_id))
-            if not chat:
-                logging.info(f"starting new private chat: {private_chat_id}")
-                chat = start_chat()
-            else:
-                logging.info(f"retrieved existing private chat: {private_chat_id}")
-                
-            chat = add_to_chat(chat, "user", event.get("text"))
-            openai_message = get_openai_message_content(get_openai_response(chat))
-            say(openai_message, channel=channel)
-            chat = add_to_chat(chat, "assistant", openai_message)
-            chat = trim_chat(chat)
-            save_chat_to_ddb(private_chats_table, "private_chat_id", private_chat_id, chat)
+            with get_chat_lock(private_chat_id):
+                chat_record = load_chat(private_chats_table, "private_chat_id", private_chat_id)
+                if len(chat_record.get("chat") or []) <= 1:
+                    logging.info(f"starting new private chat: {private_chat_id}")
+                else:
+                    logging.info(f"retrieved existing private chat: {private_chat_id}")
+
+                run_chat_turn(private_chats_table, "private_chat_id", private_chat_id, chat_record, event.get("text"), say, client, team_id=event.get("team"), request_class="im", plan_type=user_record.get("plan_type"), channel=channel)
         else:
             say(get_inactive_message(), channel=channel)
 
 
-@app.event("app_home_opened")
-def app_home_opened_event(client, event):
+def get_home_team_id(event, context):
+    team_id = context.get("team_id") if context else None
+    return team_id or (event.get("view") or {}).get("team_id")
+
+
+def app_home_opened_event(client, event, context=None):
+    # The user record is keyed on team and user, so users_info is only needed
+    # to find the email of a user who has no record yet.
     user_id = event.get("user")
-    slack_user_info = get_slack_user_info(client, user_id)
-    slack_id = get_slack_id(slack_user_info)
-    users_id_item = get_ddb_item(users_id_table, "slack_id", slack_id)
+    team_id = get_home_team_id(event, context)
+    slack_id = f"{team_id}-{user_id}" if team_id else None
+    users_id_item = get_ddb_item(users_id_table, "slack_id", slack_id) if slack_id else None
 
     if not users_id_item:
-        email = get_email(slack_user_info)
-        users_id_item = add_new_user(slack_id, email)
+        home_stats["users_info"] += 1
+        slack_user_info = get_slack_user_info(client, user_id)
+        slack_id = get_slack_id(slack_user_info)
+        users_id_item = get_ddb_item(users_id_table, "slack_id", slack_id)
+        if not users_id_item:
+            email = get_email(slack_user_info)
+            users_id_item = add_new_user(slack_id, email)
+    cache_user_record(slack_id, users_id_item)
 
     plan_type = users_id_item.get("plan_type")
     active = users_id_item.get("active")
+    home_view_hash = get_home_view_hash(plan_type, active)
+    now = get_timestamp()
+    published_at = int(users_id_item.get("home_view_published_at", 0))
+    if users_id_item.get("home_view_hash") == home_view_hash and now - published_at < HOME_VIEW_MAX_AGE:
+        home_stats["skipped"] += 1
+        log_event("home", "app_home_opened_event unchanged", slack_id=slack_id, **home_stats)
+        return
+
     response = client.views_publish(
         user_id=user_id,
         view=get_home_view(plan_type, active)
     )
+    users_id_table.update_item(
+        Key={"slack_id": slack_id},
+        UpdateExpression="SET home_view_hash = :home_view_hash, home_view_published_at = :now",
+        ExpressionAttributeValues={":home_view_hash": home_view_hash, ":now": now},
+    )
+    home_stats["published"] += 1
+    log_event("home", "app_home_opened_event published", slack_id=slack_id, **home_stats)
 
 
-def handler(event, context):
-    logging.info(f'event: {event}')
-    logging.info(f'context: {context}')
-    headers = event.get("headers")
-    logging.info(f'headers: {headers}')
+def bridge_async_say(say, loop):
+    # The chat turn runs in a worker thread and posts through the async say on
+    # the event loop. Each post is waited for, so that reply_to_chat only marks
+    # a reply posted, and run_chat_turn only saves it, once Slack has it.
+    def sync_say(*args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(say(*args, **kwargs), loop).result()
+    return sync_say
+
+
+async def run_async_chat_turn(table, key_name, key_value, chat_record, text, say, client, **kwargs):
+    sync_say = bridge_async_say(say, asyncio.get_running_loop())
+    return await asyncio.to_thread(run_chat_turn, table, key_name, key_value, chat_record, text, sync_say, get_slack_client(client.token), **kwargs)
+
+
+async def load_user_and_chat(event, table, key_name, chat_id, new_chat=False):
+    # Neither lookup needs the other's result, so the chat is read alongside
+    # the user record; for an inactive user that read is wasted.
+    lock = get_chat_lock(chat_id)
+    await asyncio.to_thread(lock.acquire)
+    try:
+        if new_chat:
+            return lock, await asyncio.to_thread(get_user_record, event), {"chat": start_chat()}
+        user_record, chat_record = await asyncio.gather(
+            asyncio.to_thread(get_user_record, event),
+            asyncio.to_thread(load_chat, table, key_name, chat_id),
+        )
+        return lock, user_record, chat_record
+    except BaseException:
+        lock.release()
+        raise
+
 
-    if headers and "x-slack-retry-num" in headers:
-        return default_response("Ignore retry")
+async def async_app_mention_event(event, say, client):
+    thread_ts = event.get("thread_ts")
+    public_chat_id = get_public_chat_id(event)
+    lock, user_record, chat_record = await load_user_and_chat(event, public_chats_table, "public_chat_id", public_chat_id, new_chat=not thread_ts)
 
-    body = event.get("body")
-    if body:
-        body = json.loads(body)
+    try:
+        if user_record and user_record.get("active"):
+            request_class = "thread" if thread_ts else "mention"
+            logging.info(f"Loaded public chat: {public_chat_id}")
+            await run_async_chat_turn(public_chats_table, "public_chat_id", public_chat_id, chat_record, event.get("text"), say, client, team_id=event.get("team"), request_class=request_class, plan_type=user_record.get("plan_type"), thread_ts=thread_ts or event.get("ts"))
+        else:
+            await say(get_inactive_message(), thread_ts=thread_ts or event.get("ts"))
+    finally:
+        lock.release()
 
-        if body.get("challenge"):
-            return slack_challenge_response(body.get("challenge"))
 
-        if body.get("event").get("bot_id"):
-            return default_response("Ignore bot")
+async def async_message_event(event, say, client, logger):
+    log_event("ingress", "message_event", event=event)
+    channel = event.get("channel")
+    if event.get("channel_type") != "im":
+        return
+
+    private_chat_id = get_private_chat_id(event)
+    lock, user_record, chat_record = await load_user_and_chat(event, private_chats_table, "private_chat_id", private_chat_id)
+
+    try:
+        if user_record and user_record.get("active"):
+            logging.info(f"Loaded private chat: {private_chat_id}")
+            await run_async_chat_turn(private_chats_table, "private_chat_id", private_chat_id, chat_record, event.get("text"), say, client, team_id=event.get("team"), request_class="im", plan_type=user_record.get("plan_type"), channel=channel)
+        else:
+            await say(get_inactive_message(), channel=channel)
+    finally:
+        lock.release()
+
+
+async def async_app_home_opened_event(client, event, context=None):
+    await asyncio.to_thread(app_home_opened_event, get_slack_client(client.token), event, context)
+
+
+def use_shared_slack_client(context, next):
+    # Bolt builds a WebClient per request; listeners get the registry's client
+    # for the authorized token instead, shared by every event on the container
+    if context.get("token"):
+        context["client"] = get_slack_client(context["token"])
+    next()
+
+
+def get_app():
+    global app
+    if app is None:
+        from slack_bolt import App
+        from slack_bolt.adapter.aws_lambda.lambda_s3_oauth_flow import LambdaS3OAuthFlow
+        app = App(
+            process_before_response=True,
+            oauth_flow=LambdaS3OAuthFlow()
+        )
+        app.use(use_shared_slack_client)
+        app.event("app_mention")(app_mention_event)
+        app.event("message")(message_event)
+        app.event("app_home_opened")(app_home_opened_event)
+    return app
+
+
+def get_async_app():
+    # Handles events only; OAuth requests keep going through the sync app,
+    # whose S3 installation and state stores also implement the async API.
+    global async_app
+    if async_app is None:
+        from slack_bolt.async_app import AsyncApp
+        from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
+        settings = get_app().oauth_flow.settings
+        async_app = AsyncApp(
+            process_before_response=True,
+            oauth_settings=AsyncOAuthSettings(
+                client_id=settings.client_id,
+                client_secret=settings.client_secret,
+                scopes=settings.scopes,
+                user_scopes=settings.user_scopes,
+                installation_store=settings.installation_store,
+                state_store=settings.state_store,
+            )
+        )
+        async_app.event("app_mention")(async_app_mention_event)
+        async_app.event("message")(async_message_event)
+        async_app.event("app_home_opened")(async_app_home_opened_event)
+    return async_app
+
+
+def claim_event(event_id, now=None):
+    # Takes the lease on a new event, or on an in-flight one whose attempt died
+    # and let the lease run out; a reply checkpointed by that attempt is kept
+    # so the retry can post it without generating again. Completed events are
+    # remembered in-process so repeats on a warm container skip the round trip.
+    if not events_table or not event_id:
+        return EVENT_CLAIMED
+    if event_state_cache.get(event_id) == EVENT_COMPLETED:
+        return EVENT_COMPLETED
+
+    now = now or get_timestamp()
+    try:
+        response = events_table.update_item(
+            Key={"event_id": event_id},
+            UpdateExpression="SET event_state = :in_flight, lease_expires_at = :lease_expires_at, expires_at = :expires_at",
+            ConditionExpression="attribute_not_exists(event_id) OR (event_state = :in_flight AND lease_expires_at < :now)",
+            ExpressionAttributeValues={
+                ":in_flight": EVENT_IN_FLIGHT,
+                ":lease_expires_at": now + EVENT_LEASE_SECONDS,
+                ":expires_at": now + EVENT_STATE_TTL,
+                ":now": now,
+            },
+            ReturnValues="ALL_OLD",
+        )
+    except events_table.meta.client.exceptions.ConditionalCheckFailedException:
+        item = get_ddb_item(events_table, "event_id", event_id) or {}
+        state = item.get("event_state", EVENT_IN_FLIGHT)
+        if state == EVENT_COMPLETED:
+            event_state_cache.set(event_id, EVENT_COMPLETED)
+        log_event("events", "claim_event skipped", event_id=event_id, state=state)
+        return state
+
+    previous_item = response.get("Attributes") or {}
+    if previous_item.get("reply") or previous_item.get("reply_ts") or previous_item.get("turn_saved"):
+        resumed_event_replies.set(event_id, {
+            "reply": previous_item.get("reply"),
+            "posted": bool(previous_item.get("reply_posted")),
+            "channel": previous_item.get("reply_channel"),
+            "ts": previous_item.get("reply_ts"),
+            "saved": bool(previous_item.get("turn_saved")),
+        })
+    log_event("events", "claim_event", event_id=event_id, resumed=bool(previous_item))
+    return EVENT_CLAIMED
+
+
+def checkpoint_event_placeholder(event_id, channel, ts):
+    # A retry streams into this message instead of posting another placeholder
+    if not events_table or not event_id or not ts:
+        return
+    events_table.update_item(
+        Key={"event_id": event_id},
+        UpdateExpression="SET reply_channel = :channel, reply_ts = :ts",
+        ExpressionAttributeValues={":channel": channel, ":ts": ts},
+    )
+
+
+def checkpoint_event_reply(event_id, reply, posted=False):
+    # Only completed generations are checkpointed, a retry regenerates the rest
+    if not events_table or not event_id:
+        return
+    events_table.update_item(
+        Key={"event_id": event_id},
+        UpdateExpression="SET reply = :reply, reply_posted = :posted",
+        ExpressionAttributeValues={":reply": reply, ":posted": posted},
+    )
 
-        if body.get("event").get("type") not in SLACK_EVENTS:
-            return default_response("Ignore event")
 
-    slack_handler = SlackRequestHandler(app=app)
-    return slack_handler.handle(event, context)
\ No newline at end of file
+def mark_event_reply_posted(event_id):
+    # Lets a retry after a later failure, e.g. in save_chat, skip the post
+    if not events_table or not event_id:
+        return
+    events_table.update_item(
+        Key={"event_id": event_id},
+        UpdateExpression="SET reply_posted = :posted",
+        ExpressionAttributeValues={":posted": True},
+    )
+
+
+def mark_event_turn_saved(event_id):
+    # Lets a retry after a later failure skip the turn instead of saving it twice
+    if not events_table or not event_id:
+        return
+    events_table.update_item(
+        Key={"event_id": event_id},
+        UpdateExpression="SET turn_saved = :saved",
+        ExpressionAttributeValues={":saved": True},
+    )
+
+
+def complete_event(event_id):
+    if not events_table or not event_id:
+        return
+    event_state_cache.set(event_id, EVENT_COMPLETED)
+    events_table.update_item(
+        Key={"event_id": event_id},
+        UpdateExpression="SET event_state = :completed REMOVE lease_expires_at, reply, reply_posted, reply_channel, reply_ts, turn_saved",
+        ExpressionAttributeValues={":completed": EVENT_COMPLETED},
+    )
+    log_event("events", "complete_event", event_id=event_id)
+
+
+def release_event(event_id):
+    # Expire the lease instead of deleting the item so that the next retry
+    # resumes right away and still finds any checkpointed reply.
+    if not events_table or not event_id:
+        return
+    events_table.update_item(
+        Key={"event_id": event_id},
+        UpdateExpression="SET lease_expires_at = :expired",
+        ExpressionAttributeValues={":expired": 0},
+    )
+    log_event("events", "release_event", event_id=event_id)
+
+
+def run_event_once(event_id, process):
+    # Returns the claim state and, when claimed, the result of process(); a
+    # raised error or a 5xx response releases the lease for the next retry.
+    state = claim_event(event_id)
+    if state != EVENT_CLAIMED:
+        return state, None
+
+    token = current_event_id.set(event_id)
+    try:
+        result = process()
+    except Exception:
+        release_event(event_id)
+        raise
+    finally:
+        current_event_id.reset(token)
+
+    if isinstance(result, dict) and result.get("statusCode", 200) >= 500:
+        release_event(event_id)
+    else:
+        complete_event(event_id)
+    return state, result
+
+
+def get_worker_client(body):
+    bot = get_app().installation_store.find_bot(
+        enterprise_id=body.get("enterprise_id"),
+        team_id=body.get("team_id"),
+        is_enterprise_install=body.get("is_enterprise_install"),
+    )
+    token = bot.bot_token if bot else SLACK_BOT_TOKEN
+    return get_slack_client(token)
+
+
+def process_queued_event(body, client=None):
+    event = body.get("event")
+    event_type = event.get("type")
+    logging.info(f"process_queued_event: {body.get('event_id')} {event_type}")
+
+    def process():
+        worker_client = client or get_worker_client(body)
+        if SLACK_ASYNC:
+            return asyncio.run(process_async_event(event, worker_client))
+        from slack_bolt.context.say import Say
+        say = Say(client=worker_client, channel=event.get("channel"))
+
+        if event_type == "app_mention":
+            app_mention_event(event, say, worker_client)
+        elif event_type == "message":
+            message_event(event, say, worker_client, logging.getLogger())
+        else:
+            logging.warning(f"process_queued_event unsupported event type: {event_type}")
+
+    state, _ = run_event_once(body.get("event_id"), process)
+    if state != EVENT_CLAIMED:
+        logging.info(f"process_queued_event skipping {state} event: {body.get('event_id')}")
+
+
+async def process_async_event(event, client):
+    from slack_sdk.web.async_client import AsyncWebClient
+    from slack_bolt.context.say.async_say import AsyncSay
+    async_client = AsyncWebClient(token=client.token)
+    say = AsyncSay(client=async_client, channel=event.get("channel"))
+
+    if event.get("type") == "app_mention":
+        await async_app_mention_event(event, say, async_client)
+    elif event.get("type") == "message":
+        await async_message_event(event, say, async_client, logging.getLogger())
+    else:
+        logging.warning(f"process_async_event unsupported event type: {event.get('type')}")
+
+
+def process_queued_events(bodies, concurrency=WORKER_CONCURRENCY):
+    # Events of a batch run side by side so that one slow generation does not
+    # hold up the others; turns in the same chat still take the chat lock.
+    # Returns the error raised by each event, None if it was processed.
+    def process(body):
+        try:
+            process_queued_event(body)
+        except Exception as e:
+            return e
+
+    if len(bodies) <= 1 or concurrency <= 1:
+        return [process(body) for body in bodies]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(bodies))) as executor:
+        # Each event gets its own copy of the context, e.g. current_deadline
+        futures = [executor.submit(contextvars.copy_context().run, process, body) for body in bodies]
+        return [future.result() for future in futures]
+
+
+def drain_event_queue(queue, batch_size=WORKER_BATCH_SIZE):
+    processed = 0
+    failed = []
+    while True:
+        messages = queue.receive(batch_size)
+        if not messages:
+            break
+        errors = process_queued_events([body for _, body in messages])
+        for (handle, body), error in zip(messages, errors):
+            if error:
+                logging.error(f"drain_event_queue error: {error}")
+                failed.append(handle)
+            else:
+                queue.delete(handle)
+            processed += 1
+    # Released only now, so that this drain does not pick them up again
+    for handle in failed:
+        queue.release(handle)
+    return processed
+
+
+def worker_handler(event, context):
+    current_deadline.set(get_deadline(context))
+    records = event.get("Records")
+    if records is None:
+        if not event_queue:
+            return default_response("No event queue configured")
+        processed = drain_event_queue(event_queue)
+        logging.info(f"worker_handler drained {processed} events")
+        return {"batchItemFailures": []}
+
+    failures = []
+    errors = process_queued_events([json.loads(record["body"]) for record in records])
+    for record, error in zip(records, errors):
+        if error:
+            logging.error(f"worker_handler error processing {record.get('messageId')}: {error}")
+            failures.append({"itemIdentifier": record.get("messageId")})
+            if isinstance(event_queue, SqsEventQueue):
+                event_queue.release(record.get("receiptHandle"))
+    log_event("clients", "worker_handler pools", stats=lambda: dict(get_pool_stats()))
+    return {"batchItemFailures": failures}
+
+
+def reject_request(reason, response):
+    rejection_counters[reason] += 1
+    log_event("ingress", "reject_request", reason=reason, counters=lambda: dict(rejection_counters))
+    return response
+
+
+def get_raw_body(event):
+    body = event.get("body") or ""
+    if event.get("isBase64Encoded"):
+        return base64.b64decode(body).decode("utf-8")
+    return body
+
+
+def get_request_method(event):
+    request_context = event.get("requestContext", {})
+    return request_context.get("http", {}).get("method") or request_context.get("httpMethod")
+
+
+def dispatch_to_bolt(body, headers, event, context):
+    # The body has already been verified and parsed; Bolt only skips its own
+    # verification and parsing for socket mode requests, which accept a dict body.
+    # With SLACK_ASYNC the async app handles the event on an event loop that
+    # lives for this invocation.
+    from slack_bolt.adapter.aws_lambda.handler import to_aws_response
+    if SLACK_ASYNC:
+        from slack_bolt.request.async_request import AsyncBoltRequest
+        bolt_request = AsyncBoltRequest(body=body, headers=headers, mode="socket_mode")
+    else:
+        from slack_bolt.request import BoltRequest
+        bolt_request = BoltRequest(body=body, headers=headers, mode="socket_mode")
+    if context:
+        bolt_request.context["aws_lambda_function_name"] = context.function_name
+        bolt_request.context["aws_lambda_invoked_function_arn"] = context.invoked_function_arn
+    bolt_request.context["lambda_request"] = event
+    if SLACK_ASYNC:
+        return to_aws_response(asyncio.run(get_async_app().async_dispatch(bolt_request)))
+    return to_aws_response(get_app().dispatch(bolt_request))
+
+
+def handler(event, context):
+    log_event("ingress", "handler", request_id=getattr(context, "aws_request_id", None), path=event.get("rawPath") or event.get("path"), body_length=len(event.get("body") or ""))
+    current_deadline.set(get_deadline(context))
+    headers = event.get("headers") or {}
+
+    raw_body = get_raw_body(event)
+    if get_request_method(event) == "GET" or not raw_body:
+        from slack_bolt.adapter.aws_lambda import SlackRequestHandler
+        return SlackRequestHandler(app=get_app()).handle(event, context)
+
+    if not slack_signature_is_valid(headers, raw_body):
+        return reject_request("signature", {"statusCode": 401, "body": "Invalid signature"})
+
+    # Without the idempotency store a retry cannot tell whether the first
+    # attempt is still running, so retries are dropped as before.
+    if "x-slack-retry-num" in headers and not events_table:
+        return reject_request("retry", default_response("Ignore retry"))
+
+    if not headers.get("content-type", "application/json").startswith("application/json"):
+        from slack_bolt.adapter.aws_lambda import SlackRequestHandler
+        return SlackRequestHandler(app=get_app()).handle(event, context)
+
+    body = json.loads(raw_body)
+    if body.get("type") == "url_verification":
+        return slack_challenge_response(body.get("challenge"))
+
+    slack_event = body.get("event") or {}
+    if slack_event.get("bot_id"):
+        return reject_request("bot", default_response("Ignore bot"))
+
+    if slack_event.get("type") not in SLACK_EVENTS:
+        return reject_request("event_type", default_response("Ignore event"))
+
+    if event_queue and slack_event.get("type") in QUEUED_EVENTS:
+        event_queue.send(body)
+        return default_response("Queued event")
+
+    state, response = run_event_once(body.get("event_id"), lambda: dispatch_to_bolt(body, headers, event, context))
+    if state == EVENT_COMPLETED:
+        return reject_request(f"duplicate_{state}", default_response("Ignore duplicate"))
+    if state != EVENT_CLAIMED:
+        # No X-Slack-No-Retry while in flight: if this attempt dies, a later
+        # retry arriving after its lease runs out resumes the event
+        return reject_request(f"duplicate_{state}", {"statusCode": 200, "body": json.dumps({"message": "Event in flight"})})
+    return response
\ No newline at end of file
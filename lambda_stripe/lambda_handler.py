@@ -1,22 +1,35 @@
 import os
 import json
-import boto3
 import base64
 import hmac
 import hashlib
 import logging
+import random
+import time
 from cgi import parse_header
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from structured_log import configure_logging, log_event
+from clients import get_boto3_resource
+from expiry_scheduler import DynamoExpiryScheduler
 
 
+configure_logging()
 log = logging.getLogger()
-log.setLevel(logging.INFO)
 
 STRIPE_SECRET = os.environ.get('STRIPE_SECRET')
-
-ddb = boto3.resource('dynamodb')
+# TransactWriteItems takes at most 100 items
+ACTIVATION_TRANSACTION_SIZE = min(int(os.environ.get('ACTIVATION_TRANSACTION_SIZE', '100')), 100)
+ACTIVATION_CONCURRENCY = int(os.environ.get('ACTIVATION_CONCURRENCY', '4'))
+ACTIVATION_ATTEMPTS = int(os.environ.get('ACTIVATION_ATTEMPTS', '3'))
+ACTIVATION_BACKOFF_BASE = float(os.environ.get('ACTIVATION_BACKOFF_BASE', '0.1'))
+ACTIVATION_BACKOFF_MAX = float(os.environ.get('ACTIVATION_BACKOFF_MAX', '2.0'))
+
+ddb = get_boto3_resource('dynamodb')
 users_id_table = ddb.Table(os.environ['DDB_USERS_ID'])
 users_email_table = ddb.Table(os.environ['DDB_USERS_EMAIL'])
+trial_expiry_scheduler = DynamoExpiryScheduler(ddb.Table(os.environ['DDB_TRIAL_TIMERS'])) if os.environ.get('DDB_TRIAL_TIMERS') else None
 
 
 def get_json_payload(event):
@@ -209,33 +222,162 @@ def get_ddb_item(table, key_name, key_value):
     response = table.get_item(
         Key={key_name: key_value}
     )
-    logging.info(f"get_ddb_item response: {response}")
+    log_event("ddb", "get_ddb_item", table=table.name, key=key_value, found="Item" in response)
     return response.get("Item")
 
 
-def get_slack_ids(email):
-    users_email_ddb_item = get_ddb_item(users_email_table, 'email', email)
-    return users_email_ddb_item.get('workspaces', [])
+def get_event_id(json_dict):
+    """
+    Get event id from Stripe JSON payload
+
+    Args:
+        json_dict (dict): Stripe JSON payload
+    Returns:
+        str: Stripe event id, e.g. "evt_1NG8Du2eZvKYlo2CUI79vXWy"
+    """
+    return json_dict.get("id", "")
 
 
-def update_users_id_table(slack_ids, stripe_payment_timestamp, email):
-    for slack_id in slack_ids:
-        response = users_id_table.update_item(
-            Key={"slack_id": slack_id},
-            UpdateExpression='SET active = :activeValue, plan_type = :planTypeValue, payment_timestamp = :paymentTimestampValue, email = :emailValue',
-            ExpressionAttributeValues={
+def get_slack_ids(email):
+    users_email_ddb_item = get_ddb_item(users_email_table, 'email', email)
+    # Legacy items hold workspaces as a list that may repeat a slack id, and a
+    # transaction may not touch an item twice. Sorted so retries chunk the same way.
+    return sorted(set(users_email_ddb_item.get('workspaces', [])))
+
+
+def get_activation_update(slack_id, stripe_payment_timestamp, email):
+    return {
+        'Update': {
+            'TableName': users_id_table.name,
+            'Key': {"slack_id": slack_id},
+            'UpdateExpression': 'SET active = :activeValue, plan_type = :planTypeValue, payment_timestamp = :paymentTimestampValue, email = :emailValue REMOVE trial_expires_at',
+            'ExpressionAttributeValues': {
                 ':activeValue': True,
                 ':planTypeValue': 'paid',
                 ':paymentTimestampValue': stripe_payment_timestamp,
                 ':emailValue': email
-            }
-        )
-        log.info(f"update_users_id_table response: {response}")
-        
+            },
+        }
+    }
+
+
+def get_client_request_token(event_id, slack_ids):
+    """
+    Idempotency token of one activation transaction, so that Stripe resending
+    an event within ten minutes does not apply a chunk twice. The chunk's
+    slack ids are part of it, so a chunk whose workspaces changed between
+    resends is a new transaction rather than a parameter mismatch.
+
+    Args:
+        event_id (str): Stripe event id
+        slack_ids (list): Slack ids of the chunk
+    Returns:
+        str: Token of at most 36 characters, or None without an event id
+    """
+    if not event_id:
+        return None
+    return hashlib.sha256(f'{event_id}#{",".join(slack_ids)}'.encode()).hexdigest()[:36]
+
+
+def get_activation_backoff(attempt, jitter=random.random):
+    """
+    Full jitter exponential backoff, so that retries wait for a conflicting
+    write to finish instead of colliding with it again
+
+    Args:
+        attempt (int): One based attempt number that failed
+        jitter (callable): Returns a float in [0, 1)
+    Returns:
+        float: Seconds to wait before the next attempt
+    """
+    return jitter() * min(ACTIVATION_BACKOFF_MAX, ACTIVATION_BACKOFF_BASE * 2 ** (attempt - 1))
+
+
+def activate_workspaces(slack_ids, stripe_payment_timestamp, email, client_request_token=None, attempts=ACTIVATION_ATTEMPTS, sleep=time.sleep):
+    """
+    Activate workspaces in one transaction, so that either all or none are paid
+
+    Args:
+        slack_ids (list): At most ACTIVATION_TRANSACTION_SIZE slack ids
+        stripe_payment_timestamp (int): Epoch payment timestamp
+        email (str): Email the payment was made with
+        client_request_token (str): Idempotency token of the transaction
+        attempts (int): Tries when the transaction conflicts with another write
+        sleep (callable): Blocks for a number of seconds between attempts
+    Returns:
+        str: "activated" or "failed"
+    """
+    client = users_id_table.meta.client
+    kwargs = {'TransactItems': [get_activation_update(slack_id, stripe_payment_timestamp, email) for slack_id in slack_ids]}
+    if client_request_token:
+        kwargs['ClientRequestToken'] = client_request_token
+    for attempt in range(1, attempts + 1):
+        try:
+            client.transact_write_items(**kwargs)
+            return "activated"
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            log.warning(f'activate_workspaces attempt {attempt} cancelled: {reasons}')
+        except client.exceptions.TransactionInProgressException as e:
+            log.warning(f'activate_workspaces attempt {attempt} failed: {e}')
+        except ClientError as e:
+            # Not worth retrying, e.g. a validation error; the other chunks go ahead
+            log.error(f'activate_workspaces failed: {e}')
+            return "failed"
+        if attempt < attempts:
+            sleep(get_activation_backoff(attempt))
+    return "failed"
+
+
+def update_users_id_table(slack_ids, stripe_payment_timestamp, email, event_id=None, transaction_size=ACTIVATION_TRANSACTION_SIZE, concurrency=ACTIVATION_CONCURRENCY):
+    """
+    Activate every workspace of a payment, in chunks of one transaction each
+    that are written concurrently
+
+    Args:
+        slack_ids (list): Slack ids of the email's workspaces
+        stripe_payment_timestamp (int): Epoch payment timestamp
+        email (str): Email the payment was made with
+        event_id (str): Stripe event id, making each transaction idempotent
+        transaction_size (int): Workspaces per transaction
+        concurrency (int): Transactions in flight
+    Returns:
+        dict: "activated" or "failed" by slack id
+    """
+    chunks = [slack_ids[i:i + transaction_size] for i in range(0, len(slack_ids), transaction_size)]
+    activate = lambda chunk: activate_workspaces(chunk, stripe_payment_timestamp, email, get_client_request_token(event_id, chunk))
+    if len(chunks) > 1 and concurrency > 1:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as executor:
+            outcomes = list(executor.map(activate, chunks))
+    else:
+        outcomes = [activate(chunk) for chunk in chunks]
+
+    report = {slack_id: outcome for chunk, outcome in zip(chunks, outcomes) for slack_id in chunk}
+    cancel_trial_timers([slack_id for slack_id, outcome in report.items() if outcome == "activated"])
+    log_event("ddb", "update_users_id_table", email=email, transactions=len(chunks), report=report)
+    return report
+
+def cancel_trial_timers(slack_ids):
+    """
+    Cancel the trial timers of paid workspaces, so that the expiry stream
+    does not handle them. A timer left behind is harmless, since trial
+    expiry only deactivates workspaces still on a trial.
+
+    Args:
+        slack_ids (list): Slack ids of activated workspaces
+    """
+    if not trial_expiry_scheduler:
+        return
+    for slack_id in slack_ids:
+        try:
+            trial_expiry_scheduler.cancel(slack_id)
+        except ClientError as e:
+            log.warning(f'cancel_trial_timers {slack_id} failed: {e}')
+
+
 def handler(event, _context):
-    log.info(f'event: {event}')
+    log_event("ingress", "stripe event", event=event)
     headers = event.get('headers')
-    log.info(f'headers: {event}')
 
     # Input validation
     try:
@@ -265,13 +407,19 @@ def handler(event, _context):
         json_dict = json.loads(json_payload)
         email = get_email(json_dict)
         stripe_payment_timestamp = get_payment_timestamp(json_dict)
+        event_id = get_event_id(json_dict)
         slack_ids = get_slack_ids(email)
 
         log.info(f'Stripe payment timestamp: {stripe_payment_timestamp}')
         log.info(f'User email: {email}')
         log.info(f'Slack workspaces: {email}')
 
-        update_users_id_table(slack_ids, stripe_payment_timestamp, email)
+        report = update_users_id_table(slack_ids, stripe_payment_timestamp, email, event_id)
+        failed = [slack_id for slack_id, outcome in report.items() if outcome != 'activated']
+        if failed:
+            # Stripe retries the event, activating a workspace again is harmless
+            log.error(f'500 Internal Server Error - workspaces not activated: {failed}')
+            return {'statusCode': 500, 'body': json.dumps({'activated': len(report) - len(failed), 'failed': failed})}
         return {'statusCode': 202, 'body': 'Stripe payment event successfully processed'}
 
     except Exception as e:
@@ -0,0 +1,104 @@
+import os
+import sys
+import hmac
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from dotenv import load_dotenv
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', dest='config')
+parser.add_argument('--function', dest='function', default='lambda_slack', choices=['lambda_slack', 'lambda_cron', 'lambda_stripe'])
+parser.add_argument('--top', dest='top', type=int, default=15)
+args = parser.parse_args()
+
+load_dotenv(dotenv_path='.env')
+load_dotenv(dotenv_path=args.config)
+
+SLACK_SIGNING_SECRET = os.environ.get('SLACK_SIGNING_SECRET') or 'cold-start'
+
+
+def get_challenge_event(signing_secret):
+    """
+    Build a URL verification challenge signed the way Slack signs requests,
+    so the handler answers it instead of rejecting it
+
+    Args:
+        signing_secret (str): Slack signing secret the handler checks against
+    Returns:
+        dict: Lambda function URL event
+    """
+    body = json.dumps({"type": "url_verification", "challenge": "cold-start"})
+    timestamp = str(int(time.time()))
+    base_string = f"v0:{timestamp}:{body}".encode()
+    signature = "v0=" + hmac.new(signing_secret.encode(), base_string, hashlib.sha256).hexdigest()
+    return {"headers": {"x-slack-request-timestamp": timestamp, "x-slack-signature": signature}, "body": body}
+
+
+# Imports the handler the way the Lambda runtime does, then times the first
+# URL verification challenge
+COLD_START_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import lambda_handler
+imported = time.perf_counter()
+status = None
+if hasattr(lambda_handler, "slack_challenge_response"):
+    status = lambda_handler.handler({get_challenge_event(SLACK_SIGNING_SECRET)!r}, None).get("statusCode")
+handled = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - start) * 1000, "challenge_ms": (handled - imported) * 1000, "challenge_status": status, "modules": sorted(sys.modules)}}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    Parse -X importtime output into total import time per top-level package
+
+    Args:
+        stderr (str): stderr of a python -X importtime run
+    Returns:
+        dict: Self import time in microseconds summed per top-level package
+    """
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        self_us, _, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        if not self_us.isdigit():
+            continue
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    return packages
+
+
+def main():
+    function_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.function)
+    common_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda_common')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([function_dir, common_dir]), SLACK_SIGNING_SECRET=SLACK_SIGNING_SECRET)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', COLD_START_SCRIPT],
+        cwd=function_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        sys.exit(result.returncode)
+
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    packages = parse_importtime(result.stderr)
+
+    print(f"{args.function}: import {timings['import_ms']:.1f} ms, first challenge {timings['challenge_ms']:.1f} ms (status {timings['challenge_status']})")
+    heavy = [name for name in ('boto3', 'botocore', 'openai', 'slack_sdk', 'slack_bolt') if name in timings['modules']]
+    print(f"heavy packages loaded: {', '.join(heavy) or 'none'}")
+    print(f"{'package':<30} {'import ms':>10}")
+    for package, self_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{package:<30} {self_us / 1000:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
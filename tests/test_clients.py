@@ -0,0 +1,98 @@
+import json
+import threading
+import pytest
+import clients
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@pytest.fixture(scope='function')
+def registry(monkeypatch):
+    monkeypatch.setattr(clients, "clients", {})
+    monkeypatch.setattr(clients, "registry_stats", clients.Counter())
+    monkeypatch.setattr(clients, "http_pool_stats", clients.Counter())
+
+
+def test_get_client_builds_once_and_counts_registry_hits(registry):
+    built = []
+    factory = lambda: built.append(object()) or built[-1]
+    client = clients.get_client("fake", factory)
+    assert clients.get_client("fake", factory) is client
+    assert clients.get_client("fake", factory) is client
+    assert len(built) == 1
+    assert clients.registry_stats == {"fake.created": 1, "fake.registry_hits": 2}
+
+
+def test_get_client_factory_can_build_wrapped_clients(registry):
+    wrapper = clients.get_client("wrapper", lambda: [clients.get_client("wrapped", object)])
+    assert wrapper == [clients.get_client("wrapped", object)]
+
+
+def test_get_boto3_resource_is_tuned_and_shared(registry):
+    dynamodb = clients.get_boto3_resource("dynamodb")
+    assert clients.get_boto3_resource("dynamodb") is dynamodb
+    config = dynamodb.meta.client.meta.config
+    assert config.max_pool_connections == clients.AWS_MAX_POOL_CONNECTIONS
+    assert config.tcp_keepalive
+    assert clients.get_boto3_client("sqs") is clients.get_boto3_client("sqs")
+
+
+def test_get_slack_client_per_token(registry):
+    client = clients.get_slack_client("xoxb-1")
+    assert clients.get_slack_client("xoxb-1") is client
+    assert clients.get_slack_client("xoxb-2") is not client
+    assert not any("xoxb" in name for name in clients.registry_stats)
+
+
+def test_get_http_client_limits(registry):
+    pytest.importorskip("httpx")
+    http_client = clients.get_http_client()
+    assert clients.get_http_client() is http_client
+    assert clients.registry_stats["httpx.openai.registry_hits"] == 1
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def reply(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        body = json.dumps({"TableNames": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-amz-json-1.0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = reply
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='function')
+def keep_alive_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_pool_stats_counts_reused_connections(registry, keep_alive_url):
+    pytest.importorskip("httpx")
+    import boto3
+
+    def factory():
+        return boto3.client("dynamodb", endpoint_url=keep_alive_url, config=clients.get_boto3_config())
+    dynamodb = clients.get_client("boto3.client.dynamodb", factory)
+    http_client = clients.get_http_client()
+    for _ in range(3):
+        dynamodb.list_tables()
+        http_client.get(keep_alive_url)
+
+    stats = clients.get_pool_stats()
+    assert stats["boto3.client.dynamodb.connections"] == 1
+    assert stats["boto3.client.dynamodb.requests"] == 3
+    assert stats["boto3.client.dynamodb.reused"] == 2
+    assert stats["httpx.openai.connections"] == 1
+    assert stats["httpx.openai.requests"] == 3
+    assert stats["httpx.openai.reused"] == 2
@@ -0,0 +1,41 @@
+import pytest
+from expiry_scheduler import ExpiryScheduler, DynamoExpiryScheduler, LocalExpiryScheduler
+
+
+def test_local_expiry_scheduler_orders_and_cancels():
+    scheduler = LocalExpiryScheduler(clock=lambda: 100)
+    scheduler.schedule("late", 90)
+    scheduler.schedule("early", 10)
+    scheduler.schedule("future", 200)
+    scheduler.schedule("cancelled", 20)
+    scheduler.cancel("cancelled")
+    scheduler.schedule("moved", 30)
+    scheduler.schedule("moved", 150)
+
+    assert scheduler.pop_expired_keys() == ["early", "late"]
+    assert scheduler.pop_expired_keys() == []
+    assert scheduler.pop_expired_keys(now=200) == ["moved", "future"]
+
+
+def test_dynamo_expiry_scheduler_writes_ttl_items(dynamodb_mock):
+    table = dynamodb_mock.create_table(
+        TableName='test_trial_timers',
+        KeySchema=[{'AttributeName': 'timer_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'timer_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    scheduler = DynamoExpiryScheduler(table)
+    scheduler.schedule("T1-U1", 1709251200)
+    scheduler.schedule("T1-U2", 1709251200)
+    scheduler.cancel("T1-U2")
+
+    assert table.scan()["Items"] == [{"timer_id": "T1-U1", "expires_at": 1709251200}]
+
+
+def test_expiry_scheduler_backends_must_implement_every_method():
+    class ScheduleOnly(ExpiryScheduler):
+        def schedule(self, key, expires_at):
+            pass
+
+    with pytest.raises(TypeError):
+        ScheduleOnly()
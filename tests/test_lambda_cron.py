@@ -0,0 +1,282 @@
+import os
+import pytest
+from datetime import datetime, timedelta
+from freezegun import freeze_time
+from lambda_cron import lambda_handler
+from trials import get_trial_expiry_bucket
+from expiry_scheduler import DynamoExpiryScheduler
+from home_view import get_home_view_hash
+from slack_notifier import SlackNotifier
+
+
+NOW = datetime(2024, 3, 1)
+
+
+@pytest.fixture(scope='function')
+def users_id_table(dynamodb_mock, monkeypatch):
+    table = dynamodb_mock.create_table(
+        TableName='test_users_id',
+        KeySchema=[{'AttributeName': 'slack_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'slack_id', 'AttributeType': 'S'},
+            {'AttributeName': 'plan_type', 'AttributeType': 'S'},
+            {'AttributeName': 'trial_expires_at', 'AttributeType': 'S'},
+        ],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'plan_type_index',
+            'KeySchema': [{'AttributeName': 'plan_type', 'KeyType': 'HASH'}, {'AttributeName': 'slack_id', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'},
+        }, {
+            'IndexName': 'trial_expiry_index',
+            'KeySchema': [{'AttributeName': 'trial_expires_at', 'KeyType': 'HASH'}, {'AttributeName': 'slack_id', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['slack_install_timestamp']},
+        }],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    monkeypatch.setattr(lambda_handler, "users_id_table", table)
+    return table
+
+
+@pytest.fixture(scope='function')
+def checkpoints_table(dynamodb_mock, monkeypatch):
+    table = dynamodb_mock.create_table(
+        TableName='test_cron_checkpoints',
+        KeySchema=[{'AttributeName': 'checkpoint_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'checkpoint_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    monkeypatch.setattr(lambda_handler, "checkpoints_table", table)
+    return table
+
+
+def add_users(table, count, plan_type='trial', days_ago=10, start=0, indexed=True):
+    install_timestamp = round((NOW - timedelta(days=days_ago)).timestamp())
+    with table.batch_writer() as batch:
+        for i in range(start, start + count):
+            item = {
+                'slack_id': f'T{i:07d}-U0001',
+                'email': f'user{i}@example.com',
+                'active': True,
+                'plan_type': plan_type,
+                'slack_install_timestamp': install_timestamp,
+            }
+            if indexed and plan_type == 'trial':
+                item['trial_expires_at'] = get_trial_expiry_bucket(install_timestamp, lambda_handler.FREE_TRIAL_DAYS)
+            batch.put_item(Item=item)
+
+
+def count_active(table):
+    return sum(1 for item in table.scan()['Items'] if item['active'])
+
+
+# moto stops paging once the ExclusiveStartKey item has left the sparse index,
+# which DynamoDB does not, so expiry index sweeps use pages larger than a bucket
+# and paging is covered by the plan_type_index backfill.
+def test_sweep_trials_reads_only_due_buckets_and_flips_only_active(monkeypatch, users_id_table):
+    monkeypatch.setattr(lambda_handler, "SWEEP_PAGE_SIZE", 50)
+    add_users(users_id_table, 30)
+    add_users(users_id_table, 20, days_ago=9, start=30)
+    add_users(users_id_table, 10, days_ago=2, start=50)
+    add_users(users_id_table, 5, plan_type='paid', start=60)
+
+    stats, finished = lambda_handler.sweep_trials('run', NOW)
+    assert finished
+    assert stats['deactivated'] == 50
+    assert stats['read'] == 50
+    assert count_active(users_id_table) == 15
+
+    item = users_id_table.get_item(Key={'slack_id': 'T0000000-U0001'})['Item']
+    assert item == {
+        'slack_id': 'T0000000-U0001',
+        'email': 'user0@example.com',
+        'active': False,
+        'plan_type': 'trial',
+        'slack_install_timestamp': item['slack_install_timestamp'],
+    }
+
+
+def test_deactivate_user_skips_users_who_paid_since_the_read(users_id_table):
+    add_users(users_id_table, 1)
+    users_id_table.update_item(Key={'slack_id': 'T0000000-U0001'}, UpdateExpression='SET plan_type = :paid', ExpressionAttributeValues={':paid': 'paid'})
+    assert lambda_handler.deactivate_user({'slack_id': 'T0000000-U0001'}) == 'skipped'
+    assert users_id_table.get_item(Key={'slack_id': 'T0000000-U0001'})['Item']['active']
+
+
+def test_sweep_resumes_from_checkpoint(monkeypatch, users_id_table, checkpoints_table):
+    monkeypatch.setattr(lambda_handler, "SWEEP_PAGE_SIZE", 10)
+    add_users(users_id_table, 45, indexed=False)
+    checks = iter([False, False, True])
+
+    stats, finished = lambda_handler.backfill_trials('run', NOW, out_of_time=lambda: next(checks))
+    assert not finished
+    assert stats['deactivated'] == 20
+
+    stats, finished = lambda_handler.backfill_trials('run', NOW)
+    assert finished
+    assert stats['resumed'] == 1
+    assert stats['deactivated'] == 25
+    assert count_active(users_id_table) == 0
+
+    # A finished run is not swept again, a new run starts from the beginning
+    assert lambda_handler.backfill_trials('run', NOW)[0]['pages'] == 0
+    assert lambda_handler.backfill_trials('next-run', NOW)[0]['pages'] > 0
+    assert lambda_handler.sweep_trials('run', NOW)[0]['pages'] == lambda_handler.SWEEP_LOOKBACK_DAYS + 1
+
+
+def test_backfill_trials_indexes_legacy_trials(users_id_table):
+    add_users(users_id_table, 40, indexed=False)
+    add_users(users_id_table, 10, days_ago=2, start=40, indexed=False)
+    stats, finished = lambda_handler.backfill_trials('run', NOW, total_segments=4, concurrency=4)
+    assert finished
+    assert count_active(users_id_table) == 10
+
+    stats, finished = lambda_handler.sweep_trials('run', NOW + timedelta(days=6))
+    assert stats['deactivated'] == 10
+    assert count_active(users_id_table) == 0
+
+
+def test_handler_reports_sweep(users_id_table):
+    add_users(users_id_table, 3, days_ago=7.5)
+    # The clock is read per invocation, not once per container
+    with freeze_time(NOW - timedelta(days=1)):
+        assert lambda_handler.handler({}, None)['ongoing'] == 3
+    with freeze_time(NOW):
+        assert lambda_handler.handler({}, None) == {'run_id': '2024-03-01', 'finished': True, 'pages': lambda_handler.SWEEP_LOOKBACK_DAYS + 1, 'read': 3, 'deactivated': 3}
+
+
+def test_handler_backfills_legacy_trials_before_sweeping(users_id_table, checkpoints_table):
+    add_users(users_id_table, 3, indexed=False)
+    add_users(users_id_table, 2, days_ago=2, start=3, indexed=False)
+    with freeze_time(NOW):
+        stats = lambda_handler.handler({}, None)
+    assert stats['finished'] and stats['deactivated'] == 3 and stats['backfilled'] == 2
+    assert count_active(users_id_table) == 2
+
+    # Once finished, the backfill is not repeated, even after its checkpoints expire
+    for item in checkpoints_table.scan()['Items']:
+        if item['checkpoint_id'] != lambda_handler.TRIAL_BACKFILL_MARKER_ID:
+            checkpoints_table.delete_item(Key={'checkpoint_id': item['checkpoint_id']})
+    with freeze_time(NOW + timedelta(days=6)):
+        stats = lambda_handler.handler({}, None)
+    assert stats['finished'] and stats['deactivated'] == 2
+    assert stats['read'] == 2 and 'indexed' not in stats
+
+
+def ttl_remove_record(slack_id, principal_id="dynamodb.amazonaws.com"):
+    return {
+        "eventName": "REMOVE",
+        "userIdentity": {"type": "Service", "principalId": principal_id},
+        "dynamodb": {"Keys": {"timer_id": {"S": slack_id}}},
+    }
+
+
+def test_expiry_stream_handler_deactivates_expired_timers(monkeypatch, users_id_table):
+    monkeypatch.setattr(lambda_handler, "trial_expiry_scheduler", DynamoExpiryScheduler(None))
+    add_users(users_id_table, 3)
+    event = {"Records": [
+        ttl_remove_record("T0000000-U0001"),
+        ttl_remove_record("T0000001-U0001"),
+        {"eventName": "REMOVE", "dynamodb": {"Keys": {"timer_id": {"S": "T0000002-U0001"}}}},
+    ]}
+
+    assert lambda_handler.expiry_stream_handler(event, None) == {"deactivated": 2}
+    assert count_active(users_id_table) == 1
+    # Replayed stream records are harmless
+    assert lambda_handler.expiry_stream_handler(event, None) == {"skipped": 2}
+
+
+class FakeSlackClient:
+    def __init__(self):
+        self.calls = []
+
+    def api_call(self, method, json=None):
+        self.calls.append((method, json))
+
+
+def get_notifier(client, rates=None, deadline=None):
+    rates = rates or {'chat.postMessage': 60, 'views.publish': 100}
+    return SlackNotifier(lambda team_id: client, rates=rates, deadline=deadline, clock=lambda: 0, sleep=lambda seconds: None)
+
+
+def test_sweep_notifies_expired_and_expiring_trials(users_id_table):
+    add_users(users_id_table, 2)
+    add_users(users_id_table, 3, days_ago=6, start=2)
+    client = FakeSlackClient()
+    notifier = get_notifier(client)
+
+    stats, finished = lambda_handler.sweep_trials('run', NOW, notifier=notifier)
+    assert finished and stats['deactivated'] == 2
+    stats, finished = lambda_handler.remind_trials('run', NOW, notifier)
+    assert finished and stats['reminded'] == 3
+    assert sorted((method, json.get('channel') or json.get('user_id')) for method, json in client.calls) == [
+        ('chat.postMessage', 'U0001'),
+    ] * 5 + [('views.publish', 'U0001')] * 2
+    assert notifier.stats == {'sent': 7}
+    item = users_id_table.get_item(Key={'slack_id': 'T0000000-U0001'})['Item']
+    assert item['home_view_hash'] == get_home_view_hash('trial', False)
+    assert users_id_table.get_item(Key={'slack_id': 'T0000002-U0001'})['Item']['trial_notice'] == '2024-03-02'
+
+    # Each user is reminded once
+    stats, finished = lambda_handler.remind_trials('next-run', NOW, notifier)
+    assert stats['skipped'] == 3
+    assert len(client.calls) == 7
+
+
+def test_remind_trials_retries_reminders_that_were_not_sent(users_id_table):
+    from slack_sdk.errors import SlackApiError
+    from slack_sdk.web import SlackResponse
+    add_users(users_id_table, 2, days_ago=6)
+
+    class FailingSlackClient(FakeSlackClient):
+        def api_call(self, method, json=None):
+            response = SlackResponse(client=self, http_verb="POST", api_url=method, req_args={}, data={"ok": False, "error": "fatal_error"}, headers={}, status_code=500)
+            raise SlackApiError("fatal_error", response)
+
+    stats, finished = lambda_handler.remind_trials('run', NOW, get_notifier(FailingSlackClient()))
+    assert finished and stats['failed'] == 2 and 'reminded' not in stats
+    assert all('trial_notice' not in item for item in users_id_table.scan()['Items'])
+
+    client = FakeSlackClient()
+    stats, finished = lambda_handler.remind_trials('next-run', NOW, get_notifier(client))
+    assert stats['reminded'] == 2
+    assert len(client.calls) == 2
+
+
+def test_sweep_defers_notifications_past_the_deadline(users_id_table, checkpoints_table):
+    add_users(users_id_table, 3)
+    client = FakeSlackClient()
+    notifier = get_notifier(client, rates={'chat.postMessage': 2, 'views.publish': 100}, deadline=0)
+    # One workspace has used up its messages for the minute
+    assert notifier.acquire('T0000002', 'chat.postMessage') and notifier.acquire('T0000002', 'chat.postMessage')
+
+    stats, finished = lambda_handler.sweep_trials('run', NOW, notifier=notifier)
+    assert not finished
+    assert stats['deactivated'] == 2 and stats['deferred'] == 1
+    assert users_id_table.get_item(Key={'slack_id': 'T0000002-U0001'})['Item']['active']
+
+    # The page was not checkpointed, so the resumed run picks up the deferred user
+    stats, finished = lambda_handler.sweep_trials('run', NOW, notifier=get_notifier(client))
+    assert finished and stats['deactivated'] == 1
+    assert count_active(users_id_table) == 0
+    assert [method for method, _ in client.calls].count('chat.postMessage') == 3
+
+
+# Loading 100k users into moto takes several minutes
+@pytest.mark.slow
+@pytest.mark.skipif(not os.environ.get("RUN_SLOW_TESTS"), reason="set RUN_SLOW_TESTS=1 to sweep 100k users")
+def test_sweep_trials_at_scale(monkeypatch, users_id_table, checkpoints_table):
+    monkeypatch.setattr(lambda_handler, "SWEEP_PAGE_SIZE", 10000)
+    add_users(users_id_table, 100000, days_ago=10, indexed=False)
+    add_users(users_id_table, 1000, days_ago=2, start=100000, indexed=False)
+    checks = iter([False] * 5 + [True])
+
+    first_stats, finished = lambda_handler.backfill_trials('run', NOW, out_of_time=lambda: next(checks))
+    assert not finished
+    stats, finished = lambda_handler.backfill_trials('run', NOW)
+    assert finished
+    assert first_stats['deactivated'] + stats['deactivated'] == 100000
+    assert first_stats['backfilled'] + stats['backfilled'] == 1000
+
+    # The nightly sweep then reads only the backfilled live trials
+    stats, finished = lambda_handler.sweep_trials('run', NOW + timedelta(days=6))
+    assert stats['read'] == stats['deactivated'] == 1000
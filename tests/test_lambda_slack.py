@@ -1,8 +1,19 @@
 import os
+import json
+import threading
+import time
+import hmac
+import base64
+import asyncio
+import hashlib
+import subprocess
+import sys
 import pytest
 import boto3
+from types import SimpleNamespace
 from lambda_slack import lambda_handler
-from moto import mock_dynamodb
+from expiry_scheduler import LocalExpiryScheduler
+from moto import mock_dynamodb, mock_sqs
 from freezegun import freeze_time
 
 
@@ -176,4 +187,1262 @@ def test_get_slack_id(slack_users_info_response):
 
 @freeze_time('2020-09-01 1:45:01')
 def test_get_timestamp():
-    assert lambda_handler.get_timestamp() == 1598924701
\ No newline at end of file
+    assert lambda_handler.get_timestamp() == 1598924701
+
+class FakeSlackClient:
+    def __init__(self, users_info_response=None):
+        self.updates = []
+        self.users_info_response = users_info_response
+        self.users_info_calls = 0
+        self.published_views = []
+
+    def chat_update(self, channel, ts, text):
+        self.updates.append(text)
+        return {"ok": True, "channel": channel, "ts": ts}
+
+    def users_info(self, user):
+        self.users_info_calls += 1
+        return self.users_info_response
+
+    def views_publish(self, user_id, view):
+        self.published_views.append(view)
+        return {"ok": True}
+
+
+def openai_stream_chunk(content):
+    delta = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+def test_get_openai_stream_delta():
+    assert lambda_handler.get_openai_stream_delta(openai_stream_chunk("Diana")) == "Diana"
+    assert lambda_handler.get_openai_stream_delta(openai_stream_chunk(None)) == ""
+    assert lambda_handler.get_openai_stream_delta(SimpleNamespace(choices=[])) == ""
+
+
+def test_stream_openai_response_coalesces_updates(monkeypatch, chat):
+    chunks = [openai_stream_chunk(c) for c in ["Di", "ana", " Ro", "ss", None]]
+    monkeypatch.setattr(lambda_handler, "get_openai_stream", lambda chat, model=None: iter(chunks))
+    clock = iter([0.0, 0.1, 0.2, 0.3, 1.5, 1.6]).__next__
+    said = []
+
+    def say(text, **kwargs):
+        said.append((text, kwargs))
+        return {"ok": True, "channel": "C04L47VUPMX", "ts": "1677959194.104610"}
+
+    client = FakeSlackClient()
+    content, completed, posted = lambda_handler.stream_openai_response(client, say, chat, clock=clock, thread_ts="1677959194.104609")
+    assert (content, completed, posted) == ("Diana Ross", True, True)
+    assert said == [(lambda_handler.STREAM_PLACEHOLDER, {"thread_ts": "1677959194.104609"})]
+    assert client.updates == ["Di", "Diana Ross"]
+
+
+def test_stream_openai_response_resends_an_edit_that_was_rate_limited(monkeypatch, chat):
+    from slack_sdk.errors import SlackApiError
+    from slack_sdk.web import SlackResponse
+    chunks = [openai_stream_chunk(c) for c in ["Hel", "lo", " wor", "ld!"]]
+    monkeypatch.setattr(lambda_handler, "get_openai_stream", lambda chat, model=None: iter(chunks))
+    monkeypatch.setattr(lambda_handler.time, "sleep", lambda seconds: None)
+
+    class RateLimitedSlackClient(FakeSlackClient):
+        def chat_update(self, channel, ts, text):
+            if text == "Hello world!" and "Hello world!" not in self.rate_limited:
+                self.rate_limited.append(text)
+                response = SlackResponse(client=self, http_verb="POST", api_url="chat.update", req_args={}, data={"ok": False, "error": "ratelimited"}, headers={"Retry-After": "0"}, status_code=429)
+                raise SlackApiError("ratelimited", response)
+            return super().chat_update(channel, ts, text)
+
+    client = RateLimitedSlackClient()
+    client.rate_limited = []
+    content, completed, posted = lambda_handler.stream_openai_response(client, lambda text, **kwargs: {"channel": "C1", "ts": "1"}, chat, clock=iter([0.0, 1.0, 2.0, 3.0, 4.0]).__next__)
+    assert (content, completed, posted) == ("Hello world!", True, True)
+    assert client.rate_limited == ["Hello world!"]
+    assert client.updates[-1] == "Hello world!"
+
+
+def test_stream_openai_response_error_before_first_token(monkeypatch, chat):
+    def failing_stream(chat, model=None):
+        raise Exception("OpenAI unavailable")
+
+    monkeypatch.setattr(lambda_handler, "get_openai_stream", failing_stream)
+    client = FakeSlackClient()
+    content, completed, posted = lambda_handler.stream_openai_response(client, lambda text, **kwargs: {"channel": "C1", "ts": "1"}, chat)
+    assert (content, completed, posted) == (lambda_handler.get_openai_unavailable_message(), False, True)
+    assert client.updates == [lambda_handler.get_openai_unavailable_message()]
+
+
+def test_reply_to_chat_does_not_cache_a_stream_cut_short(monkeypatch):
+    monkeypatch.setattr(lambda_handler, "STREAM_RESPONSES", True)
+    monkeypatch.setattr(lambda_handler, "RESPONSE_CACHE_TTL", 60)
+    monkeypatch.setattr(lambda_handler, "response_cache", lambda_handler.TTLCache(10, 60))
+
+    def failing_stream(chat, model=None):
+        yield openai_stream_chunk("Ring-")
+        raise Exception("connection reset")
+
+    monkeypatch.setattr(lambda_handler, "get_openai_stream", failing_stream)
+    client = FakeSlackClient()
+    chat = lambda_handler.add_to_chat(lambda_handler.start_chat(), "user", "what does the fox say?")
+    assert lambda_handler.reply_to_chat(chat, lambda text, **kwargs: {"channel": "C1", "ts": "1"}, client) == "Ring-"
+    assert client.updates == ["Ring-"]
+    assert len(lambda_handler.response_cache.items) == 0
+
+
+def signed_slack_request(body, timestamp, secret="secret"):
+    raw_body = json.dumps(body)
+    base_string = f"v0:{timestamp}:{raw_body}".encode()
+    signature = "v0=" + hmac.new(secret.encode(), base_string, hashlib.sha256).hexdigest()
+    return {
+        "headers": {"x-slack-request-timestamp": str(timestamp), "x-slack-signature": signature},
+        "body": raw_body,
+    }
+
+
+@pytest.fixture(scope='function')
+def app_mention_body(app_mention_event_thread_exists):
+    event = dict(app_mention_event_thread_exists, type="app_mention")
+    return {"team_id": "T04L47VTW0Z", "event_id": "Ev04L47VTW0Z", "event": event}
+
+
+def test_slack_signature_is_valid(monkeypatch, app_mention_body):
+    monkeypatch.setattr(lambda_handler, "SLACK_SIGNING_SECRET", "secret")
+    request = signed_slack_request(app_mention_body, 1677959194)
+    assert lambda_handler.slack_signature_is_valid(request["headers"], request["body"], current_time=1677959200)
+    assert not lambda_handler.slack_signature_is_valid(request["headers"], request["body"] + " ", current_time=1677959200)
+    assert not lambda_handler.slack_signature_is_valid(request["headers"], request["body"], current_time=1677959194 + 600)
+    assert not lambda_handler.slack_signature_is_valid({}, request["body"])
+
+
+def test_handler_queues_generation_events(monkeypatch, app_mention_body):
+    queue = lambda_handler.MemoryEventQueue()
+    monkeypatch.setattr(lambda_handler, "event_queue", queue)
+    monkeypatch.setattr(lambda_handler, "SLACK_SIGNING_SECRET", "secret")
+    request = signed_slack_request(app_mention_body, int(time.time()))
+
+    response = lambda_handler.handler(request, None)
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"]) == {"message": "Queued event"}
+    assert queue.messages == [app_mention_body]
+
+    request["headers"]["x-slack-signature"] = "v0=invalid"
+    assert lambda_handler.handler(request, None)["statusCode"] == 401
+    assert len(queue.messages) == 1
+
+
+def test_drain_event_queue_in_batches(monkeypatch, tmp_path, app_mention_body):
+    handled = []
+    monkeypatch.setattr(lambda_handler, "app_mention_event", lambda event, say, client: handled.append(event))
+    monkeypatch.setattr(lambda_handler, "get_worker_client", lambda body: None)
+    queue = lambda_handler.FileEventQueue(str(tmp_path / "events.jsonl"))
+    for _ in range(5):
+        queue.send(app_mention_body)
+
+    assert lambda_handler.drain_event_queue(queue, batch_size=2) == 5
+    assert handled == [app_mention_body["event"]] * 5
+    assert queue.receive(2) == []
+
+
+@pytest.mark.parametrize("queue_type", ["file", "memory"])
+def test_drain_event_queue_deletes_only_processed_events(monkeypatch, tmp_path, app_mention_body, queue_type):
+    def app_mention_event(event, say, client):
+        if event.get("text") == "fail":
+            raise Exception("OpenAI unavailable")
+
+    monkeypatch.setattr(lambda_handler, "app_mention_event", app_mention_event)
+    monkeypatch.setattr(lambda_handler, "get_worker_client", lambda body: None)
+    queue = lambda_handler.FileEventQueue(str(tmp_path / "events.jsonl")) if queue_type == "file" else lambda_handler.MemoryEventQueue()
+    failing_body = dict(app_mention_body, event=dict(app_mention_body["event"], text="fail"))
+    for body in [app_mention_body, failing_body, app_mention_body]:
+        queue.send(body)
+
+    assert lambda_handler.drain_event_queue(queue, batch_size=2) == 3
+    assert [body for _, body in queue.receive(10)] == [failing_body]
+
+
+def test_worker_handler_reports_batch_item_failures(monkeypatch, app_mention_body):
+    def app_mention_event(event, say, client):
+        if event.get("text") == "fail":
+            raise Exception("OpenAI unavailable")
+
+    monkeypatch.setattr(lambda_handler, "app_mention_event", app_mention_event)
+    monkeypatch.setattr(lambda_handler, "get_worker_client", lambda body: None)
+    failing_body = dict(app_mention_body, event=dict(app_mention_body["event"], text="fail"))
+    records = [
+        {"messageId": "1", "body": json.dumps(app_mention_body)},
+        {"messageId": "2", "body": json.dumps(failing_body)},
+    ]
+    assert lambda_handler.worker_handler({"Records": records}, None) == {"batchItemFailures": [{"itemIdentifier": "2"}]}
+
+
+def test_sqs_event_queue_release_retries_within_seconds(monkeypatch, app_mention_body):
+    monkeypatch.setattr(lambda_handler, "EVENT_RETRY_DELAY", 0)
+    with mock_sqs():
+        sqs = boto3.client("sqs")
+        queue_url = sqs.create_queue(QueueName="test_events", Attributes={"VisibilityTimeout": "1800"})["QueueUrl"]
+        queue = lambda_handler.SqsEventQueue(queue_url)
+        queue.client = sqs
+        queue.send(app_mention_body)
+
+        [(handle, body)] = queue.receive(10)
+        assert queue.receive(10) == []
+        calls = []
+        change_message_visibility = sqs.change_message_visibility
+        monkeypatch.setattr(sqs, "change_message_visibility", lambda **kwargs: calls.append(kwargs) or change_message_visibility(**kwargs))
+        queue.release(handle)
+        assert calls == [{"QueueUrl": queue_url, "ReceiptHandle": handle, "VisibilityTimeout": 0}]
+
+        # Delivered again right away, and the receive still counts toward the DLQ
+        response = sqs.receive_message(QueueUrl=queue_url, AttributeNames=["ApproximateReceiveCount"])
+        [message] = response["Messages"]
+        assert json.loads(message["Body"]) == body
+        assert message["Attributes"]["ApproximateReceiveCount"] == "2"
+
+
+def test_worker_handler_releases_failed_records(monkeypatch, app_mention_body):
+    released = []
+    queue = lambda_handler.SqsEventQueue("https://sqs.us-east-1.amazonaws.com/123456789012/test_events")
+    monkeypatch.setattr(queue, "release", released.append)
+    monkeypatch.setattr(lambda_handler, "event_queue", queue)
+    monkeypatch.setattr(lambda_handler, "app_mention_event", lambda event, say, client: 1 / 0)
+    monkeypatch.setattr(lambda_handler, "get_worker_client", lambda body: None)
+    records = [{"messageId": "1", "receiptHandle": "handle-1", "body": json.dumps(app_mention_body)}]
+
+    assert lambda_handler.worker_handler({"Records": records}, None) == {"batchItemFailures": [{"itemIdentifier": "1"}]}
+    assert released == ["handle-1"]
+
+
+def test_worker_handler_processes_records_concurrently(monkeypatch, app_mention_body):
+    # Each event waits for the other, which only returns if they run side by side
+    barrier = threading.Barrier(2, timeout=5)
+    deadlines = []
+
+    def app_mention_event(event, say, client):
+        deadlines.append(lambda_handler.current_deadline.get())
+        barrier.wait()
+
+    class LambdaContext:
+        def get_remaining_time_in_millis(self):
+            return 300000
+
+    monkeypatch.setattr(lambda_handler, "app_mention_event", app_mention_event)
+    monkeypatch.setattr(lambda_handler, "get_worker_client", lambda body: None)
+    records = [{"messageId": str(i), "body": json.dumps(dict(app_mention_body, event_id=f"Ev{i}"))} for i in range(2)]
+    assert lambda_handler.worker_handler({"Records": records}, LambdaContext()) == {"batchItemFailures": []}
+    assert len(deadlines) == 2 and None not in deadlines
+
+
+def test_use_shared_slack_client_replaces_per_request_client():
+    from slack_bolt import BoltContext
+    context = BoltContext({"token": "xoxb-shared", "client": object()})
+    lambda_handler.use_shared_slack_client(context, lambda: None)
+    assert context["client"] is lambda_handler.get_slack_client("xoxb-shared")
+    assert context.say.client is context["client"]
+
+
+def test_strip_mentions():
+    assert lambda_handler.strip_mentions("<@U04KU9EAYNQ> who made that song popular?") == "who made that song popular?"
+    assert lambda_handler.strip_mentions("ask <@W012A3CDE|jane> about it") == "ask  about it"
+    assert lambda_handler.strip_mentions(None) == ""
+
+
+def test_count_message_tokens_uses_stored_count_without_writing_it():
+    message = {"role": "user", "content": "<@U04KU9EAYNQ> " + "a" * 40}
+    assert lambda_handler.count_message_tokens(message) == 10 + lambda_handler.MESSAGE_TOKEN_OVERHEAD
+    assert message == {"role": "user", "content": "<@U04KU9EAYNQ> " + "a" * 40}
+    assert lambda_handler.count_message_tokens(dict(message, tokens=3)) == 3
+
+
+def test_build_context_drops_oldest_turns_to_fit_budget(chat):
+    chat.append({"role": "user", "content": "x" * 400})
+    chat.append({"role": "assistant", "content": "y" * 40})
+    chat.append({"role": "user", "content": "<@U04KU9EAYNQ> and then?"})
+
+    context = lambda_handler.build_context(chat, budget=40)
+    assert context == [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "assistant", "content": "y" * 40},
+        {"role": "user", "content": "and then?"},
+    ]
+    assert all("tokens" not in message for message in chat)
+
+
+def test_build_context_truncates_oversized_latest_turn():
+    chat = lambda_handler.start_chat()
+    chat.append({"role": "user", "content": "z" * 1000})
+    context = lambda_handler.build_context(chat, budget=30, min_latest_tokens=0)
+    assert context[0]["role"] == "system"
+    assert context[1]["content"] == "z" * 60 + " [truncated]"
+
+
+def test_build_context_shrinks_the_summary_before_the_latest_turn():
+    chat = lambda_handler.start_chat()
+    chat.append({"role": "user", "content": "z" * 1000})
+    # The system prompt and summary alone are over the budget
+    context, prompt_tokens = lambda_handler.build_counted_context(chat, summary="s" * 1000, budget=100, min_latest_tokens=50)
+    assert context[1]["content"].startswith("Summary of the earlier conversation: s")
+    assert context[1]["content"].endswith(" [truncated]")
+    assert context[2]["content"] == "z" * 184 + " [truncated]"
+    assert prompt_tokens <= 100 + 2 * lambda_handler.MESSAGE_TOKEN_OVERHEAD
+
+    # With no room left for any summary, the latest turn still keeps its slice
+    context = lambda_handler.build_context(chat, summary="s" * 1000, budget=20, min_latest_tokens=50)
+    assert [message["role"] for message in context] == ["system", "user"]
+    assert context[1]["content"] == "z" * 184 + " [truncated]"
+
+
+def openai_completion(content):
+    message = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def long_chat(turns):
+    chat = lambda_handler.start_chat()
+    for i in range(turns):
+        chat.append({"role": "user", "content": f"question {i} " + "q" * 80})
+        chat.append({"role": "assistant", "content": f"answer {i} " + "a" * 80})
+    return chat
+
+
+def test_compact_chat_folds_old_turns_into_summary(monkeypatch):
+    prompts = []
+    def get_openai_response(chat):
+        prompts.append(chat)
+        return openai_completion("The user asked questions 0 to 3.")
+
+    monkeypatch.setattr(lambda_handler, "get_openai_response", get_openai_response)
+    chat = long_chat(5)
+    compacted, summary = lambda_handler.compact_chat(chat, "Earlier summary.", threshold=100, keep_turns=2)
+    assert summary == "The user asked questions 0 to 3."
+    assert compacted == [chat[0]] + chat[-2:]
+    assert "Earlier summary." in prompts[0][1]["content"]
+    assert "question 3" in prompts[0][1]["content"]
+    assert "question 4" not in prompts[0][1]["content"]
+
+
+def test_compact_chat_below_threshold_or_disabled(monkeypatch):
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat: pytest.fail("unexpected summarization"))
+    chat = long_chat(5)
+    assert lambda_handler.compact_chat(chat, None, threshold=0, keep_turns=2) == (chat, None)
+    assert lambda_handler.compact_chat(chat, None, threshold=100000, keep_turns=2, max_length=len(chat)) == (chat, None)
+
+
+def test_compact_chat_folds_chats_over_the_length_cap(monkeypatch):
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat: openai_completion("Folded."))
+    chat = long_chat(5)
+    assert lambda_handler.compact_chat(chat, None, threshold=100000, keep_turns=2, max_length=len(chat) - 1) == ([chat[0]] + chat[-2:], "Folded.")
+
+
+def test_compact_chat_keeps_chat_when_summarization_fails(monkeypatch):
+    def get_openai_response(chat):
+        raise Exception("OpenAI unavailable")
+
+    monkeypatch.setattr(lambda_handler, "get_openai_response", get_openai_response)
+    chat = long_chat(5)
+    assert lambda_handler.compact_chat(chat, "summary", threshold=100, keep_turns=2) == (chat, "summary")
+
+
+def test_build_context_includes_summary(chat):
+    context = lambda_handler.build_context(chat, summary="They talked about Motown.")
+    assert context[1] == {"role": "system", "content": "Summary of the earlier conversation: They talked about Motown."}
+    assert context[-1] == {"role": "assistant", "content": "Diana Ross"}
+
+
+def test_save_chat_to_ddb_with_summary(dynamodb_mock, chat):
+    ddb_id = "public_chat_id"
+    chat_id = "T04L47VTW0Z-C04L47VUPMX-1677959194.104609"
+    table = dynamodb_mock.create_table(
+        TableName='test_public_chats',
+        KeySchema=[{'AttributeName': ddb_id, 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': ddb_id, 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    lambda_handler.save_chat_to_ddb(table, ddb_id, chat_id, chat, "They talked about Motown.")
+    item = lambda_handler.get_ddb_item(table, ddb_id, chat_id)
+    assert lambda_handler.get_chat_from_ddb_item(item) == chat
+    assert lambda_handler.get_summary_from_ddb_item(item) == "They talked about Motown."
+    assert lambda_handler.get_summary_from_ddb_item(None) is None
+
+
+def test_ttl_cache_expiry_and_lru_eviction():
+    now = [0.0]
+    cache = lambda_handler.TTLCache(max_size=2, ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    now[0] = 11
+    assert cache.get("a", "missing") == "missing"
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_get_response_cache_key_normalizes_messages():
+    chat = lambda_handler.start_chat()
+    key = lambda_handler.get_response_cache_key("gpt-4o-mini", chat + [{"role": "user", "content": "<@U04KU9EAYNQ>  What does the fox   say?"}])
+    assert key == lambda_handler.get_response_cache_key("gpt-4o-mini", chat + [{"role": "user", "content": "what does the fox say?"}])
+    assert key != lambda_handler.get_response_cache_key("gpt-4o", chat + [{"role": "user", "content": "what does the fox say?"}])
+
+
+def test_reply_to_chat_caches_one_shot_questions(monkeypatch):
+    monkeypatch.setattr(lambda_handler, "RESPONSE_CACHE_TTL", 60)
+    monkeypatch.setattr(lambda_handler, "response_cache", lambda_handler.TTLCache(10, 60))
+    monkeypatch.setattr(lambda_handler, "response_cache_stats", {"hits": 0, "shared_hits": 0, "misses": 0, "bypassed": 0})
+    calls = []
+    def get_openai_response(chat, model=None):
+        calls.append(chat)
+        return openai_completion("Ring-ding-ding")
+
+    monkeypatch.setattr(lambda_handler, "get_openai_response", get_openai_response)
+    said = []
+    say = lambda text, **kwargs: said.append(text)
+
+    for text in ["<@U04KU9EAYNQ> what does the fox say?", "What does the fox say?"]:
+        chat = lambda_handler.add_to_chat(lambda_handler.start_chat(), "user", text)
+        assert lambda_handler.reply_to_chat(chat, say, None) == "Ring-ding-ding"
+
+    chat = lambda_handler.add_to_chat(long_chat(1), "user", "what does the fox say?")
+    lambda_handler.reply_to_chat(chat, say, None)
+    assert said == ["Ring-ding-ding"] * 3
+    assert len(calls) == 2
+    assert lambda_handler.response_cache_stats == {"hits": 1, "shared_hits": 0, "misses": 1, "bypassed": 1}
+
+
+def test_get_cached_response_shared_tier(monkeypatch, dynamodb_mock):
+    table = dynamodb_mock.create_table(
+        TableName='test_response_cache',
+        KeySchema=[{'AttributeName': 'cache_key', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'cache_key', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    monkeypatch.setattr(lambda_handler, "RESPONSE_CACHE_TTL", 60)
+    monkeypatch.setattr(lambda_handler, "response_cache_table", table)
+    monkeypatch.setattr(lambda_handler, "response_cache", lambda_handler.TTLCache(10, 60))
+    lambda_handler.set_cached_response("fox", "Ring-ding-ding")
+
+    monkeypatch.setattr(lambda_handler, "response_cache", lambda_handler.TTLCache(10, 60))
+    shared_hits = lambda_handler.response_cache_stats["shared_hits"]
+    assert lambda_handler.get_cached_response("fox") == "Ring-ding-ding"
+    assert lambda_handler.response_cache_stats["shared_hits"] == shared_hits + 1
+    assert lambda_handler.get_cached_response("dog") is None
+
+
+@pytest.fixture(scope='function')
+def users_id_table(dynamodb_mock, monkeypatch):
+    table = dynamodb_mock.create_table(
+        TableName='test_users_id',
+        KeySchema=[{'AttributeName': 'slack_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'slack_id', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    monkeypatch.setattr(lambda_handler, "users_id_table", table)
+    monkeypatch.setattr(lambda_handler, "user_record_cache", lambda_handler.TTLCache(10, 300))
+    return table
+
+
+def test_get_user_record_is_cached_across_events(users_id_table, message_event_private):
+    slack_id = "T04L47VTW0Z-U04NSB59LP9"
+    users_id_table.put_item(Item={"slack_id": slack_id, "active": True, "plan_type": "trial"})
+    assert lambda_handler.get_user_record(message_event_private).get("active")
+
+    users_id_table.delete_item(Key={"slack_id": slack_id})
+    assert lambda_handler.get_user_record(message_event_private).get("active")
+    assert lambda_handler.user_record_cache.hits == 1
+
+
+def test_get_user_record_negative_caching(users_id_table, message_event_private):
+    assert lambda_handler.get_user_record(message_event_private) is None
+    users_id_table.put_item(Item={"slack_id": "T04L47VTW0Z-U04NSB59LP9", "active": True})
+    assert lambda_handler.get_user_record(message_event_private) is None
+
+    lambda_handler.user_record_cache.clock = lambda: time.monotonic() + lambda_handler.USER_CACHE_NEGATIVE_TTL + 1
+    assert lambda_handler.get_user_record(message_event_private).get("active")
+
+
+def test_cache_user_record_bounds_active_records(monkeypatch, users_id_table):
+    now = [1709251200]
+    monkeypatch.setattr(lambda_handler, "get_timestamp", lambda: now[0])
+    monkeypatch.setattr(lambda_handler, "USER_CACHE_TTL", lambda_handler.USER_CACHE_MAX_TTL)
+    clock = [0.0]
+    lambda_handler.user_record_cache.clock = lambda: clock[0]
+    install_timestamp = now[0] - lambda_handler.get_trial_expires_at(0) + 10
+    lambda_handler.cache_user_record("T1-U1", {"active": True, "plan_type": "paid"})
+    lambda_handler.cache_user_record("T1-U2", {"active": True, "plan_type": "trial", "slack_install_timestamp": install_timestamp})
+
+    # A trial ending in 10 seconds is cached for 10 seconds, others for at most the cap
+    clock[0] = 11
+    assert lambda_handler.user_record_cache.get("T1-U2") is None
+    assert lambda_handler.user_record_cache.get("T1-U1") is not None
+    clock[0] = lambda_handler.USER_CACHE_MAX_TTL + 1
+    assert lambda_handler.user_record_cache.get("T1-U1") is None
+
+
+def test_user_cache_ttls_are_capped():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = "from lambda_slack import lambda_handler; print(lambda_handler.USER_CACHE_TTL, lambda_handler.USER_CACHE_NEGATIVE_TTL)"
+    env = dict(os.environ, PYTHONPATH=os.path.join(root, "lambda_common"), USER_CACHE_TTL="3600", USER_CACHE_NEGATIVE_TTL="10")
+    result = subprocess.run([sys.executable, "-c", script], cwd=root, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == [str(lambda_handler.USER_CACHE_MAX_TTL), "10"]
+
+
+@pytest.fixture(scope='function')
+def chat_turns_storage(dynamodb_mock, monkeypatch):
+    chats_table = dynamodb_mock.create_table(
+        TableName='test_private_chats',
+        KeySchema=[{'AttributeName': 'private_chat_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'private_chat_id', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    turns_table = dynamodb_mock.create_table(
+        TableName='test_chat_turns',
+        KeySchema=[{'AttributeName': 'chat_id', 'KeyType': 'HASH'}, {'AttributeName': 'seq', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'chat_id', 'AttributeType': 'S'}, {'AttributeName': 'seq', 'AttributeType': 'N'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    monkeypatch.setattr(lambda_handler, "CHAT_STORAGE", "turns")
+    monkeypatch.setattr(lambda_handler, "chat_turns_table", turns_table)
+    return chats_table, turns_table
+
+
+def test_run_chat_turn_appends_turns(monkeypatch, chat_turns_storage):
+    chats_table, turns_table = chat_turns_storage
+    monkeypatch.setattr(lambda_handler, "reply_to_chat", lambda chat, say, client, summary=None, **kwargs: f"answer {len(chat)}")
+    # moto applies Limit before ScanIndexForward=False, so keep the whole chat within one page
+    monkeypatch.setattr(lambda_handler, "MAX_CHAT_LENGTH", 11)
+    chat_id = "T04L47VTW0Z-C04L47VUPMX-U04NSB59LP9"
+
+    for i in range(5):
+        chat_record = lambda_handler.load_chat(chats_table, "private_chat_id", chat_id)
+        lambda_handler.run_chat_turn(chats_table, "private_chat_id", chat_id, chat_record, f"question {i}", None, None)
+
+    chat_turns_id = lambda_handler.get_chat_turns_id("private_chat_id", chat_id)
+    assert turns_table.scan()["Count"] == 11
+    assert turns_table.get_item(Key={"chat_id": chat_turns_id, "seq": lambda_handler.CHAT_METADATA_SEQ})["Item"] == {"chat_id": chat_turns_id, "seq": lambda_handler.CHAT_METADATA_SEQ, "last_seq": 10}
+    assert lambda_handler.get_ddb_item(chats_table, "private_chat_id", chat_id) is None
+
+    # Once saved, a load is a single query on the turns table
+    monkeypatch.setattr(lambda_handler, "get_ddb_item", lambda *args: pytest.fail("unexpected get_item"))
+    chat = lambda_handler.load_chat(chats_table, "private_chat_id", chat_id)["chat"]
+    assert len(chat) == 11
+    assert chat[0] == lambda_handler.start_chat()[0]
+    assert chat[-2]["content"] == "question 4"
+    assert chat[-1]["content"] == "answer 10"
+
+
+def test_load_chat_turns_migrates_legacy_chat_item(monkeypatch, chat_turns_storage, private_chats_item, chat):
+    chats_table, turns_table = chat_turns_storage
+    chats_table.put_item(Item=private_chats_item)
+
+    chat_record = lambda_handler.load_chat(chats_table, "private_chat_id", private_chats_item["private_chat_id"])
+    assert [(m["role"], m["content"]) for m in chat_record["chat"]] == [(m["role"], m["content"]) for m in chat]
+    assert chat_record["last_seq"] == 2
+    assert turns_table.scan()["Count"] == 3
+
+    # The migration is recorded on the metadata row, so it is not repeated
+    monkeypatch.setattr(lambda_handler, "get_ddb_item", lambda *args: pytest.fail("unexpected get_item"))
+    assert lambda_handler.load_chat(chats_table, "private_chat_id", private_chats_item["private_chat_id"]) == chat_record
+
+
+def test_run_chat_turn_folds_instead_of_trimming_once_summaries_are_enabled(monkeypatch, dynamodb_mock):
+    table = dynamodb_mock.create_table(
+        TableName='test_public_chats',
+        KeySchema=[{'AttributeName': 'public_chat_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'public_chat_id', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    prompts = []
+    def get_openai_response(chat):
+        prompts.append(chat[1]["content"])
+        return openai_completion(f"summary {len(prompts)}")
+
+    monkeypatch.setattr(lambda_handler, "get_openai_response", get_openai_response)
+    monkeypatch.setattr(lambda_handler, "reply_to_chat", lambda chat, say, client, summary=None, **kwargs: f"answer to {chat[-1]['content']}")
+    monkeypatch.setattr(lambda_handler, "MAX_CHAT_LENGTH", 5)
+    monkeypatch.setattr(lambda_handler, "SUMMARY_TOKEN_THRESHOLD", 100000)
+    monkeypatch.setattr(lambda_handler, "SUMMARY_KEEP_TURNS", 2)
+    chat_id = "T04L47VTW0Z-C04L47VUPMX-1677959194.104609"
+
+    for i in range(5):
+        chat_record = lambda_handler.load_chat(table, "public_chat_id", chat_id)
+        lambda_handler.run_chat_turn(table, "public_chat_id", chat_id, chat_record, f"question {i}", None, None)
+
+    # Every turn but the kept ones went through a summary, none were dropped
+    assert "question 0" in prompts[0] and "question 1" in prompts[0]
+    assert "question 2" in prompts[1] and "question 1" not in prompts[1]
+    chat_record = lambda_handler.load_chat(table, "public_chat_id", chat_id)
+    assert [message["content"] for message in chat_record["chat"][1:]] == ["question 4", "answer to question 4"]
+    assert chat_record["summary"] == "summary 2"
+
+
+def test_run_chat_turn_folds_turns_outside_the_loaded_tail(monkeypatch, chat_turns_storage):
+    chats_table, turns_table = chat_turns_storage
+    prompts = []
+    def get_openai_response(chat):
+        prompts.append(chat[1]["content"])
+        return openai_completion("Folded.")
+
+    monkeypatch.setattr(lambda_handler, "get_openai_response", get_openai_response)
+    monkeypatch.setattr(lambda_handler, "reply_to_chat", lambda chat, say, client, summary=None, **kwargs: "answer 3")
+    # moto applies Limit before ScanIndexForward=False, so keep the whole chat within one page
+    monkeypatch.setattr(lambda_handler, "MAX_CHAT_LENGTH", 11)
+    monkeypatch.setattr(lambda_handler, "SUMMARY_TOKEN_THRESHOLD", 1)
+    monkeypatch.setattr(lambda_handler, "SUMMARY_KEEP_TURNS", 2)
+    chat_id = "T04L47VTW0Z-C04L47VUPMX-U04NSB59LP9"
+    turns = []
+    for i in range(3):
+        turns += [{"role": "user", "content": f"question {i}"}, {"role": "assistant", "content": f"answer {i}"}]
+    lambda_handler.put_chat_turns(lambda_handler.get_chat_turns_id("private_chat_id", chat_id), 1, turns)
+
+    # Only the last two turns were loaded, as with a tail longer than MAX_CHAT_LENGTH
+    chat_record = {"chat": lambda_handler.start_chat() + turns[-2:], "summary": None, "summary_seq": 0, "seqs": [5, 6], "last_seq": 6}
+    lambda_handler.run_chat_turn(chats_table, "private_chat_id", chat_id, chat_record, "question 3", None, None)
+
+    assert all(f"question {i}" in prompts[0] for i in range(3))
+    assert "question 3" not in prompts[0]
+    chat_record = lambda_handler.load_chat(chats_table, "private_chat_id", chat_id)
+    assert chat_record["summary"] == "Folded."
+    assert chat_record["summary_seq"] == 6
+    assert chat_record["last_seq"] == 8
+    assert [message["content"] for message in chat_record["chat"][1:]] == ["question 3", "answer 3"]
+
+
+def test_encode_decode_chat(chat):
+    chat[1]["tokens"] = 11
+    chat.append({"role": "tool", "content": "lookup result"})
+    data = lambda_handler.encode_chat(chat)
+    assert data[0] == lambda_handler.CHAT_CODEC_VERSION
+    assert lambda_handler.decode_chat(data) == chat
+
+    with pytest.raises(ValueError):
+        lambda_handler.decode_chat(bytes([99]) + data[1:])
+
+
+def test_add_to_chat_counts_tokens_once(monkeypatch):
+    chat = lambda_handler.add_to_chat([lambda_handler.set_token_count(lambda_handler.start_chat()[0])], "user", "what does the fox say?")
+    assert chat[-1]["tokens"] == lambda_handler.estimate_tokens("what does the fox say?") + lambda_handler.MESSAGE_TOKEN_OVERHEAD
+    monkeypatch.setattr(lambda_handler, "estimate_tokens", lambda text: pytest.fail("counted twice"))
+    context, prompt_tokens = lambda_handler.build_counted_context(chat)
+    assert context[-1] == {"role": "user", "content": "what does the fox say?"}
+
+
+def test_save_chat_to_ddb_compressed(monkeypatch, dynamodb_mock, chat):
+    monkeypatch.setattr(lambda_handler, "CHAT_CODEC", "zlib")
+    ddb_id = "private_chat_id"
+    table = dynamodb_mock.create_table(
+        TableName='test_private_chats',
+        KeySchema=[{'AttributeName': ddb_id, 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': ddb_id, 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    lambda_handler.save_chat_to_ddb(table, ddb_id, "compressed", chat)
+    table.put_item(Item={ddb_id: "legacy", "chat": chat})
+
+    compressed_item = lambda_handler.get_ddb_item(table, ddb_id, "compressed")
+    assert "chat" not in compressed_item
+    assert lambda_handler.get_chat_from_ddb_item(compressed_item) == chat
+    # Every stored message carries its token count
+    assert all(message["tokens"] == lambda_handler.count_message_tokens({"content": message["content"]}) for message in lambda_handler.get_chat_from_ddb_item(compressed_item))
+    assert lambda_handler.get_chat_from_ddb_item(lambda_handler.get_ddb_item(table, ddb_id, "legacy")) == chat
+
+
+def test_challenge_and_ignored_events_skip_heavy_imports():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    now = int(time.time())
+    challenge = signed_slack_request({"type": "url_verification", "challenge": "abc"}, now)
+    bot_event = signed_slack_request({"event": {"type": "message", "bot_id": "B1"}}, now)
+    script = f"""
+import json, sys
+from lambda_slack import lambda_handler
+from expiry_scheduler import LocalExpiryScheduler
+print(lambda_handler.handler({challenge!r}, None)["body"])
+print(lambda_handler.handler({bot_event!r}, None)["body"])
+print(sorted({{"boto3", "openai", "slack_sdk", "slack_bolt"}} & set(sys.modules)))
+"""
+    env = dict(os.environ, PYTHONPATH=os.path.join(root, "lambda_common"), SLACK_SIGNING_SECRET="secret")
+    result = subprocess.run([sys.executable, "-c", script], cwd=root, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines() == ['{"challenge": "abc"}', '{"message": "Ignore bot"}', '[]']
+
+
+def test_handler_verifies_signature_before_filtering(monkeypatch):
+    monkeypatch.setattr(lambda_handler, "SLACK_SIGNING_SECRET", "secret")
+    monkeypatch.setattr(lambda_handler, "rejection_counters", lambda_handler.Counter())
+    request = signed_slack_request({"type": "url_verification", "challenge": "abc"}, int(time.time()))
+    request["headers"]["x-slack-signature"] = "v0=forged"
+    assert lambda_handler.handler(request, None)["statusCode"] == 401
+    request = signed_slack_request({"type": "url_verification", "challenge": "abc"}, int(time.time()))
+    request["headers"]["x-slack-request-timestamp"] = "not-a-timestamp"
+    assert lambda_handler.handler(request, None)["statusCode"] == 401
+
+    request = signed_slack_request({"event": {"type": "reaction_added"}}, int(time.time()))
+    assert json.loads(lambda_handler.handler(request, None)["body"]) == {"message": "Ignore event"}
+    request["headers"]["x-slack-retry-num"] = "1"
+    assert json.loads(lambda_handler.handler(request, None)["body"]) == {"message": "Ignore retry"}
+
+    # An unsigned retry is rejected as unsigned, not fast-pathed as a retry
+    request["headers"]["x-slack-signature"] = "v0=forged"
+    assert lambda_handler.handler(request, None)["statusCode"] == 401
+    assert lambda_handler.rejection_counters == {"signature": 3, "event_type": 1, "retry": 1}
+
+
+def test_handler_hands_parsed_body_to_bolt(monkeypatch, app_mention_body):
+    monkeypatch.setattr(lambda_handler, "SLACK_SIGNING_SECRET", "secret")
+    monkeypatch.setattr(lambda_handler, "event_queue", None)
+    dispatched = []
+    monkeypatch.setattr(lambda_handler, "dispatch_to_bolt", lambda body, headers, event, context: dispatched.append(body) or {"statusCode": 200})
+    request = signed_slack_request(app_mention_body, int(time.time()))
+    request["body"] = base64.b64encode(request["body"].encode()).decode()
+    request["isBase64Encoded"] = True
+
+    assert lambda_handler.handler(request, None) == {"statusCode": 200}
+    assert dispatched == [app_mention_body]
+
+
+@pytest.fixture(scope='function')
+def events_table(dynamodb_mock, monkeypatch):
+    table = dynamodb_mock.create_table(
+        TableName='test_events',
+        KeySchema=[{'AttributeName': 'event_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'event_id', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    monkeypatch.setattr(lambda_handler, "events_table", table)
+    monkeypatch.setattr(lambda_handler, "event_state_cache", lambda_handler.TTLCache(10, 60))
+    monkeypatch.setattr(lambda_handler, "resumed_event_replies", lambda_handler.TTLCache(10, 60))
+    return table
+
+
+def test_claim_event_states(events_table):
+    assert lambda_handler.claim_event("Ev1", now=1000) == lambda_handler.EVENT_CLAIMED
+    assert lambda_handler.claim_event("Ev1", now=1001) == lambda_handler.EVENT_IN_FLIGHT
+
+    # The first attempt died: once its lease runs out a retry takes over
+    resume_at = 1000 + lambda_handler.EVENT_LEASE_SECONDS + 1
+    assert lambda_handler.claim_event("Ev1", now=resume_at) == lambda_handler.EVENT_CLAIMED
+
+    lambda_handler.complete_event("Ev1")
+    assert events_table.get_item(Key={"event_id": "Ev1"})["Item"]["event_state"] == "completed"
+    events_table.delete_item(Key={"event_id": "Ev1"})
+    assert lambda_handler.claim_event("Ev1") == lambda_handler.EVENT_COMPLETED
+
+
+def test_worker_resumes_checkpointed_reply(monkeypatch, events_table, app_mention_body):
+    said = []
+    monkeypatch.setattr(lambda_handler, "get_worker_client", lambda body: None)
+    monkeypatch.setattr(lambda_handler, "get_user_record", lambda event: {"active": True})
+    monkeypatch.setattr(lambda_handler, "load_chat", lambda table, key_name, key_value: {"chat": lambda_handler.start_chat()})
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: openai_completion("Ring-ding-ding"))
+    monkeypatch.setattr("slack_bolt.context.say.Say.__call__", lambda self, text, **kwargs: said.append(text))
+
+    def save_chat_fails(*args):
+        raise Exception("DynamoDB unavailable")
+
+    monkeypatch.setattr(lambda_handler, "save_chat", save_chat_fails)
+    with pytest.raises(Exception):
+        lambda_handler.process_queued_event(app_mention_body)
+    item = events_table.get_item(Key={"event_id": "Ev04L47VTW0Z"})["Item"]
+    assert (item["reply"], item["reply_posted"]) == ("Ring-ding-ding", True)
+
+    # The retry only saves the reply the failed attempt already posted
+    saved = []
+    monkeypatch.setattr(lambda_handler, "save_chat", lambda *args: saved.append(args[-1]))
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: pytest.fail("reply was generated twice"))
+    lambda_handler.process_queued_event(app_mention_body)
+    lambda_handler.process_queued_event(app_mention_body)
+    assert said == ["Ring-ding-ding"]
+    assert [message["content"] for message in saved[0]][-1] == "Ring-ding-ding"
+
+
+def test_worker_skips_a_turn_the_failed_attempt_saved(monkeypatch, events_table, app_mention_body):
+    said, saved = [], []
+    monkeypatch.setattr(lambda_handler, "get_worker_client", lambda body: None)
+    monkeypatch.setattr(lambda_handler, "get_user_record", lambda event: {"active": True})
+    monkeypatch.setattr(lambda_handler, "load_chat", lambda table, key_name, key_value: {"chat": lambda_handler.start_chat()})
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: openai_completion("Ring-ding-ding"))
+    monkeypatch.setattr(lambda_handler, "save_chat", lambda *args: saved.append(args[-1]))
+    monkeypatch.setattr("slack_bolt.context.say.Say.__call__", lambda self, text, **kwargs: said.append(text))
+
+    # The attempt fails after the turn was saved
+    app_mention_event = lambda_handler.app_mention_event
+    def app_mention_event_fails(event, say, client):
+        app_mention_event(event, say, client)
+        raise Exception("Lambda timed out")
+
+    monkeypatch.setattr(lambda_handler, "app_mention_event", app_mention_event_fails)
+    with pytest.raises(Exception):
+        lambda_handler.process_queued_event(app_mention_body)
+    assert events_table.get_item(Key={"event_id": "Ev04L47VTW0Z"})["Item"]["turn_saved"] is True
+
+    monkeypatch.setattr(lambda_handler, "app_mention_event", app_mention_event)
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: pytest.fail("reply was generated twice"))
+    lambda_handler.process_queued_event(app_mention_body)
+    assert said == ["Ring-ding-ding"]
+    assert len(saved) == 1
+    assert "turn_saved" not in events_table.get_item(Key={"event_id": "Ev04L47VTW0Z"})["Item"]
+
+
+def test_worker_posts_a_checkpointed_reply_that_was_never_posted(monkeypatch, events_table, app_mention_body):
+    said = []
+    monkeypatch.setattr(lambda_handler, "get_worker_client", lambda body: None)
+    monkeypatch.setattr(lambda_handler, "get_user_record", lambda event: {"active": True})
+    monkeypatch.setattr(lambda_handler, "load_chat", lambda table, key_name, key_value: {"chat": lambda_handler.start_chat()})
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: openai_completion("Ring-ding-ding"))
+    monkeypatch.setattr(lambda_handler, "save_chat", lambda *args: None)
+
+    def say_fails(self, text, **kwargs):
+        raise Exception("Slack unavailable")
+
+    monkeypatch.setattr("slack_bolt.context.say.Say.__call__", say_fails)
+    with pytest.raises(Exception):
+        lambda_handler.process_queued_event(app_mention_body)
+    assert events_table.get_item(Key={"event_id": "Ev04L47VTW0Z"})["Item"]["reply_posted"] is False
+
+    monkeypatch.setattr("slack_bolt.context.say.Say.__call__", lambda self, text, **kwargs: said.append(text))
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: pytest.fail("reply was generated twice"))
+    lambda_handler.process_queued_event(app_mention_body)
+    assert said == ["Ring-ding-ding"]
+
+
+def test_reply_to_chat_checkpoints_only_completed_generations(monkeypatch, events_table):
+    monkeypatch.setattr(lambda_handler, "STREAM_RESPONSES", True)
+
+    def failing_stream(chat, model=None):
+        yield openai_stream_chunk("Ring-")
+        raise Exception("connection reset")
+
+    monkeypatch.setattr(lambda_handler, "get_openai_stream", failing_stream)
+    assert lambda_handler.claim_event("Ev1") == lambda_handler.EVENT_CLAIMED
+    token = lambda_handler.current_event_id.set("Ev1")
+    try:
+        chat = lambda_handler.add_to_chat(lambda_handler.start_chat(), "user", "what does the fox say?")
+        lambda_handler.reply_to_chat(chat, lambda text, **kwargs: {"channel": "C1", "ts": "1"}, FakeSlackClient())
+    finally:
+        lambda_handler.current_event_id.reset(token)
+    assert "reply" not in events_table.get_item(Key={"event_id": "Ev1"})["Item"]
+
+
+def test_reply_to_chat_retry_edits_the_placeholder_whose_closing_edit_failed(monkeypatch, events_table):
+    from slack_sdk.errors import SlackApiError
+    from slack_sdk.web import SlackResponse
+    monkeypatch.setattr(lambda_handler, "STREAM_RESPONSES", True)
+    monkeypatch.setattr(lambda_handler, "get_openai_stream", lambda chat, model=None: iter([openai_stream_chunk("Ring-ding-ding")]))
+
+    class FailingSlackClient(FakeSlackClient):
+        def chat_update(self, channel, ts, text):
+            if self.failures:
+                self.failures -= 1
+                raise SlackApiError("internal_error", SlackResponse(client=self, http_verb="POST", api_url="chat.update", req_args={}, data={"ok": False, "error": "internal_error"}, headers={}, status_code=500))
+            self.edited.append(ts)
+            return super().chat_update(channel, ts, text)
+
+    client = FailingSlackClient()
+    # Fails the first delta's edit and the closing edit
+    client.failures, client.edited = 2, []
+    posted = []
+    def say(text, **kwargs):
+        posted.append(text)
+        return {"channel": "C1", "ts": f"{len(posted)}.0"}
+
+    def reply():
+        assert lambda_handler.claim_event("Ev1") == lambda_handler.EVENT_CLAIMED
+        token = lambda_handler.current_event_id.set("Ev1")
+        try:
+            chat = lambda_handler.add_to_chat(lambda_handler.start_chat(), "user", "what does the fox say?")
+            return lambda_handler.reply_to_chat(chat, say, client)
+        finally:
+            lambda_handler.current_event_id.reset(token)
+
+    # The event is released with the reply checkpointed but unposted
+    with pytest.raises(lambda_handler.ReplyNotPosted):
+        reply()
+    lambda_handler.release_event("Ev1")
+    item = events_table.get_item(Key={"event_id": "Ev1"})["Item"]
+    assert (item["reply"], item["reply_posted"], item["reply_ts"]) == ("Ring-ding-ding", False, "1.0")
+
+    # The retry edits the same message instead of posting a second placeholder
+    monkeypatch.setattr(lambda_handler, "get_openai_stream", lambda chat, model=None: pytest.fail("reply was generated twice"))
+    assert reply() == "Ring-ding-ding"
+    assert posted == [lambda_handler.STREAM_PLACEHOLDER]
+    assert (client.edited, client.updates) == (["1.0"], ["Ring-ding-ding"])
+    assert events_table.get_item(Key={"event_id": "Ev1"})["Item"]["reply_posted"] is True
+
+
+def test_handler_lets_retries_through_idempotency_store(monkeypatch, events_table, app_mention_body):
+    monkeypatch.setattr(lambda_handler, "SLACK_SIGNING_SECRET", "secret")
+    monkeypatch.setattr(lambda_handler, "event_queue", None)
+    dispatched = []
+    monkeypatch.setattr(lambda_handler, "dispatch_to_bolt", lambda body, headers, event, context: dispatched.append(body) or {"statusCode": 200})
+    request = signed_slack_request(app_mention_body, int(time.time()))
+    request["headers"]["x-slack-retry-num"] = "1"
+
+    assert lambda_handler.handler(request, None) == {"statusCode": 200}
+    response = lambda_handler.handler(request, None)
+    assert json.loads(response["body"]) == {"message": "Ignore duplicate"}
+    assert response["headers"]["X-Slack-No-Retry"] == "1"
+    assert len(dispatched) == 1
+
+
+def test_handler_keeps_slack_retrying_while_in_flight(monkeypatch, events_table, app_mention_body):
+    monkeypatch.setattr(lambda_handler, "SLACK_SIGNING_SECRET", "secret")
+    monkeypatch.setattr(lambda_handler, "event_queue", None)
+    monkeypatch.setattr(lambda_handler, "dispatch_to_bolt", lambda body, headers, event, context: pytest.fail("dispatched while in flight"))
+    assert lambda_handler.claim_event(app_mention_body["event_id"]) == lambda_handler.EVENT_CLAIMED
+
+    response = lambda_handler.handler(signed_slack_request(app_mention_body, int(time.time())), None)
+    assert response == {"statusCode": 200, "body": json.dumps({"message": "Event in flight"})}
+
+
+def test_run_chat_turn_merges_concurrent_turns(monkeypatch, dynamodb_mock):
+    table = dynamodb_mock.create_table(
+        TableName='test_public_chats',
+        KeySchema=[{'AttributeName': 'public_chat_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'public_chat_id', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    monkeypatch.setattr(lambda_handler, "reply_to_chat", lambda chat, say, client, summary=None, **kwargs: f"answer to {chat[-1]['content']}")
+    monkeypatch.setattr(lambda_handler, "MAX_CHAT_LENGTH", 11)
+    chat_id = "T04L47VTW0Z-C04L47VUPMX-1677959194.104609"
+
+    # Both turns load the chat before either one is saved
+    first_record = lambda_handler.load_chat(table, "public_chat_id", chat_id)
+    second_record = lambda_handler.load_chat(table, "public_chat_id", chat_id)
+    lambda_handler.run_chat_turn(table, "public_chat_id", chat_id, first_record, "first", None, None)
+    lambda_handler.run_chat_turn(table, "public_chat_id", chat_id, second_record, "second", None, None)
+
+    chat_record = lambda_handler.load_chat(table, "public_chat_id", chat_id)
+    assert [message["content"] for message in chat_record["chat"][1:]] == ["first", "answer to first", "second", "answer to second"]
+    assert chat_record["version"] == 2
+
+
+def test_run_chat_turn_merges_concurrent_turns_in_turns_storage(monkeypatch, chat_turns_storage):
+    chats_table, turns_table = chat_turns_storage
+    monkeypatch.setattr(lambda_handler, "reply_to_chat", lambda chat, say, client, summary=None, **kwargs: f"answer to {chat[-1]['content']}")
+    monkeypatch.setattr(lambda_handler, "MAX_CHAT_LENGTH", 11)
+    chat_id = "T04L47VTW0Z-C04L47VUPMX-U04NSB59LP9"
+
+    first_record = lambda_handler.load_chat(chats_table, "private_chat_id", chat_id)
+    second_record = lambda_handler.load_chat(chats_table, "private_chat_id", chat_id)
+    lambda_handler.run_chat_turn(chats_table, "private_chat_id", chat_id, first_record, "first", None, None)
+    lambda_handler.run_chat_turn(chats_table, "private_chat_id", chat_id, second_record, "second", None, None)
+
+    chat = lambda_handler.load_chat(chats_table, "private_chat_id", chat_id)["chat"]
+    assert [message["content"] for message in chat[1:]] == ["first", "answer to first", "second", "answer to second"]
+    assert turns_table.scan()["Count"] == 5
+
+
+def test_run_chat_turn_keeps_the_sent_reply_when_every_save_conflicts(monkeypatch, dynamodb_mock):
+    table = dynamodb_mock.create_table(
+        TableName='test_public_chats',
+        KeySchema=[{'AttributeName': 'public_chat_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'public_chat_id', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    attempts = []
+    monkeypatch.setattr(lambda_handler, "try_save_chat", lambda *args: attempts.append(args) and False)
+    monkeypatch.setattr(lambda_handler, "reply_to_chat", lambda chat, say, client, summary=None, **kwargs: "answer")
+    chat_id = "T04L47VTW0Z-C04L47VUPMX-1677959194.104609"
+
+    chat_record = lambda_handler.load_chat(table, "public_chat_id", chat_id)
+    with pytest.raises(lambda_handler.ChatSaveConflict):
+        lambda_handler.save_chat(table, "public_chat_id", chat_id, chat_record, lambda_handler.start_chat(), None, [])
+    attempts.clear()
+    assert lambda_handler.run_chat_turn(table, "public_chat_id", chat_id, chat_record, "question", None, None) == "answer"
+    assert len(attempts) == lambda_handler.CHAT_SAVE_ATTEMPTS
+
+
+def test_get_chat_lock_is_shared_per_chat(monkeypatch):
+    monkeypatch.setattr(lambda_handler, "chat_locks", lambda_handler.OrderedDict())
+    monkeypatch.setattr(lambda_handler, "CHAT_LOCKS_SIZE", 2)
+    lock = lambda_handler.get_chat_lock("a")
+    assert lambda_handler.get_chat_lock("a") is lock
+    with lock:
+        lambda_handler.get_chat_lock("b")
+        lambda_handler.get_chat_lock("c")
+        # A held lock is never evicted
+        assert lambda_handler.get_chat_lock("a") is lock
+    lambda_handler.get_chat_lock("d")
+    lambda_handler.get_chat_lock("e")
+    assert list(lambda_handler.chat_locks) == ["d", "e"]
+
+
+def test_local_rate_limiter_buckets_per_team():
+    now = [0.0]
+    limiter = lambda_handler.LocalRateLimiter(2, 1000, clock=lambda: now[0])
+    assert limiter.acquire("T1", 100) == 0
+    assert limiter.acquire("T1", 100) == 0
+    assert limiter.acquire("T1", 100) == pytest.approx(30)
+    # Other teams have their own budget
+    assert limiter.acquire("T2", 900) == 0
+    assert limiter.acquire("T2", 200) == pytest.approx(6)
+    now[0] = 30
+    assert limiter.acquire("T1", 100) == 0
+
+
+def test_local_rate_limiter_and_caches_are_shared_safely_across_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    limiter = lambda_handler.LocalRateLimiter(50, 0, clock=lambda: 0.0)
+    cache = lambda_handler.TTLCache(8, 60)
+
+    def worker(i):
+        cache.set(i % 16, i)
+        cache.get((i + 1) % 16)
+        return limiter.acquire("T1", 1)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        waits = list(executor.map(worker, range(2000)))
+    assert waits.count(0) == 50
+    assert len(cache.items) == 8
+
+
+def test_dynamo_rate_limiter_fixed_windows(dynamodb_mock):
+    table = dynamodb_mock.create_table(
+        TableName='test_rate_limits',
+        KeySchema=[{'AttributeName': 'limit_key', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'limit_key', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    now = [6000.0]
+    limiter = lambda_handler.DynamoRateLimiter(table, 0, 1000, clock=lambda: now[0])
+    assert limiter.acquire("T1", 600) == 0
+    assert limiter.acquire("T1", 600) == 60
+    assert limiter.acquire("T1", 400) == 0
+    now[0] = 6060
+    assert limiter.acquire("T1", 600) == 0
+    assert table.get_item(Key={"limit_key": "T1#100"})["Item"]["tokens"] == 1000
+
+
+def test_run_chat_turn_replies_busy_when_team_is_over_budget(monkeypatch, chat):
+    said, saved = [], []
+    monkeypatch.setattr(lambda_handler, "rate_limiter", lambda_handler.LocalRateLimiter(1, 0))
+    monkeypatch.setattr(lambda_handler, "RATE_LIMIT_MAX_WAIT", 0)
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: openai_completion("Diana Ross"))
+    monkeypatch.setattr(lambda_handler, "save_chat", lambda *args: saved.append(args))
+    say = lambda text, **kwargs: said.append(text)
+
+    lambda_handler.run_chat_turn(None, "public_chat_id", "chat", {"chat": list(chat)}, "who?", say, None, team_id="T1")
+    lambda_handler.run_chat_turn(None, "public_chat_id", "chat", {"chat": list(chat)}, "who?", say, None, team_id="T1")
+    assert said == ["Diana Ross", lambda_handler.get_rate_limited_message()]
+    assert len(saved) == 1
+
+
+def test_reply_to_chat_apologizes_when_openai_fails(monkeypatch, chat):
+    said = []
+
+    def get_openai_response(chat, model=None):
+        raise Exception("OpenAI deadline exceeded")
+
+    monkeypatch.setattr(lambda_handler, "get_openai_response", get_openai_response)
+    message = lambda_handler.reply_to_chat(list(chat), lambda text, **kwargs: said.append(text), None)
+    assert said == [message] == [lambda_handler.get_openai_unavailable_message()]
+
+
+def test_reply_to_chat_sends_only_role_and_content(monkeypatch, chat):
+    sent = []
+    monkeypatch.setattr(lambda_handler, "rate_limiter", lambda_handler.LocalRateLimiter(10, 10000))
+    monkeypatch.setattr(lambda_handler, "model_routes", [{"model": "fast", "max_prompt_tokens": 1000}])
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: sent.append(chat) or openai_completion("Diana Ross"))
+    chat.append({"role": "user", "content": "who sang it?", "tokens": 6})
+    chat.append({"role": "assistant", "content": "The Supremes"})
+    chat.append({"role": "user", "content": "<@U04KU9EAYNQ> and the lead?"})
+
+    lambda_handler.reply_to_chat(chat, lambda text, **kwargs: None, None, team_id="T1")
+    assert len(sent[0]) == len(chat)
+    assert all(set(message) == {"role", "content"} for message in sent[0])
+
+
+def test_get_deadline_keeps_margin_for_reply():
+    class LambdaContext:
+        def get_remaining_time_in_millis(self):
+            return 300000
+
+    deadline = lambda_handler.get_deadline(LambdaContext())
+    assert deadline - time.monotonic() == pytest.approx(300 - lambda_handler.OPENAI_DEADLINE_MARGIN, abs=1)
+    assert lambda_handler.get_deadline(None) is None
+
+
+def test_route_model_first_matching_rule(monkeypatch):
+    monkeypatch.setattr(lambda_handler, "model_routes", lambda_handler.parse_model_routes(json.dumps([
+        {"model": "fast", "max_prompt_tokens": 50, "request_classes": ["im"]},
+        {"model": "long", "min_prompt_tokens": 1000},
+        {"model": "trial", "plans": ["trial"]},
+    ])))
+    short_context = lambda_handler.start_chat() + [{"role": "user", "content": "hi"}]
+    long_context = lambda_handler.start_chat() + [{"role": "user", "content": "word " * 1000}]
+    assert lambda_handler.route_model(short_context, request_class="im", plan_type="paid") == "fast"
+    assert lambda_handler.route_model(short_context, request_class="thread", plan_type="paid") == lambda_handler.OPENAI_MODEL
+    assert lambda_handler.route_model(long_context, request_class="im", plan_type="trial") == "long"
+    assert lambda_handler.route_model(short_context, request_class="thread", plan_type="trial") == "trial"
+    assert lambda_handler.parse_model_routes("not json") == []
+
+
+def test_reply_to_chat_uses_routed_model(monkeypatch, chat):
+    monkeypatch.setattr(lambda_handler, "model_routes", [{"model": "fast", "request_classes": ["im"]}])
+    models = []
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: models.append(model) or openai_completion("Diana Ross"))
+    lambda_handler.reply_to_chat(list(chat), lambda text, **kwargs: None, None, request_class="im")
+    lambda_handler.reply_to_chat(list(chat), lambda text, **kwargs: None, None, request_class="thread")
+    assert models == ["fast", lambda_handler.OPENAI_MODEL]
+
+
+def test_reply_to_chat_counts_the_context_once(monkeypatch, chat):
+    budgets = []
+    monkeypatch.setattr(lambda_handler, "model_routes", [{"model": "fast", "max_prompt_tokens": 1000}])
+    monkeypatch.setattr(lambda_handler, "get_chat_token_count", lambda chat: pytest.fail("context counted again"))
+    monkeypatch.setattr(lambda_handler, "acquire_openai_budget", lambda team_id, tokens: budgets.append(tokens) or True)
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: openai_completion("Diana Ross"))
+
+    lambda_handler.reply_to_chat(chat, lambda text, **kwargs: None, None, team_id="T1")
+    assert budgets == [lambda_handler.build_counted_context(chat)[1]]
+
+
+def test_app_home_opened_skips_users_info_and_unchanged_views(monkeypatch, dynamodb_mock, users_id_table, slack_users_info_response):
+    users_email_table = dynamodb_mock.create_table(
+        TableName='test_users_email',
+        KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    monkeypatch.setattr(lambda_handler, "users_email_table", users_email_table)
+    event = {"type": "app_home_opened", "user": "U04KU2Y1AMS", "tab": "home"}
+    context = {"team_id": "T04L47VTW0Z"}
+    client = FakeSlackClient(slack_users_info_response)
+
+    # A new user is looked up once and onboarded
+    lambda_handler.app_home_opened_event(client, event, context)
+    assert client.users_info_calls == 1
+    assert client.published_views == [lambda_handler.get_home_view("trial", True)]
+
+    # Known users with an unchanged view cost one read and no Slack calls
+    lambda_handler.app_home_opened_event(client, event, context)
+    assert client.users_info_calls == 1
+    assert len(client.published_views) == 1
+
+    users_id_table.update_item(Key={"slack_id": "T04L47VTW0Z-U04KU2Y1AMS"}, UpdateExpression="SET active = :active", ExpressionAttributeValues={":active": False})
+    lambda_handler.app_home_opened_event(client, event, context)
+    assert client.published_views[-1] == lambda_handler.get_home_view("trial", False)
+    assert lambda_handler.get_home_view("trial", False) is lambda_handler.get_home_view("trial", False)
+
+
+def test_app_home_opened_republishes_an_old_unchanged_view(monkeypatch, users_id_table):
+    now = [1709251200]
+    monkeypatch.setattr(lambda_handler, "get_timestamp", lambda: now[0])
+    slack_id = "T04L47VTW0Z-U04KU2Y1AMS"
+    users_id_table.put_item(Item={"slack_id": slack_id, "active": True, "plan_type": "trial"})
+    event = {"type": "app_home_opened", "user": "U04KU2Y1AMS", "tab": "home"}
+    context = {"team_id": "T04L47VTW0Z"}
+    client = FakeSlackClient()
+
+    lambda_handler.app_home_opened_event(client, event, context)
+    lambda_handler.app_home_opened_event(client, event, context)
+    assert len(client.published_views) == 1
+
+    # Slack may have dropped the view since, e.g. on a reinstall
+    now[0] += lambda_handler.HOME_VIEW_MAX_AGE
+    lambda_handler.app_home_opened_event(client, event, context)
+    assert client.published_views == [lambda_handler.get_home_view("trial", True)] * 2
+    assert users_id_table.get_item(Key={"slack_id": slack_id})["Item"]["home_view_published_at"] == now[0]
+
+
+@pytest.fixture(scope='function')
+def users_email_table(dynamodb_mock, monkeypatch):
+    table = dynamodb_mock.create_table(
+        TableName='test_users_email',
+        KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    monkeypatch.setattr(lambda_handler, "users_email_table", table)
+    return table
+
+
+def test_add_new_user_is_idempotent(users_id_table, users_email_table):
+    user_record = lambda_handler.add_new_user("T1-U1", "test.user@gmail.com")
+    assert user_record["plan_type"] == "trial"
+    users_id_table.update_item(Key={"slack_id": "T1-U1"}, UpdateExpression="SET plan_type = :paid", ExpressionAttributeValues={":paid": "paid"})
+
+    # A repeated install keeps the existing record and adds no duplicate workspace
+    assert lambda_handler.add_new_user("T1-U1", "test.user@gmail.com")["plan_type"] == "paid"
+    lambda_handler.add_new_user("T2-U1", "test.user@gmail.com")
+    assert users_email_table.get_item(Key={"email": "test.user@gmail.com"})["Item"]["workspaces"] == {"T1-U1", "T2-U1"}
+
+
+def test_add_new_user_schedules_trial_expiry(monkeypatch, users_id_table, users_email_table):
+    scheduler = LocalExpiryScheduler()
+    monkeypatch.setattr(lambda_handler, "trial_expiry_scheduler", scheduler)
+    user_record = lambda_handler.add_new_user("T1-U1", "test.user@gmail.com")
+    expires_at = user_record["slack_install_timestamp"] + 7 * 86400
+
+    assert scheduler.pop_expired_keys(now=expires_at - 1) == []
+    assert scheduler.pop_expired_keys(now=expires_at) == ["T1-U1"]
+
+
+def test_add_new_user_migrates_legacy_workspaces_list(users_id_table, users_email_table):
+    users_email_table.put_item(Item={"email": "test.user@gmail.com", "workspaces": ["T1-U1", "T1-U1"]})
+    lambda_handler.add_new_user("T2-U1", "test.user@gmail.com")
+    assert users_email_table.get_item(Key={"email": "test.user@gmail.com"})["Item"]["workspaces"] == {"T1-U1", "T2-U1"}
+    assert users_id_table.get_item(Key={"slack_id": "T2-U1"})["Item"]["active"]
+
+
+@pytest.fixture(scope='function')
+def async_private_chats_table(dynamodb_mock, monkeypatch, users_id_table, message_event_private):
+    table = dynamodb_mock.create_table(
+        TableName='test_private_chats',
+        KeySchema=[{'AttributeName': 'private_chat_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'private_chat_id', 'AttributeType': 'S'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1}
+    )
+    monkeypatch.setattr(lambda_handler, "private_chats_table", table)
+    users_id_table.put_item(Item={"slack_id": "T04L47VTW0Z-U04NSB59LP9", "active": True, "plan_type": "trial"})
+    return table
+
+
+def test_async_message_event_saves_after_the_post(monkeypatch, async_private_chats_table, message_event_private):
+    def reply_to_chat(chat, say, client, summary=None, team_id=None, request_class=None, plan_type=None, **say_kwargs):
+        say("answer", **say_kwargs)
+        return "answer"
+
+    calls = []
+    save_chat = lambda_handler.save_chat
+    monkeypatch.setattr(lambda_handler, "reply_to_chat", reply_to_chat)
+    monkeypatch.setattr(lambda_handler, "save_chat", lambda *args: calls.append("save") or save_chat(*args))
+
+    async def say(text, **kwargs):
+        calls.append(("say", text, kwargs))
+        await asyncio.sleep(0.2)
+        calls.append("said")
+
+    client = SimpleNamespace(token="xoxb-fake")
+    asyncio.run(lambda_handler.async_message_event(message_event_private, say, client, None))
+
+    assert calls == [("say", "answer", {"channel": "C04L47VUPMX"}), "said", "save"]
+    chat = lambda_handler.load_chat(async_private_chats_table, "private_chat_id", lambda_handler.get_private_chat_id(message_event_private))["chat"]
+    assert [message["content"] for message in chat[1:]] == ["Why did the chicken cross the road?", "answer"]
+
+
+def test_async_message_event_retries_a_reply_whose_post_failed(monkeypatch, events_table, async_private_chats_table, message_event_private):
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: openai_completion("Ring-ding-ding"))
+    said = []
+    failures = [Exception("Slack unavailable")]
+
+    async def say(text, **kwargs):
+        if failures:
+            raise failures.pop()
+        said.append(text)
+
+    def process():
+        asyncio.run(lambda_handler.async_message_event(message_event_private, say, SimpleNamespace(token="xoxb-fake"), None))
+
+    # The failed post leaves the reply unposted and the turn unsaved
+    with pytest.raises(Exception, match="Slack unavailable"):
+        lambda_handler.run_event_once("Ev1", process)
+    assert events_table.get_item(Key={"event_id": "Ev1"})["Item"]["reply_posted"] is False
+    chat_id = lambda_handler.get_private_chat_id(message_event_private)
+    assert lambda_handler.get_ddb_item(async_private_chats_table, "private_chat_id", chat_id) is None
+
+    # The retry posts the checkpointed reply and saves the turn once
+    monkeypatch.setattr(lambda_handler, "get_openai_response", lambda chat, model=None: pytest.fail("reply was generated twice"))
+    lambda_handler.run_event_once("Ev1", process)
+    assert said == ["Ring-ding-ding"]
+    chat = lambda_handler.load_chat(async_private_chats_table, "private_chat_id", chat_id)["chat"]
+    assert [message["content"] for message in chat[1:]] == ["Why did the chicken cross the road?", "Ring-ding-ding"]
@@ -0,0 +1,132 @@
+import time
+import threading
+import pytest
+from lambda_stripe import lambda_handler
+from expiry_scheduler import LocalExpiryScheduler
+
+
+@pytest.fixture(scope='function')
+def users_tables(dynamodb_mock, monkeypatch):
+    users_id_table = dynamodb_mock.create_table(
+        TableName='test_users_id',
+        KeySchema=[{'AttributeName': 'slack_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'slack_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    users_email_table = dynamodb_mock.create_table(
+        TableName='test_users_email',
+        KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    monkeypatch.setattr(lambda_handler, "users_id_table", users_id_table)
+    monkeypatch.setattr(lambda_handler, "users_email_table", users_email_table)
+    return users_id_table, users_email_table
+
+
+def add_workspaces(users_id_table, users_email_table, email, count):
+    slack_ids = {f'T{i:04d}-U0001' for i in range(count)}
+    with users_id_table.batch_writer() as batch:
+        for slack_id in slack_ids:
+            batch.put_item(Item={'slack_id': slack_id, 'email': email, 'active': False, 'plan_type': 'trial', 'trial_expires_at': '2024-03-01'})
+    users_email_table.put_item(Item={'email': email, 'workspaces': slack_ids})
+    return slack_ids
+
+
+def get_stripe_request(payload):
+    timestamp = str(int(time.time()))
+    signature = lambda_handler.compute_signature(lambda_handler.get_payload_bytes(timestamp, payload), lambda_handler.STRIPE_SECRET)
+    return {
+        'headers': {'content-type': 'application/json', 'stripe-signature': f't={timestamp},v1={signature}'},
+        'body': payload,
+        'isBase64Encoded': False,
+    }
+
+
+def test_update_users_id_table_activates_workspaces_in_concurrent_transactions(monkeypatch, users_tables):
+    users_id_table, users_email_table = users_tables
+    slack_ids = add_workspaces(users_id_table, users_email_table, 'lol@lol.com', 250)
+    # moto's backend is not thread-safe, so its calls are serialized here;
+    # the chunks are still submitted from concurrent threads
+    moto_lock = threading.Lock()
+    transact_write_items = users_id_table.meta.client.transact_write_items
+    def serialized_transact_write_items(**kwargs):
+        with moto_lock:
+            return transact_write_items(**kwargs)
+    monkeypatch.setattr(users_id_table.meta.client, "transact_write_items", serialized_transact_write_items)
+
+    report = lambda_handler.update_users_id_table(lambda_handler.get_slack_ids('lol@lol.com'), 1689369093, 'lol@lol.com', 'evt_1', transaction_size=100, concurrency=3)
+    assert report == {slack_id: 'activated' for slack_id in slack_ids}
+    items = users_id_table.scan()['Items']
+    assert len(items) == 250
+    assert all(item['active'] and item['plan_type'] == 'paid' and 'trial_expires_at' not in item for item in items)
+
+
+def test_update_users_id_table_reports_failed_chunks(monkeypatch, users_tables):
+    users_id_table, users_email_table = users_tables
+    add_workspaces(users_id_table, users_email_table, 'lol@lol.com', 5)
+    slack_ids = lambda_handler.get_slack_ids('lol@lol.com')
+    transact_write_items = users_id_table.meta.client.transact_write_items
+    client_request_tokens = []
+
+    def conflicting_transact_write_items(**kwargs):
+        client_request_tokens.append(kwargs['ClientRequestToken'])
+        if kwargs['TransactItems'][0]['Update']['Key']['slack_id'] == slack_ids[0]:
+            error = {'Error': {'Code': 'TransactionCanceledException', 'Message': 'cancelled'}, 'CancellationReasons': [{'Code': 'TransactionConflict'}]}
+            raise users_id_table.meta.client.exceptions.TransactionCanceledException(error, 'TransactWriteItems')
+        return transact_write_items(**kwargs)
+    monkeypatch.setattr(users_id_table.meta.client, "transact_write_items", conflicting_transact_write_items)
+    sleeps = []
+    monkeypatch.setattr(lambda_handler, "get_activation_backoff", lambda attempt: sleeps.append(attempt) or 0)
+    scheduler = LocalExpiryScheduler()
+    for slack_id in slack_ids:
+        scheduler.schedule(slack_id, 100)
+    monkeypatch.setattr(lambda_handler, "trial_expiry_scheduler", scheduler)
+
+    report = lambda_handler.update_users_id_table(slack_ids, 1689369093, 'lol@lol.com', 'evt_1', transaction_size=2)
+    assert report == dict(zip(slack_ids, ['failed'] * 2 + ['activated'] * 3))
+    # Each chunk retries with its own idempotency token
+    assert len(client_request_tokens) == lambda_handler.ACTIVATION_ATTEMPTS + 2
+    assert len(set(client_request_tokens)) == 3
+    # Retries back off between attempts, not after the last one
+    assert sleeps == list(range(1, lambda_handler.ACTIVATION_ATTEMPTS))
+    assert [item['active'] for item in sorted(users_id_table.scan()['Items'], key=lambda item: item['slack_id'])] == [False] * 2 + [True] * 3
+    # Only the paid workspaces stop waiting for their trial to expire
+    assert scheduler.pop_expired_keys(now=100) == slack_ids[:2]
+
+
+def test_get_slack_ids_dedupes_legacy_workspaces_list(users_tables):
+    users_id_table, users_email_table = users_tables
+    slack_ids = sorted(add_workspaces(users_id_table, users_email_table, 'lol@lol.com', 3))
+    users_email_table.put_item(Item={'email': 'lol@lol.com', 'workspaces': slack_ids + slack_ids[:1]})
+
+    assert lambda_handler.get_slack_ids('lol@lol.com') == slack_ids
+    report = lambda_handler.update_users_id_table(lambda_handler.get_slack_ids('lol@lol.com'), 1689369093, 'lol@lol.com', 'evt_1')
+    assert report == {slack_id: 'activated' for slack_id in slack_ids}
+
+
+def test_activate_workspaces_reports_invalid_transactions_as_failed(users_tables):
+    users_id_table, users_email_table = users_tables
+    # DynamoDB rejects a transaction that touches the same item twice
+    assert lambda_handler.activate_workspaces(['T0000-U0001', 'T0000-U0001'], 1689369093, 'lol@lol.com') == 'failed'
+
+
+def test_client_request_token_follows_chunk_contents():
+    assert lambda_handler.get_client_request_token('evt_1', ['T1-U1', 'T2-U1']) == lambda_handler.get_client_request_token('evt_1', ['T1-U1', 'T2-U1'])
+    assert lambda_handler.get_client_request_token('evt_1', ['T1-U1', 'T2-U1']) != lambda_handler.get_client_request_token('evt_1', ['T1-U1', 'T3-U1'])
+    assert len(lambda_handler.get_client_request_token('evt_1', ['T1-U1'])) == 36
+    assert lambda_handler.get_client_request_token('', ['T1-U1']) is None
+
+
+def test_get_activation_backoff_is_jittered_and_capped():
+    assert lambda_handler.get_activation_backoff(1, jitter=lambda: 0.5) == 0.5 * lambda_handler.ACTIVATION_BACKOFF_BASE
+    assert lambda_handler.get_activation_backoff(30, jitter=lambda: 1.0) == lambda_handler.ACTIVATION_BACKOFF_MAX
+
+
+def test_handler_activates_every_workspace(users_tables, stripe_payment_intent_succeeded_event):
+    users_id_table, users_email_table = users_tables
+    add_workspaces(users_id_table, users_email_table, 'lol@lol.com', 3)
+
+    response = lambda_handler.handler(get_stripe_request(stripe_payment_intent_succeeded_event), None)
+    assert response['statusCode'] == 202
+    assert all(item['active'] and item['payment_timestamp'] == 1689369093 for item in users_id_table.scan()['Items'])
@@ -0,0 +1,136 @@
+import json
+import time
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from openai_client import DeadlineExceeded, ResilientOpenAI
+
+
+def completion_body(model, content):
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": 1746718912,
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+    }
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # Each scripted reply is (status, delay, headers) for one model; a 200
+    # answers with the requested model's name.
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        model = request["model"]
+        self.server.requests.append(model)
+        script = self.server.scripts.get(model, [])
+        status, delay, headers = script.pop(0) if len(script) > 1 else script[0] if script else (200, 0, {})
+        time.sleep(delay)
+        body = completion_body(model, f"answer from {model}") if status == 200 else {"error": {"message": "fake error"}}
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='function')
+def fake_openai():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler)
+    server.scripts = {}
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_client(server, **kwargs):
+    sleeps = []
+    client = ResilientOpenAI(
+        "sk-fake",
+        "primary",
+        base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+        sleep=sleeps.append,
+        jitter=lambda: 1.0,
+        **kwargs
+    )
+    return client, sleeps
+
+
+def test_retries_429_and_5xx_with_backoff(fake_openai):
+    fake_openai.scripts["primary"] = [(429, 0, {"retry-after": "2"}), (503, 0, {}), (200, 0, {})]
+    client, sleeps = get_client(fake_openai)
+    response = client.create([{"role": "user", "content": "hi"}])
+    assert response.choices[0].message.content == "answer from primary"
+    assert sleeps == [2.0, 1.0]
+    assert client.stats["retries"] == 2
+
+
+def test_does_not_retry_client_errors(fake_openai):
+    fake_openai.scripts["primary"] = [(400, 0, {})]
+    client, sleeps = get_client(fake_openai, fallback_model="fallback")
+    with pytest.raises(Exception):
+        client.create([{"role": "user", "content": "hi"}])
+    assert fake_openai.requests == ["primary"]
+
+
+def test_falls_back_when_primary_is_unavailable(fake_openai):
+    fake_openai.scripts["primary"] = [(500, 0, {})]
+    client, sleeps = get_client(fake_openai, fallback_model="fallback", max_attempts=2)
+    response = client.create([{"role": "user", "content": "hi"}])
+    assert response.choices[0].message.content == "answer from fallback"
+    assert fake_openai.requests == ["primary", "primary", "fallback"]
+    assert client.stats["fallbacks"] == 1
+
+
+def test_deadline_bounds_request_timeout(fake_openai):
+    fake_openai.scripts["primary"] = [(200, 1.0, {})]
+    client, sleeps = get_client(fake_openai, max_attempts=1)
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        client.create([{"role": "user", "content": "hi"}], deadline=time.monotonic() + 0.2)
+    assert time.monotonic() - start < 0.9
+
+    with pytest.raises(DeadlineExceeded):
+        client.create([{"role": "user", "content": "hi"}], deadline=time.monotonic() - 1)
+
+
+def test_hedges_slow_requests_to_fallback_model(fake_openai):
+    fake_openai.scripts["primary"] = [(200, 0, {})] * 3 + [(200, 0.5, {})]
+    client, sleeps = get_client(fake_openai, fallback_model="fallback", hedge=True, hedge_min_samples=3)
+    for _ in range(3):
+        client.create([{"role": "user", "content": "hi"}])
+
+    start = time.monotonic()
+    response = client.create([{"role": "user", "content": "hi"}])
+    assert response.choices[0].message.content == "answer from fallback"
+    assert time.monotonic() - start < 0.4
+    assert client.stats["hedged"] == 1
+    assert client.stats["hedge_wins"] == 1
+    # Let the abandoned primary call finish before the fake server shuts down
+    time.sleep(0.5)
+
+
+def test_hedges_routed_models_on_their_own_latency(fake_openai):
+    fake_openai.scripts["large"] = [(200, 0, {})] * 3 + [(200, 0.5, {})]
+    client, sleeps = get_client(fake_openai, fallback_model="fallback", hedge=True, hedge_min_samples=3)
+    for _ in range(3):
+        client.create([{"role": "user", "content": "hi"}], model="large")
+    assert len(client.get_latency("large")) == 3
+    assert len(client.get_latency("primary")) == 0
+
+    start = time.monotonic()
+    response = client.create([{"role": "user", "content": "hi"}], model="large")
+    assert response.choices[0].message.content == "answer from fallback"
+    assert time.monotonic() - start < 0.4
+    assert client.get_stats()["hedged"] == 1
+    assert client.get_stats()["hedge_wins"] == 1
+    time.sleep(0.5)
@@ -0,0 +1,82 @@
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+from slack_notifier import SlackNotifier
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeClient:
+    def __init__(self, clock, rate_limited=0, retry_after="5", status_code=429):
+        self.clock = clock
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.status_code = status_code
+        self.calls = []
+
+    def api_call(self, method, json=None):
+        if self.rate_limited:
+            self.rate_limited -= 1
+            response = SlackResponse(client=self, http_verb="POST", api_url=method, req_args={}, data={"ok": False, "error": "ratelimited"}, headers={"Retry-After": self.retry_after}, status_code=self.status_code)
+            raise SlackApiError("rate limited", response)
+        self.calls.append((self.clock(), method, json))
+
+
+def get_notifier(client, clock, **kwargs):
+    return SlackNotifier(lambda team_id: client if team_id != "T_GONE" else None, rates={"chat.postMessage": 60}, clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_slack_notifier_keeps_each_team_under_its_rate():
+    clock = FakeClock()
+    client = FakeClient(clock)
+    notifier = get_notifier(client, clock)
+
+    for i in range(70):
+        assert notifier.call("T1", "chat.postMessage", channel=f"U{i}", text="hi") == "sent"
+    assert notifier.call("T2", "chat.postMessage", channel="U1", text="hi") == "sent"
+    # A full bucket is sent at once, the rest at one per second
+    assert [at for at, _, _ in client.calls[:60]] == [0.0] * 60
+    assert [at for at, _, _ in client.calls[60:70]] == [float(i) for i in range(1, 11)]
+    assert client.calls[70] == (10.0, "chat.postMessage", {"channel": "U1", "text": "hi"})
+    assert notifier.call("T_GONE", "chat.postMessage", channel="U1", text="hi") == "no_client"
+
+
+def test_slack_notifier_waits_out_retry_after():
+    clock = FakeClock()
+    client = FakeClient(clock, rate_limited=1)
+    notifier = get_notifier(client, clock)
+
+    assert notifier.call("T1", "chat.postMessage", channel="U1", text="hi") == "sent"
+    assert notifier.call("T1", "chat.postMessage", channel="U2", text="hi") == "sent"
+    # The bucket is empty after Retry-After and refills from there
+    assert [at for at, _, _ in client.calls] == [5.0, 6.0]
+    assert notifier.stats == {"retried": 1, "waited": 2, "sent": 2}
+
+    client.rate_limited = 3
+    assert notifier.call("T1", "chat.postMessage", channel="U3", text="hi") == "rate_limited"
+
+    client.status_code = 400
+    client.rate_limited = 1
+    assert notifier.call("T1", "chat.postMessage", channel="U4", text="hi") == "failed"
+
+
+def test_slack_notifier_defers_past_the_deadline():
+    clock = FakeClock()
+    client = FakeClient(clock, rate_limited=1, retry_after="30")
+    notifier = get_notifier(client, clock, deadline=20)
+
+    assert notifier.call("T1", "chat.postMessage", channel="U1", text="hi") == "rate_limited"
+    assert notifier.call("T1", "chat.postMessage", channel="U2", text="hi") == "deferred"
+    assert not notifier.acquire("T1", "chat.postMessage")
+    assert client.calls == []
+    assert clock.sleeps == []
@@ -0,0 +1,49 @@
+import json
+import logging
+import structured_log
+
+
+def test_parse_sample_rates():
+    assert structured_log.parse_sample_rates("") == {}
+    assert structured_log.parse_sample_rates("ddb=0.1, openai=1") == {"ddb": 0.1, "openai": 1.0}
+
+
+def test_truncate():
+    assert structured_log.truncate(42) == 42
+    assert structured_log.truncate(None) is None
+    assert structured_log.truncate("abc", max_chars=5) == "abc"
+    assert structured_log.truncate("a" * 10, max_chars=4) == "aaaa...[6 more chars]"
+    assert structured_log.truncate({"role": "user"}, max_chars=100) == "{'role': 'user'}"
+
+    class Unformattable:
+        def __repr__(self):
+            raise AssertionError("formatted an element past the cap")
+
+    chat = [{"role": "user", "content": "x" * 10000}] * 10 + [Unformattable()]
+    text = structured_log.truncate({"chat": chat}, max_chars=50)
+    assert len(text) <= 50 + len("...[1000 more chars]")
+
+
+def test_log_event_is_lazy_and_level_gated(caplog):
+    calls = []
+    def expensive():
+        calls.append(1)
+        return "value"
+
+    with caplog.at_level(logging.WARNING, logger="bounce"):
+        structured_log.log_event("ddb", "skipped", field=expensive)
+    assert calls == []
+
+    with caplog.at_level(logging.INFO, logger="bounce"):
+        structured_log.log_event("ddb", "emitted", field=expensive, count=3)
+    assert calls == [1]
+    assert json.loads(caplog.records[-1].getMessage()) == {"category": "ddb", "message": "emitted", "field": "value", "count": 3}
+
+
+def test_log_event_sampling(monkeypatch, caplog):
+    monkeypatch.setattr(structured_log, "sample_rates", {"ddb": 0.0})
+    with caplog.at_level(logging.INFO, logger="bounce"):
+        structured_log.log_event("ddb", "sampled out")
+        structured_log.log_event("ddb", "always kept", level=logging.ERROR)
+        structured_log.log_event("openai", "unsampled category")
+    assert [json.loads(r.getMessage())["message"] for r in caplog.records] == ["always kept", "unsampled category"]